@@ -0,0 +1,82 @@
+# backend/answer_matching.py
+# Bilge Logvian - Simülasyon cevap eşleştirme motoru
+# Her challenge için eşleştirici uygulama açılırken bir kez derlenir ve
+# (lab_name, challenge index) anahtarlı tabloda tutulur. Gönderilen cevap lab türüne
+# göre normalize edilir; böylece aynı anlama gelen payload'lar (ör. ' OR 1=1-- ile
+# ' OR '1'='1' --) aynı kanonik biçime iner.
+
+import re
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Tuple
+
+Normalizer = Callable[[str], str]
+
+_SPACE_RE = re.compile(r"\s+")
+_SQL_BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/")
+_SQL_LINE_COMMENT_RE = re.compile(r"\s*(--|#).*$")
+_SQL_STATEMENT_END_RE = re.compile(r"\s*;+\s*(?=--$|$)")
+_SQL_TAUTOLOGY_RE = re.compile(r"'?(\w+)'?\s*=\s*'?(\w+)'?")
+_PUNCT_SPACE_RE = re.compile(r"\s*([=,()])\s*")
+_HTML_QUOTED_ATTR_RE = re.compile(r"=\s*'([^>]*?)'(?=[\s/>]|$)")
+_HTML_SCRIPT_END_RE = re.compile(r";?\s*</script\s*>")
+
+
+def normalize_text(answer: str) -> str:
+    return _SPACE_RE.sub(" ", answer.strip().lower())
+
+
+def normalize_sql(answer: str) -> str:
+    """SQLi payload'larını kanonik biçime indir"""
+    text = answer.strip().lower().replace('"', "'")
+    text = _SQL_BLOCK_COMMENT_RE.sub("", text)
+    # Satır sonu yorumu sorgunun kalanını etkisiz bıraktığı için cevabın parçasıdır; silinmez,
+    # -- ve # aynı kanonik " --" işaretine indirilir (admin' ile admin' -- aynı cevap değildir)
+    text = _SQL_LINE_COMMENT_RE.sub(" --", text)
+    text = _PUNCT_SPACE_RE.sub(r"\1", text)
+    # '1'='1, 1=1, 'a'='a' ... hepsi aynı tautoloji
+    text = _SQL_TAUTOLOGY_RE.sub(lambda m: "1=1" if m.group(1) == m.group(2) else m.group(0), text)
+    text = _SPACE_RE.sub(" ", text).strip()
+    return _SQL_STATEMENT_END_RE.sub(" ", text).strip()
+
+
+def normalize_xss(answer: str) -> str:
+    """HTML/JS payload'larında tırnak, boşluk ve büyük/küçük harf farklarını yok say"""
+    text = answer.strip().lower().replace('"', "'").replace("`", "'")
+    text = _SPACE_RE.sub(" ", text)
+    text = _PUNCT_SPACE_RE.sub(r"\1", text)
+    text = _HTML_QUOTED_ATTR_RE.sub(r"=\1", text)
+    text = _HTML_SCRIPT_END_RE.sub("</script>", text)
+    return text.replace(" >", ">").replace(" />", "/>")
+
+
+NORMALIZERS: Dict[str, Normalizer] = {
+    "text": normalize_text,
+    "sql": normalize_sql,
+    "xss": normalize_xss,
+}
+
+
+class AnswerMatcher:
+    __slots__ = ("normalize", "accepted", "patterns")
+
+    def __init__(self, normalize: Normalizer, accepted: Iterable[str], patterns: Iterable[str] = ()):
+        self.normalize = normalize
+        self.accepted: FrozenSet[str] = frozenset(normalize(a) for a in accepted)
+        # Desenler normalize edilmiş cevaba uygulanır
+        self.patterns = tuple(re.compile(p) for p in patterns)
+
+    def matches(self, answer: str) -> bool:
+        normalized = self.normalize(answer)
+        if normalized in self.accepted:
+            return True
+        return any(p.fullmatch(normalized) for p in self.patterns)
+
+
+def compile_matchers(labs: Dict[str, Dict[str, Any]]) -> Dict[Tuple[str, int], AnswerMatcher]:
+    """LAB_SIMULATIONS konfigürasyonundan (lab, challenge index) → eşleştirici tablosu oluştur"""
+    table: Dict[Tuple[str, int], AnswerMatcher] = {}
+    for lab_name, lab in labs.items():
+        normalize = NORMALIZERS[lab.get("answer_kind", "text")]
+        for index, challenge in enumerate(lab["challenges"]):
+            accepted = [challenge["solution"], *challenge.get("alternatives", [])]
+            table[(lab_name, index)] = AnswerMatcher(normalize, accepted, challenge.get("patterns", []))
+    return table
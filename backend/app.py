@@ -1,8 +1,24 @@
+import json
+import os
+import resource
+import sys
+import time
+from queue import Empty
+from threading import Event, Thread
+
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
 import torch
 
+# Nicemleme yardımcıları llm/ dizininde; sunucu ile aynı kodu kullan
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "llm"))
+from quantization import quantize_model  # noqa: E402
+from streaming import IncrementalDecoder, StopSequenceFilter, trim_at_stop  # noqa: E402
+
 # Modeli yükle (Phi-3-mini)
 model_path = "../llm"  # modeli nereye indirdiysen ona göre ayarla
 tokenizer = AutoTokenizer.from_pretrained(model_path)
@@ -12,6 +28,15 @@ model = AutoModelForCausalLM.from_pretrained(
     device_map="cpu"  # sadece CPU kullanıyoruz
 )
 
+# LLM_QUANTIZE=int8|int4 → dekoder Linear katmanları nicemlenir; llm sunucusuyla aynı yardımcı kullanılır
+QUANTIZE_REQUESTED = os.getenv("LLM_QUANTIZE", "none")
+model, QUANTIZE = quantize_model(model, QUANTIZE_REQUESTED)
+model.eval()
+
+STATS = {"generated_tokens": 0, "generate_seconds": 0.0}
+# Akışta iki parça arasında en fazla bu kadar saniye beklenir
+STREAM_TIMEOUT = float(os.getenv("LLM_STREAM_TIMEOUT", "60"))
+
 # FastAPI uygulaması
 app = FastAPI()
 
@@ -19,21 +44,126 @@ app = FastAPI()
 class ChatRequest(BaseModel):
     message: str
 
+def build_prompt(message: str) -> str:
+    return f"Sen Bilge Wizard'sın. Kullanıcıya siber güvenlik öğretmeni gibi davran. Açıkla, örnek ver ve gerekirse ödev ver.\n\nKullanıcı: {message}\nWizard:"
+
+# Model cevaptan sonra bir sonraki konuşmacının turunu da yazabilir; cevap bu işaretlerde kesilir
+SPEAKER_MARKERS = ("\nKullanıcı:", "\nWizard:")
+
+
+class StopOnSpeaker(StoppingCriteria):
+    """Üretilen metin bir sonraki konuşmacının işaretine ulaşınca üretimi durdur"""
+
+    def __init__(self):
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.filter = StopSequenceFilter(SPEAKER_MARKERS)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.filter.feed(self.decoder.push(int(input_ids[0, -1])))
+        return torch.full((input_ids.shape[0],), self.filter.stopped, dtype=torch.bool)
+
+
 @app.post("/chat")
 def chat(req: ChatRequest):
-    prompt = f"Sen Bilge Wizard'sın. Kullanıcıya siber güvenlik öğretmeni gibi davran. Açıkla, örnek ver ve gerekirse ödev ver.\n\nKullanıcı: {req.message}\nWizard:"
+    prompt = build_prompt(req.message)
 
     inputs = tokenizer(prompt, return_tensors="pt").to("cpu")
+    started = time.perf_counter()
     outputs = model.generate(
         **inputs,
         max_new_tokens=200,
         temperature=0.7,
-        top_p=0.9
+        top_p=0.9,
+        stopping_criteria=StoppingCriteriaList([StopOnSpeaker()])
     )
+    STATS["generate_seconds"] += time.perf_counter() - started
+
+    # Sadece prompt'tan sonra üretilen token'ları decode et
+    prompt_tokens = inputs["input_ids"].shape[1]
+    completion_ids = outputs[0][prompt_tokens:]
+    STATS["generated_tokens"] += len(completion_ids)
+    reply = trim_at_stop(tokenizer.decode(completion_ids, skip_special_tokens=True), SPEAKER_MARKERS).strip()
+
+    return {
+        "reply": reply,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(completion_ids),
+            "total_tokens": prompt_tokens + len(completion_ids)
+        }
+    }
+
+@app.get("/health")
+def health():
+    seconds = STATS["generate_seconds"]
+    return {
+        "quantization": QUANTIZE,
+        "quantization_requested": QUANTIZE_REQUESTED,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tokens_per_second": round(STATS["generated_tokens"] / seconds, 2) if seconds else 0.0
+    }
+
+class StopOnEvent(StoppingCriteria):
+    """Event set edilince üretimi durdur (istemci koptu ya da akış zaman aşımına uğradı)"""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool)
+
+
+def ndjson(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+@app.post("/chat/stream")
+def chat_stream(req: ChatRequest):
+    # Üretim ayrı thread'de sürer; streamer decode edilen metni parça parça verir (NDJSON)
+    inputs = tokenizer(build_prompt(req.message), return_tensors="pt").to("cpu")
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT)
+    cancelled = Event()
+    errors = []
+
+    def generate():
+        try:
+            model.generate(
+                **inputs,
+                max_new_tokens=200,
+                temperature=0.7,
+                top_p=0.9,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnEvent(cancelled), StopOnSpeaker()])
+            )
+        except Exception as e:
+            # Hata okuyan tarafa iletilir; streamer kapatılmazsa akış asılı kalır
+            errors.append(e)
+            streamer.end()
+
+    Thread(target=generate, daemon=True).start()
+
+    def events():
+        speaker = StopSequenceFilter(SPEAKER_MARKERS)
+        try:
+            for text in streamer:
+                text = speaker.feed(text)
+                if text:
+                    yield ndjson({"text": text})
+                if speaker.stopped:
+                    break
+            tail = speaker.flush()
+            if tail:
+                yield ndjson({"text": tail})
+        except Empty:
+            yield ndjson({"error": f"Model {STREAM_TIMEOUT:g} sn içinde cevap üretmedi"})
+            return
+        finally:
+            # Normal bitişte etkisiz; zaman aşımı ya da istemci kopmasında üretimi durdurur
+            cancelled.set()
 
-    reply = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    # Prompt'un başını kesip sadece cevabı alalım
-    if "Wizard:" in reply:
-        reply = reply.split("Wizard:")[-1].strip()
+        if errors:
+            yield ndjson({"error": str(errors[0])})
+            return
+        yield ndjson({"done": True})
 
-    return {"reply": reply}
+    return StreamingResponse(events(), media_type="application/x-ndjson")
@@ -0,0 +1,151 @@
+# backend/chat_cache.py
+# Bilge Logvian - Tekrarlanan sorular için cevap önbelleği
+# İki katman: normalize edilmiş mesaj + prompt'a giren geçmiş penceresinin hash'i ile birebir LRU,
+# ve isteğe bağlı olarak karakter n-gram benzerliğine dayalı "semantik" katman.
+
+import hashlib
+import json
+import math
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+SparseVector = Dict[str, float]
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(message: str) -> str:
+    """Büyük/küçük harf, noktalama ve boşluk farklarını yok say"""
+    text = unicodedata.normalize("NFKC", message).casefold()
+    # casefold "İ" harfini "i̇" (i + birleşik nokta) yapar; noktayı at
+    text = text.replace("\u0307", "")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def hash_window(window: List[Tuple[str, str]]) -> str:
+    """(rol, mesaj) çiftlerinden oluşan geçmiş penceresinin özetini çıkar.
+
+    Pencere prompt'a olduğu gibi girdiği için metinler normalize edilmeden hash'lenir.
+    """
+    if not window:
+        return ""
+    raw = json.dumps([[role, msg] for role, msg in window], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def char_ngram_embedding(text: str, n: int = 3) -> SparseVector:
+    """Bağımlılıksız, seyrek karakter n-gram vektörü (L2 normalize)"""
+    padded = f" {text} "
+    grams = Counter(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    norm = math.sqrt(sum(c * c for c in grams.values())) or 1.0
+    return {g: c / norm for g, c in grams.items()}
+
+
+def cosine(a: SparseVector, b: SparseVector) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class ResponseCache:
+    """TTL ve boyut sınırlı cevap önbelleği.
+
+    Anahtar, normalize edilmiş mesaj ile LLM'e gönderilen geçmiş penceresinin
+    tamamının hash'idir; pencere farklıysa prompt da farklıdır ve önbellek
+    kullanılmaz. Eşleşmeler sohbetin başında ya da aynı yoldan gelen konuşmalarda olur.
+
+    Semantik katman yalnızca ``semantic_threshold`` verildiğinde ve geçmiş penceresi
+    boşken kullanılır; sohbet bağlamı varken mesaj benzerliği tek başına aynı cevabı
+    garanti etmez.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 3600.0,
+        semantic_threshold: Optional[float] = None,
+        embed: Callable[[str], SparseVector] = char_ngram_embedding
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.embed = embed
+        # key -> (cevap, son geçerlilik zamanı, gömme vektörü)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float, Optional[SparseVector]]]" = OrderedDict()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, message: str, window: List[Tuple[str, str]]) -> Optional[str]:
+        if self.max_size <= 0:
+            return None
+
+        now = time.time()
+        normalized = normalize_message(message)
+        key = (normalized, hash_window(window))
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return entry[0]
+            del self._entries[key]
+
+        if self.semantic_threshold is not None and not window:
+            hit = self._semantic_lookup(normalized, now)
+            if hit is not None:
+                self.stats["semantic_hits"] += 1
+                return hit
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, message: str, window: List[Tuple[str, str]], response: str) -> None:
+        if self.max_size <= 0:
+            return
+
+        normalized = normalize_message(message)
+        key = (normalized, hash_window(window))
+        vector = self.embed(normalized) if self.semantic_threshold is not None and not window else None
+
+        self._entries[key] = (response, time.time() + self.ttl, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _semantic_lookup(self, normalized: str, now: float) -> Optional[str]:
+        query = self.embed(normalized)
+        best_key, best_score = None, self.semantic_threshold
+        expired = []
+
+        for key, (response, expires_at, vector) in self._entries.items():
+            if vector is None:
+                continue
+            if expires_at <= now:
+                expired.append(key)
+                continue
+            score = cosine(query, vector)
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        for key in expired:
+            del self._entries[key]
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][0]
+
+    def snapshot(self) -> Dict[str, float]:
+        lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+        hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,83 @@
+# backend/chat_history.py
+# Bilge Logvian - Kullanıcı başına sabit boyutlu sohbet geçmişi
+# Geçmiş bir halka tampon (deque) içinde tutulur; taşan eski turlar isteğe bağlı
+# olarak diske (JSONL) arşivlenir, böylece kullanıcı başına bellek sabit kalır.
+
+import json
+import os
+import time
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Tuple
+
+USER = "user"
+ASSISTANT = "assistant"
+
+
+def estimate_tokens(text: str) -> int:
+    """Kaba token tahmini (~4 karakter/token) + mesaj başına rol yükü"""
+    return (len(text) + 3) // 4 + 4
+
+
+class ChatTurn:
+    """Tek bir sohbet turu; dict yerine __slots__ ile küçük tutulur"""
+    __slots__ = ("role", "msg", "time", "tokens")
+
+    def __init__(self, role: str, msg: str, ts: Optional[float] = None):
+        self.role = role
+        self.msg = msg
+        self.time = ts if ts is not None else time.time()
+        self.tokens = estimate_tokens(msg)
+
+    def to_dict(self):
+        return {"from": "user" if self.role == USER else "bot", "msg": self.msg, "time": self.time}
+
+
+class ChatHistory:
+    """En fazla ``max_turns`` tur tutan halka tampon"""
+    __slots__ = ("_turns", "archive_path")
+
+    def __init__(self, max_turns: int = 50, archive_path: Optional[str] = None):
+        self._turns: Deque[ChatTurn] = deque(maxlen=max_turns)
+        self.archive_path = archive_path
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def __iter__(self) -> Iterator[ChatTurn]:
+        return iter(self._turns)
+
+    def append(self, role: str, msg: str, ts: Optional[float] = None) -> ChatTurn:
+        if len(self._turns) == self._turns.maxlen and self.archive_path:
+            self._archive(self._turns[0])
+        turn = ChatTurn(role, msg, ts)
+        self._turns.append(turn)
+        return turn
+
+    def window(self, token_budget: int) -> List[Tuple[str, str]]:
+        """Token bütçesine sığan en yeni turları kronolojik sırayla döndür"""
+        selected: List[Tuple[str, str]] = []
+        used = 0
+        for turn in reversed(self._turns):
+            if used + turn.tokens > token_budget:
+                break
+            used += turn.tokens
+            selected.append((turn.role, turn.msg))
+        selected.reverse()
+        return selected
+
+    @classmethod
+    def from_turns(cls, turns: List[Tuple[str, str, float]], max_turns: int = 50,
+                   archive_path: Optional[str] = None) -> "ChatHistory":
+        """Depodan okunan (rol, mesaj, zaman) satırlarından geçmiş oluştur"""
+        history = cls(max_turns=max_turns, archive_path=archive_path)
+        for role, msg, ts in turns[-max_turns:]:
+            history._turns.append(ChatTurn(role, msg, ts))
+        return history
+
+    def _archive(self, turn: ChatTurn) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.archive_path) or ".", exist_ok=True)
+            with open(self.archive_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(turn.to_dict(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"⚠️ Sohbet arşivine yazılamadı ({self.archive_path}): {e}")
@@ -4,12 +4,24 @@ import os
 import time
 import json
 import random
-from typing import Optional, Dict, Any, List
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import asyncio
+import uuid
+import hashlib
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Tuple, Awaitable, AsyncIterator, TypeVar
+import httpx
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from groq import Groq
+from groq import AsyncGroq
+from chat_cache import ResponseCache
+from chat_history import ChatHistory, USER, ASSISTANT
+from progress_store import InsufficientBalance, SimulationRecord, create_progress_store
+from answer_matching import compile_matchers
+from tasks_data import modules as TASK_MODULES
 
 # --- Ortam değişkenlerini yükle ---
 load_dotenv()
@@ -17,18 +29,50 @@ load_dotenv()
 # --- Groq API Configuration ---
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "llama-3.3-70b-versatile")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", str(LLM_MAX_CONCURRENCY)))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
 
 if not GROQ_API_KEY:
     raise RuntimeError("GROQ_API_KEY bulunamadı. Lütfen .env dosyasında ayarla.")
 
-# Groq client'ını başlat
+# Groq client'ını başlat (async; tek bir havuzlanmış HTTP bağlantı havuzu paylaşılır)
 try:
-    client = Groq(api_key=GROQ_API_KEY)
+    client = AsyncGroq(
+        api_key=GROQ_API_KEY,
+        timeout=LLM_TIMEOUT,
+        http_client=httpx.AsyncClient(
+            timeout=LLM_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS
+            )
+        )
+    )
     print("✅ Groq client başarıyla başlatıldı")
 except Exception as e:
     print(f"⚠️ Groq client başlatılamadı: {e}")
     client = None
 
+# Aynı anda Groq'a giden istek sayısını sınırla; fazlası event loop'u bloklamadan sırada bekler
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+T = TypeVar("T")
+
+# --- Cevap Önbelleği ---
+CHAT_CACHE_SEMANTIC_THRESHOLD = os.getenv("CHAT_CACHE_SEMANTIC_THRESHOLD")
+RESPONSE_CACHE = ResponseCache(
+    max_size=int(os.getenv("CHAT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "3600")),
+    semantic_threshold=float(CHAT_CACHE_SEMANTIC_THRESHOLD) if CHAT_CACHE_SEMANTIC_THRESHOLD else None
+)
+
+# --- Sohbet Geçmişi ---
+CHAT_HISTORY_MAX_TURNS = int(os.getenv("CHAT_HISTORY_MAX_TURNS", "50"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "1500"))
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR")
+
 # --- FastAPI setup ---
 app = FastAPI(
     title="Bilge Logvian — Siber Güvenlik Akademisi",
@@ -45,6 +89,14 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    if client:
+        await client.close()
+    # Bekleyen yazmaların flush'ı event loop'u bloklamasın
+    await run_in_threadpool(PROGRESS_STORE.close)
+
+
 # --- Data Models ---
 class ChatRequest(BaseModel):
     user_id: Optional[str] = "anon"
@@ -75,8 +127,15 @@ class AnswerRequest(BaseModel):
 LAB_SIMULATIONS = {
     "sql_injection": {
         "friendly_name": "SQL Enjeksiyon Simülasyonu",
+        "task_title": "SQL Injection",
+        "task_description": "SQL enjeksiyon saldırılarını öğren",
+        "module": "sql_injection",
+        "skill": "SQL Injection",
+        "reward": {"xp": 25, "coins": 15},
+        "unlock_xp": 0,
         "description": "SQL enjeksiyon saldırılarını öğren ve pratik yap",
         "url": "http://localhost:8081",
+        "answer_kind": "sql",
         "challenges": [
             {
                 "id": 1,
@@ -84,42 +143,62 @@ LAB_SIMULATIONS = {
                 "description": "' OR '1'='1 payload'unu kullanarak giriş yap",
                 "target": "admin",
                 "hint": "Kullanıcı adı kısmına ' OR '1'='1 yazmayı dene",
-                "solution": "admin' OR '1'='1' --"
+                "solution": "admin' OR '1'='1' --",
+                "alternatives": ["' OR '1'='1' --", "admin' --"]
             },
             {
                 "id": 2,
                 "title": "Union Based SQL Injection",
                 "description": "UNION SELECT kullanarak veritabanından veri çek",
                 "hint": "UNION SELECT 1,2,3 -- kullan",
-                "solution": "' UNION SELECT 1,username,password FROM users --"
+                "solution": "' UNION SELECT 1,username,password FROM users --",
+                "patterns": [
+                    r"' union (all )?select ([^,\s]+,)*(username,password|password,username)(,[^,\s]+)* from users --"
+                ]
             }
         ]
     },
     "xss": {
         "friendly_name": "XSS Simülasyonu",
+        "task_title": "XSS - Stored",
+        "task_description": "XSS payload'larını deneyimle",
+        "module": "xss_stored",
+        "skill": "XSS",
+        "reward": {"xp": 30, "coins": 20},
+        "unlock_xp": 25,
         "description": "XSS payload'larını deneyimle ve korunma yöntemlerini öğren",
         "url": "http://localhost:8082",
+        "answer_kind": "xss",
         "challenges": [
             {
                 "id": 1,
                 "title": "Temel XSS",
                 "description": "<script>alert('XSS')</script> payload'unu çalıştır",
                 "hint": "Yorum kısmına script tag'i ekle",
-                "solution": "<script>alert('XSS')</script>"
+                "solution": "<script>alert('XSS')</script>",
+                "patterns": [r"<script>alert\([^<]*\)</script>"]
             },
             {
                 "id": 2,
                 "title": "Stored XSS",
                 "description": "XSS payload'unu kalıcı hale getir",
                 "hint": "Profil bilgilerine XSS ekle",
-                "solution": "<img src=x onerror=alert('XSS')>"
+                "solution": "<img src=x onerror=alert('XSS')>",
+                "patterns": [r"<img src=[^ >]* onerror=alert\([^<]*\)/?>", r"<svg onload=alert\([^<]*\)/?>"]
             }
         ]
     },
     "hash_cracking": {
         "friendly_name": "Hash Kırma Simülasyonu",
+        "task_title": "Hash Cracking",
+        "task_description": "Hash fonksiyonlarını çözümle",
+        "module": "hash_cracking",
+        "skill": "Hash Cracking",
+        "reward": {"xp": 35, "coins": 25},
+        "unlock_xp": 50,
         "description": "Hash fonksiyonlarını çözümle ve kırma tekniklerini öğren",
         "url": "http://localhost:8083",
+        "answer_kind": "text",
         "challenges": [
             {
                 "id": 1,
@@ -139,52 +218,183 @@ LAB_SIMULATIONS = {
     }
 }
 
+# (lab_name, challenge index) → derlenmiş cevap eşleştiricisi; uygulama açılırken bir kez kurulur
+ANSWER_MATCHERS = compile_matchers(LAB_SIMULATIONS)
+
+# --- Görev Kataloğu ---
+# /api/tasks cevabının kullanıcıdan bağımsız kısmı bir kez üretilir ve değişmez.
+# Kullanıcıya özel alanlar (completed/locked) tamamlanan modüllerin bit maskesinden
+# hesaplanır; katalog sürümü + maskeler ETag olarak kullanılır.
+class TaskCatalog:
+    __slots__ = ("tasks", "unlock_xp", "bits", "version")
+
+    def __init__(self, labs: Dict[str, Dict[str, Any]], modules: Dict[str, Dict[str, Any]]):
+        tasks = []
+        for lab_name, lab in labs.items():
+            module = modules.get(lab["module"], {})
+            tasks.append(MappingProxyType({
+                "id": lab_name,
+                "title": lab["task_title"],
+                "description": lab["task_description"],
+                "reward": MappingProxyType(dict(lab["reward"])),
+                "difficulty": module.get("difficulty"),
+                "estimated_minutes": module.get("estimated_minutes"),
+                "type": "simulation"
+            }))
+        self.tasks = tuple(tasks)
+        self.unlock_xp = tuple(lab["unlock_xp"] for lab in labs.values())
+        self.bits = {lab_name: 1 << i for i, lab_name in enumerate(labs)}
+
+        raw = json.dumps(
+            [{**t, "reward": dict(t["reward"])} for t in self.tasks] + [list(self.unlock_xp)],
+            sort_keys=True, ensure_ascii=False
+        )
+        self.version = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def completed_mask(self, completed_modules: List[str]) -> int:
+        mask = 0
+        for name in completed_modules:
+            mask |= self.bits.get(name, 0)
+        return mask
+
+    def locked_mask(self, xp: int) -> int:
+        mask = 0
+        for i, threshold in enumerate(self.unlock_xp):
+            if xp < threshold:
+                mask |= 1 << i
+        return mask
+
+    def render(self, completed: int, locked: int) -> List[Dict[str, Any]]:
+        return [
+            {**task, "reward": dict(task["reward"]), "completed": bool(completed >> i & 1), "locked": bool(locked >> i & 1)}
+            for i, task in enumerate(self.tasks)
+        ]
+
+
+TASK_CATALOG = TaskCatalog(LAB_SIMULATIONS, TASK_MODULES)
+
 # --- Simülasyon Durumları ---
-SIMULATION_STATES = {
-    "sql_injection": {
-        "current_challenge": 0,
-        "completed": False,
-        "user_inputs": []
-    },
-    "xss": {
-        "current_challenge": 0,
-        "completed": False,
-        "user_inputs": []
-    },
-    "hash_cracking": {
-        "current_challenge": 0,
-        "completed": False,
-        "user_inputs": []
-    }
-}
+# Şablon LAB_SIMULATIONS'tır; kullanıcı başına yalnızca şablondan farkı (hangi
+# challenge'da olduğu, bitirip bitirmediği, son denemeleri) tutulur. Her lab durumu
+# depoda (user_id, lab_name) anahtarlı ayrı bir satırdır; kayıt, kullanıcı bir lab'a
+# ilk kez cevap gönderdiğinde ya da lab'ı başlattığında yazılır.
+SIMULATION_INPUT_HISTORY = 20
+# Aynı lab'a eşzamanlı gönderimlerde compare-and-set en fazla bu kadar yeniden denenir
+SIMULATION_SAVE_RETRIES = 5
+
+
+class SimulationState:
+    __slots__ = ("current_challenge", "completed", "user_inputs", "version")
+
+    def __init__(self, current_challenge: int = 0, completed: bool = False, user_inputs: Optional[list] = None,
+                 version: int = 0):
+        self.current_challenge = current_challenge
+        self.completed = completed
+        # (challenge index, cevap, doğru mu) demetleri; en yeni SIMULATION_INPUT_HISTORY adet
+        self.user_inputs: List[Tuple[int, str, bool]] = user_inputs or []
+        # Depodaki satırın sürümü; 0 → henüz yazılmamış
+        self.version = version
+
+    def record_input(self, challenge: int, answer: str, correct: bool) -> None:
+        self.user_inputs.append((challenge, answer, correct))
+        if len(self.user_inputs) > SIMULATION_INPUT_HISTORY:
+            del self.user_inputs[:-SIMULATION_INPUT_HISTORY]
+
+    @classmethod
+    def from_record(cls, record: SimulationRecord) -> "SimulationState":
+        return cls(
+            record.current_challenge, record.completed,
+            [tuple(item) for item in record.user_inputs], record.version
+        )
+
 
 # --- Veri Depolama ---
-USER_PROGRESS: Dict[str, Dict[str, Any]] = {}
-ACTIVE_LABS: Dict[str, Dict[str, Any]] = {}
+PROGRESS_STORE_URL = os.getenv("PROGRESS_STORE_URL", "sqlite:///logvian_progress.db")
+PROGRESS_WRITE_BEHIND = os.getenv("PROGRESS_WRITE_BEHIND", "0") == "1"
+STARTING_COINS = 100
+HINT_COST = 10
+
+
+DEFAULT_SKILLS = {
+    "SQL Injection": 0,
+    "XSS": 0,
+    "Hash Cracking": 0,
+    "Cryptography": 0
+}
+
+
+PROGRESS_STORE = create_progress_store(PROGRESS_STORE_URL, write_behind=PROGRESS_WRITE_BEHIND)
 
 
 # --- Yardımcı Fonksiyonlar ---
 def ensure_user(user_id: str) -> Dict[str, Any]:
-    if user_id not in USER_PROGRESS:
-        USER_PROGRESS[user_id] = {
-            "xp": 0,
-            "coins": 100,
+    """Kullanıcı profilini ve bakiyesini getir; ilk erişimde oluştur.
+
+    Sohbet geçmişi, lab durumları, tamamlanan modüller ve yetenekler profilde
+    değildir; gereken endpoint bunları depodan ayrıca okur.
+    """
+    user = PROGRESS_STORE.load(user_id)
+    if user is None:
+        user = {
+            "user_id": user_id,
             "level": 1,
-            "completed_modules": [],
-            "chat_history": [],
             "current_quest": None,
             "inventory": ["Başlangıç Tılsımı"],
-            "skills": {
-                "SQL Injection": 0,
-                "XSS": 0,
-                "Hash Cracking": 0,
-                "Cryptography": 0
-            },
-            "active_labs": {},
-            "simulation_states": SIMULATION_STATES.copy(),
             "created_at": time.time()
         }
-    return USER_PROGRESS[user_id]
+        PROGRESS_STORE.save(user_id, user)
+        PROGRESS_STORE.apply_ledger(user_id, 0, STARTING_COINS, "signup", "signup")
+
+    user["xp"], user["coins"] = PROGRESS_STORE.get_balance(user_id)
+    return user
+
+
+def chat_archive_path(user_id: str) -> Optional[str]:
+    return os.path.join(CHAT_ARCHIVE_DIR, f"{user_id}.jsonl") if CHAT_ARCHIVE_DIR else None
+
+
+def load_chat_history(user_id: str) -> ChatHistory:
+    """Depodaki en yeni CHAT_HISTORY_MAX_TURNS turdan geçmiş oluştur"""
+    return ChatHistory.from_turns(
+        PROGRESS_STORE.get_chat_turns(user_id, CHAT_HISTORY_MAX_TURNS),
+        max_turns=CHAT_HISTORY_MAX_TURNS,
+        archive_path=chat_archive_path(user_id)
+    )
+
+
+def load_chat_window(user_id: str) -> List[Tuple[str, str]]:
+    """Kullanıcıyı oluştur ve prompt'a girecek geçmiş penceresini getir (senkron; thread havuzunda çağrılır)"""
+    ensure_user(user_id)
+    return load_chat_history(user_id).window(CHAT_CONTEXT_TOKEN_BUDGET)
+
+
+def append_chat_turns(user_id: str, *turns: Tuple[str, str]) -> None:
+    """Yeni turları ekle; yalnızca bu satırlar yazılır, taşan eski turlar silinir"""
+    now = time.time()
+    rows = [(role, msg, now) for role, msg in turns]
+    if CHAT_ARCHIVE_DIR:
+        # Taşan turların arşive yazılması için mevcut halka tampon üzerinden ekle
+        history = load_chat_history(user_id)
+        for role, msg, ts in rows:
+            history.append(role, msg, ts)
+    PROGRESS_STORE.append_chat_turns(user_id, rows, keep_last=CHAT_HISTORY_MAX_TURNS)
+
+
+def load_simulation_state(user_id: str, lab_name: str) -> SimulationState:
+    """Kullanıcının lab durumunu getir; kayıt yoksa boş durum döner (yazılmaz)"""
+    record = PROGRESS_STORE.get_simulation_state(user_id, lab_name)
+    return SimulationState.from_record(record) if record else SimulationState()
+
+
+def save_simulation_state(user_id: str, lab_name: str, state: SimulationState, check_version: bool = True) -> bool:
+    """Lab durumunu yaz; ``check_version`` ile arada değişmişse yazmadan False döner"""
+    saved = PROGRESS_STORE.save_simulation_state(
+        user_id, lab_name, state.current_challenge, state.completed, state.user_inputs,
+        expected_version=state.version if check_version else None
+    )
+    if saved:
+        state.version += 1
+    return saved
 
 
 # --- Lab Simülasyon Fonksiyonları ---
@@ -209,19 +419,11 @@ def start_lab_simulation(user_id: str, lab_name: str) -> Dict[str, Any]:
     }
 
     # Kullanıcı verilerine kaydet
-    user_data = ensure_user(user_id)
-    if "active_labs" not in user_data:
-        user_data["active_labs"] = {}
-    user_data["active_labs"][lab_name] = lab_info
-
-    if user_id not in ACTIVE_LABS:
-        ACTIVE_LABS[user_id] = {}
-    ACTIVE_LABS[user_id][lab_name] = lab_info
+    ensure_user(user_id)
+    PROGRESS_STORE.set_active_lab(user_id, lab_name, lab_info)
 
     # Simülasyon durumunu sıfırla
-    user_data["simulation_states"][lab_name]["current_challenge"] = 0
-    user_data["simulation_states"][lab_name]["completed"] = False
-    user_data["simulation_states"][lab_name]["user_inputs"] = []
+    save_simulation_state(user_id, lab_name, SimulationState(), check_version=False)
 
     print(f"✅ Lab simülasyonu başlatıldı: {lab_name} for {user_id}")
     return lab_info
@@ -229,28 +431,57 @@ def start_lab_simulation(user_id: str, lab_name: str) -> Dict[str, Any]:
 
 def check_simulation_answer(lab_name: str, challenge_id: int, user_answer: str) -> bool:
     """Simülasyon cevabını kontrol et"""
-    if lab_name not in LAB_SIMULATIONS:
-        return False
-
-    challenges = LAB_SIMULATIONS[lab_name]["challenges"]
-    if challenge_id < 0 or challenge_id >= len(challenges):
-        return False
-
-    challenge = challenges[challenge_id]
-    return user_answer.strip().lower() == challenge["solution"].lower()
+    matcher = ANSWER_MATCHERS.get((lab_name, challenge_id))
+    return matcher is not None and matcher.matches(user_answer)
 
 
 def get_current_challenge(user_id: str, lab_name: str) -> Dict[str, Any]:
     """Mevcut challenge'ı getir"""
-    user_data = ensure_user(user_id)
-    state = user_data["simulation_states"][lab_name]
+    ensure_user(user_id)
+    return current_challenge_for(PROGRESS_STORE.get_simulation_state(user_id, lab_name), lab_name)
+
+
+def current_challenge_for(state: Optional[SimulationRecord], lab_name: str) -> Optional[Dict[str, Any]]:
+    """Okunmuş lab durumundan mevcut challenge'ı getir"""
+    current = state.current_challenge if state else 0
     challenges = LAB_SIMULATIONS[lab_name]["challenges"]
 
-    if state["current_challenge"] < len(challenges):
-        return challenges[state["current_challenge"]]
+    if current < len(challenges):
+        return challenges[current]
     return None
 
 
+def challenge_payload(lab_name: str, challenge: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Challenge'ın istemciye gösterilecek kısmı (çözüm ve ipucu hariç)"""
+    if not challenge:
+        return {"completed": True, "message": "Tüm challenge'lar tamamlandı!"}
+
+    return {
+        "challenge": {
+            "id": challenge["id"],
+            "title": challenge["title"],
+            "description": challenge["description"],
+            "hint_available": True
+        },
+        "progress": {
+            "current": challenge["id"],
+            "total": len(LAB_SIMULATIONS[lab_name]["challenges"])
+        }
+    }
+
+
+def build_progress(user: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = user["user_id"]
+    return {
+        "level": user["level"],
+        "total_xp": user["xp"],
+        "total_coins": user["coins"],
+        "next_level_xp": user["level"] * 100,
+        "completed_tasks": PROGRESS_STORE.get_completed_modules(user_id),
+        "skills": {**DEFAULT_SKILLS, **PROGRESS_STORE.get_skills(user_id)}
+    }
+
+
 # --- Mistik Öğretici Prompt ---
 MISTIC_SYSTEM_PROMPT = """
 Sen "Bilge Logvian"sın. Mistik, bilge ve gizemli bir siber güvenlik üstadısın. Karanlık ağların sırlarını bilen, kod büyüsünün ustası bir mentorsun.
@@ -270,45 +501,139 @@ Sen "Bilge Logvian"sın. Mistik, bilge ve gizemli bir siber güvenlik üstadıs
 """
 
 
-def ask_bilge_logvian(user_message: str, chat_history: list = None) -> str:
-    """Bilge Logvian'a soru sor"""
+async def run_until_disconnect(request: Request, awaitable: Awaitable[T]) -> T:
+    """İstemci bağlantıyı koparırsa devam eden işi iptal et"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise HTTPException(status_code=499, detail="İstemci bağlantıyı kapattı")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def build_chat_messages(user_message: str, window: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+    """Sistem prompt'u, son sohbet geçmişi ve yeni mesajdan Groq mesaj listesini oluştur"""
+    messages = [{"role": "system", "content": MISTIC_SYSTEM_PROMPT}]
+    messages.extend({"role": role, "content": content} for role, content in window)
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+class LLMError(Exception):
+    """Groq cevabı alınamadı; mesaj kullanıcıya gösterilir ama sohbet geçmişine yazılmaz"""
+
+
+LLM_UNAVAILABLE_MESSAGE = "🔮 Bilge Logvian şu anda derin meditasyonda... (API bağlantı hatası)"
+
+
+def llm_error(e: Exception) -> LLMError:
+    return LLMError(f"🔮 Bilge Logvian derin düşüncelere daldı... (Hata: {str(e)})")
+
+
+async def ask_bilge_logvian(user_message: str, window: List[Tuple[str, str]] = None) -> str:
+    """Bilge Logvian'a soru sor; cevap alınamazsa ``LLMError`` fırlatır"""
     if not client:
-        return "🔮 Bilge Logvian şu anda derin meditasyonda... (API bağlantı hatası)"
+        raise LLMError(LLM_UNAVAILABLE_MESSAGE)
 
-    messages = [{"role": "system", "content": MISTIC_SYSTEM_PROMPT}]
+    window = window or []
+    cached = RESPONSE_CACHE.get(user_message, window)
+    if cached is not None:
+        return cached
 
-    if chat_history:
-        for msg in chat_history[-6:]:
-            if msg["from"] == "user":
-                messages.append({"role": "user", "content": msg["msg"]})
-            else:
-                messages.append({"role": "assistant", "content": msg["msg"]})
+    messages = build_chat_messages(user_message, window)
+
+    try:
+        async with LLM_SEMAPHORE:
+            completion = await client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1024,
+                timeout=LLM_TIMEOUT
+            )
+        response = completion.choices[0].message.content
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        raise llm_error(e) from e
+
+    if not response or not response.strip():
+        raise llm_error(ValueError("boş cevap"))
+
+    RESPONSE_CACHE.put(user_message, window, response)
+    return response
 
-    messages.append({"role": "user", "content": user_message})
+
+async def stream_bilge_logvian(user_message: str, window: List[Tuple[str, str]] = None) -> AsyncIterator[str]:
+    """Bilge Logvian'ın cevabını Groq stream'inden geldikçe parça parça üret.
+
+    Groq hatası (ya da boş cevap) token olarak verilmez; o ana kadar kaç parça
+    üretilmiş olursa olsun ``LLMError`` fırlatılır.
+    """
+    if not client:
+        raise LLMError(LLM_UNAVAILABLE_MESSAGE)
+
+    window = window or []
+    cached = RESPONSE_CACHE.get(user_message, window)
+    if cached is not None:
+        yield cached
+        return
+
+    messages = build_chat_messages(user_message, window)
+    parts: List[str] = []
 
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1024,
-            timeout=30
-        )
-        return completion.choices[0].message.content
+        async with LLM_SEMAPHORE:
+            stream = await client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1024,
+                timeout=LLM_TIMEOUT,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        return f"🔮 Bilge Logvian derin düşüncelere daldı... (Hata: {str(e)})"
+        raise llm_error(e) from e
+
+    response = "".join(parts)
+    if not response.strip():
+        raise llm_error(ValueError("boş cevap"))
+    RESPONSE_CACHE.put(user_message, window, response)
+
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Tek bir server-sent event satırı oluştur"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
 
 
 # --- API ENDPOINT'LERİ ---
 
 @app.get("/")
-async def root():
+def root():
     return {
         "message": "🔮 Bilge Logvian'ın Siber Güvenlik Akademisine Hoş Geldiniz",
         "status": "active",
         "version": "3.0.0 (Simülasyon Modu)",
-        "active_users": len(USER_PROGRESS),
-        "active_labs": sum(len(labs) for labs in ACTIVE_LABS.values())
+        "active_users": PROGRESS_STORE.user_count(),
+        "active_labs": PROGRESS_STORE.active_lab_count()
     }
 
 
@@ -318,6 +643,7 @@ async def health():
         "status": "healthy",
         "timestamp": time.time(),
         "groq_connected": client is not None,
+        "response_cache": RESPONSE_CACHE.snapshot(),
         "simulation_mode": True
     }
 
@@ -325,7 +651,7 @@ async def health():
 # --- Lab Simülasyon Endpoint'leri ---
 
 @app.post("/api/lab/start")
-async def start_lab(req: LabStartRequest):
+def start_lab(req: LabStartRequest):
     """Yeni bir lab simülasyonu başlat"""
     lab_info = start_lab_simulation(req.user_id, req.lab_name)
     return {
@@ -337,15 +663,10 @@ async def start_lab(req: LabStartRequest):
 
 
 @app.post("/api/lab/stop")
-async def stop_lab(req: LabStopRequest):
+def stop_lab(req: LabStopRequest):
     """Aktif bir lab simülasyonu durdur"""
-    user_data = ensure_user(req.user_id)
-
-    if req.user_id in ACTIVE_LABS and req.lab_name in ACTIVE_LABS[req.user_id]:
-        del ACTIVE_LABS[req.user_id][req.lab_name]
-
-    if req.lab_name in user_data.get("active_labs", {}):
-        del user_data["active_labs"][req.lab_name]
+    ensure_user(req.user_id)
+    PROGRESS_STORE.remove_active_lab(req.user_id, req.lab_name)
 
     return {
         "success": True,
@@ -354,11 +675,11 @@ async def stop_lab(req: LabStopRequest):
 
 
 @app.get("/api/lab/active/{user_id}")
-async def get_active_labs(user_id: str):
+def get_active_labs(user_id: str):
     """Kullanıcının aktif lablarını listele"""
-    user_data = ensure_user(user_id)
+    ensure_user(user_id)
     return {
-        "active_labs": user_data.get("active_labs", {}),
+        "active_labs": PROGRESS_STORE.get_active_labs(user_id),
         "available_labs": LAB_SIMULATIONS
     }
 
@@ -366,132 +687,114 @@ async def get_active_labs(user_id: str):
 # --- Simülasyon Challenge Endpoint'leri ---
 
 @app.get("/api/simulation/{lab_name}/challenge")
-async def get_current_challenge_endpoint(user_id: str, lab_name: str):
+def get_current_challenge_endpoint(user_id: str, lab_name: str):
     """Mevcut challenge'ı getir"""
     if lab_name not in LAB_SIMULATIONS:
         raise HTTPException(status_code=404, detail="Lab bulunamadı")
 
-    challenge = get_current_challenge(user_id, lab_name)
-    if not challenge:
-        return {"completed": True, "message": "Tüm challenge'lar tamamlandı!"}
-
-    return {
-        "challenge": {
-            "id": challenge["id"],
-            "title": challenge["title"],
-            "description": challenge["description"],
-            "hint_available": True
-        },
-        "progress": {
-            "current": challenge["id"],
-            "total": len(LAB_SIMULATIONS[lab_name]["challenges"])
-        }
-    }
+    return challenge_payload(lab_name, get_current_challenge(user_id, lab_name))
 
 
 @app.post("/api/simulation/{lab_name}/submit")
-async def submit_simulation_answer(user_id: str, lab_name: str, answer: str):
+def submit_simulation_answer(user_id: str, lab_name: str, answer: str):
     """Simülasyon cevabını gönder"""
     if lab_name not in LAB_SIMULATIONS:
         raise HTTPException(status_code=404, detail="Lab bulunamadı")
 
     user_data = ensure_user(user_id)
-    state = user_data["simulation_states"][lab_name]
+    challenge_count = len(LAB_SIMULATIONS[lab_name]["challenges"])
 
-    if state["completed"]:
-        return {"correct": True, "completed": True, "message": "Bu lab zaten tamamlandı!"}
+    # Durum satırı compare-and-set ile yazılır; aynı lab'a eşzamanlı bir gönderim
+    # araya girerse güncel durum okunup cevap yeniden değerlendirilir
+    for _ in range(SIMULATION_SAVE_RETRIES):
+        state = load_simulation_state(user_id, lab_name)
 
-    current_challenge = state["current_challenge"]
-    is_correct = check_simulation_answer(lab_name, current_challenge, answer)
+        if state.completed:
+            return {"correct": True, "completed": True, "message": "Bu lab zaten tamamlandı!"}
 
-    if is_correct:
-        state["current_challenge"] += 1
-        state["user_inputs"].append({"challenge": current_challenge, "answer": answer, "correct": True})
+        current_challenge = state.current_challenge
+        is_correct = check_simulation_answer(lab_name, current_challenge, answer)
 
-        # Son challenge mı kontrol et
-        if state["current_challenge"] >= len(LAB_SIMULATIONS[lab_name]["challenges"]):
-            state["completed"] = True
+        state.record_input(current_challenge, answer, is_correct)
+        if is_correct:
+            state.current_challenge += 1
+            # Son challenge mı kontrol et
+            state.completed = state.current_challenge >= challenge_count
 
-            # Ödül ver
-            rewards = {
-                "sql_injection": {"xp": 25, "coins": 15},
-                "xss": {"xp": 30, "coins": 20},
-                "hash_cracking": {"xp": 35, "coins": 25}
-            }
-
-            reward = rewards.get(lab_name, {"xp": 0, "coins": 0})
-            user_data["xp"] += reward["xp"]
-            user_data["coins"] += reward["coins"]
-            user_data["completed_modules"].append(lab_name)
-
-            # Skill geliştir
-            skill_name = lab_name.replace("_", " ").title()
-            user_data["skills"][skill_name] += 1
-
-            return {
-                "correct": True,
-                "completed": True,
-                "message": f"🎉 Tebrikler! {LAB_SIMULATIONS[lab_name]['friendly_name']} tamamlandı!",
-                "rewards": reward,
-                "level_up": user_data["xp"] >= user_data["level"] * 100
-            }
-        else:
-            return {
-                "correct": True,
-                "completed": False,
-                "message": "Doğru cevap! Sonraki challenge'a geçiliyor...",
-                "next_challenge": state["current_challenge"] + 1
-            }
+        if save_simulation_state(user_id, lab_name, state):
+            break
     else:
-        state["user_inputs"].append({"challenge": current_challenge, "answer": answer, "correct": False})
+        raise HTTPException(status_code=409, detail="Lab durumu eşzamanlı olarak değişti, tekrar deneyin")
+
+    if not is_correct:
         return {
             "correct": False,
             "message": "Cevap yanlış. Tekrar deneyin veya ipucu alın."
         }
 
+    if not state.completed:
+        return {
+            "correct": True,
+            "completed": False,
+            "message": "Doğru cevap! Sonraki challenge'a geçiliyor...",
+            "next_challenge": state.current_challenge + 1
+        }
+
+    # Ödül ver
+    reward = LAB_SIMULATIONS[lab_name]["reward"]
+    # Ödül lab başına tek seferlik; eşzamanlı iki gönderim ya da yeniden başlatılıp
+    # tekrar tamamlanan lab çifte ödül alamaz
+    result = PROGRESS_STORE.apply_ledger(
+        user_id, reward["xp"], reward["coins"], f"lab_complete:{lab_name}", "lab_complete"
+    )
+    user_data["xp"], user_data["coins"] = result.balance
+
+    # Modül ilk kez tamamlandıysa skill geliştir
+    if PROGRESS_STORE.add_completed_module(user_id, lab_name):
+        PROGRESS_STORE.increment_skill(user_id, LAB_SIMULATIONS[lab_name]["skill"])
+
+    friendly_name = LAB_SIMULATIONS[lab_name]["friendly_name"]
+    if not result.applied:
+        return {
+            "correct": True,
+            "completed": True,
+            "message": f"✅ {friendly_name} yeniden tamamlandı! Bu lab'ın ödülü daha önce verilmişti.",
+            "rewards": {"xp": 0, "coins": 0},
+            "already_rewarded": True,
+            "level_up": False
+        }
+
+    return {
+        "correct": True,
+        "completed": True,
+        "message": f"🎉 Tebrikler! {friendly_name} tamamlandı!",
+        "rewards": reward,
+        "already_rewarded": False,
+        "level_up": user_data["xp"] >= user_data["level"] * 100
+    }
+
 
 # --- Frontend için uyumlu endpoint'ler ---
 
 @app.get("/api/tasks")
-async def get_tasks(user_id: str):
+def get_tasks(user_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
     """Mevcut görevleri getir"""
     user = ensure_user(user_id)
 
-    tasks = [
-        {
-            "id": "sql_injection",
-            "title": "SQL Injection",
-            "description": "SQL enjeksiyon saldırılarını öğren",
-            "reward": {"xp": 25, "coins": 15},
-            "completed": "sql_injection" in user["completed_modules"],
-            "locked": False,
-            "type": "simulation"
-        },
-        {
-            "id": "xss",
-            "title": "XSS - Stored",
-            "description": "XSS payload'larını deneyimle",
-            "reward": {"xp": 30, "coins": 20},
-            "completed": "xss" in user["completed_modules"],
-            "locked": user["xp"] < 25,
-            "type": "simulation"
-        },
-        {
-            "id": "hash_cracking",
-            "title": "Hash Cracking",
-            "description": "Hash fonksiyonlarını çözümle",
-            "reward": {"xp": 35, "coins": 25},
-            "completed": "hash_cracking" in user["completed_modules"],
-            "locked": user["xp"] < 50,
-            "type": "simulation"
-        }
-    ]
+    completed = TASK_CATALOG.completed_mask(PROGRESS_STORE.get_completed_modules(user_id))
+    locked = TASK_CATALOG.locked_mask(user["xp"])
+    etag = f'"{TASK_CATALOG.version}-{completed:x}-{locked:x}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
 
-    return {"tasks": tasks}
+    response.headers.update(headers)
+    return {"tasks": TASK_CATALOG.render(completed, locked)}
 
 
 @app.post("/api/lab/{task_id}/start")
-async def start_lab_by_task(task_id: str, user_id: str):
+def start_lab_by_task(task_id: str, user_id: str):
     """Görev ID'sine göre lab başlat"""
     if task_id not in LAB_SIMULATIONS:
         raise HTTPException(status_code=404, detail="Görev bulunamadı")
@@ -506,15 +809,17 @@ async def start_lab_by_task(task_id: str, user_id: str):
 
 
 @app.post("/api/hint")
-async def get_hint(req: HintRequest):
+def get_hint(req: HintRequest, idempotency_key: Optional[str] = Header(None)):
     """Görev için ipucu ver"""
-    user = ensure_user(req.user_id)
+    ensure_user(req.user_id)
 
-    if user["coins"] < 10:
+    # Aynı Idempotency-Key ile tekrarlanan istek ikinci kez jeton düşmez
+    key = f"hint:{req.task_id}:{idempotency_key or uuid.uuid4().hex}"
+    try:
+        result = PROGRESS_STORE.apply_ledger(req.user_id, 0, -HINT_COST, key, "hint")
+    except InsufficientBalance:
         raise HTTPException(status_code=400, detail="Yeterli jetonunuz yok")
 
-    user["coins"] -= 10
-
     lab_hints = {
         "sql_injection": "SQL Injection için: ' OR '1'='1 gibi temel payload'ları dene",
         "xss": "XSS için: <script>alert('XSS')</script> temel payload ile başla",
@@ -525,32 +830,32 @@ async def get_hint(req: HintRequest):
 
     return {
         "hint": hint,
-        "coins_left": user["coins"]
+        "coins_left": result.balance.coins
     }
 
 
 # --- Diğer endpoint'ler ---
 
 @app.post("/api/chat")
-async def chat_with_bilge(req: ChatRequest):
+async def chat_with_bilge(req: ChatRequest, request: Request):
     """Bilge Logvian ile sohbet et"""
-    user = ensure_user(req.user_id)
+    window = await run_in_threadpool(load_chat_window, req.user_id)
 
-    user_msg_entry = {
-        "from": "user",
-        "msg": req.message,
-        "time": time.time()
-    }
-    user["chat_history"].append(user_msg_entry)
-
-    bot_response = ask_bilge_logvian(req.message, user["chat_history"])
+    try:
+        bot_response = await run_until_disconnect(
+            request, ask_bilge_logvian(req.message, window)
+        )
+    except LLMError as e:
+        # Hata mesajı gösterilir ama geçmişe yazılmaz (sonraki prompt'lara girmez)
+        return {
+            "response": str(e),
+            "error": True,
+            "user_id": req.user_id,
+            "timestamp": time.time()
+        }
 
-    bot_msg_entry = {
-        "from": "bot",
-        "msg": bot_response,
-        "time": time.time()
-    }
-    user["chat_history"].append(bot_msg_entry)
+    # Turlar sona eklenir; cevap beklerken yazılan diğer turlar ezilmez
+    await run_in_threadpool(append_chat_turns, req.user_id, (USER, req.message), (ASSISTANT, bot_response))
 
     return {
         "response": bot_response,
@@ -559,20 +864,80 @@ async def chat_with_bilge(req: ChatRequest):
     }
 
 
+@app.post("/api/chat/stream")
+async def chat_with_bilge_stream(req: ChatRequest):
+    """Bilge Logvian ile sohbet et (SSE ile token token akış)"""
+    window = await run_in_threadpool(load_chat_window, req.user_id)
+
+    async def event_stream():
+        parts: List[str] = []
+        try:
+            async for token in stream_bilge_logvian(req.message, window):
+                parts.append(token)
+                yield sse_event({"token": token})
+        except LLMError as e:
+            # Hata ayrı bir olay olarak gider; yarım ya da hatalı cevap geçmişe yazılmaz
+            yield sse_event({"error": str(e), "partial": bool(parts)}, event="error")
+            return
+
+        # Yalnızca tamamlanan cevap kaydedilir; istemci arada koparsa buraya gelinmez
+        response = "".join(parts)
+        await run_in_threadpool(append_chat_turns, req.user_id, (USER, req.message), (ASSISTANT, response))
+        yield sse_event({
+            "response": response,
+            "user_id": req.user_id,
+            "timestamp": time.time()
+        }, event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/api/user/{user_id}/progress")
-async def get_user_progress(user_id: str):
+def get_user_progress(user_id: str):
     """Kullanıcı ilerlemesini getir"""
     user = ensure_user(user_id)
-    return {
-        "progress": {
-            "level": user["level"],
-            "total_xp": user["xp"],
-            "total_coins": user["coins"],
-            "next_level_xp": user["level"] * 100,
-            "completed_tasks": user["completed_modules"],
-            "skills": user["skills"]
+    return {"progress": build_progress(user)}
+
+
+DASHBOARD_FIELDS = ("tasks", "progress", "active_labs", "challenges")
+
+
+@app.get("/api/user/{user_id}/dashboard")
+def get_user_dashboard(user_id: str, fields: Optional[str] = None):
+    """Görevler, ilerleme, aktif lablar ve challenge'ları tek istekte getir.
+
+    ``fields`` virgülle ayrılmış alt kümedir (ör. ``?fields=tasks,progress``);
+    verilmezse tüm alanlar döner.
+    """
+    selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(DASHBOARD_FIELDS)
+    unknown = [f for f in selected if f not in DASHBOARD_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Bilinmeyen alan(lar): {', '.join(unknown)}")
+
+    user = ensure_user(user_id)
+    dashboard: Dict[str, Any] = {}
+
+    if "tasks" in selected:
+        dashboard["tasks"] = TASK_CATALOG.render(
+            TASK_CATALOG.completed_mask(PROGRESS_STORE.get_completed_modules(user_id)),
+            TASK_CATALOG.locked_mask(user["xp"])
+        )
+    if "progress" in selected:
+        dashboard["progress"] = build_progress(user)
+    if "active_labs" in selected:
+        dashboard["active_labs"] = PROGRESS_STORE.get_active_labs(user_id)
+    if "challenges" in selected:
+        states = PROGRESS_STORE.get_simulation_states(user_id)
+        dashboard["challenges"] = {
+            lab_name: challenge_payload(lab_name, current_challenge_for(states.get(lab_name), lab_name))
+            for lab_name in LAB_SIMULATIONS
         }
-    }
+
+    return dashboard
 
 
 if __name__ == "__main__":
@@ -0,0 +1,663 @@
+# backend/progress_store.py
+# Bilge Logvian - Kullanıcı ilerleme deposu
+# main.py'deki USER_PROGRESS / ACTIVE_LABS sözlüklerinin yerini alır.
+# Varsayılan arka uç SQLite (WAL); SQLAlchemy sayesinde PostgreSQL URL'si de verilebilir.
+# "memory://" ile eski süreç içi davranış (kalıcılık yok) seçilebilir.
+# XP/jeton bakiyeleri yalnızca ekleme yapılan bir defter (ledger) üzerinden değişir;
+# bakiyeler tablosu bu defterin somutlaştırılmış görünümüdür.
+# Kullanıcı kaydı küçük bir profildir (seviye, envanter, ...); sohbet turları, lab
+# simülasyon durumları, tamamlanan modüller ve yetenekler kendi anahtarlı tablolarında
+# tutulur ve yalnızca değişen satırlar yazılır.
+
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import (
+    Column, Float, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+    create_engine, event, func, select
+)
+from sqlalchemy.exc import IntegrityError
+
+UserData = Dict[str, Any]
+# (rol, mesaj, zaman)
+ChatTurnRow = Tuple[str, str, float]
+
+class Balance(NamedTuple):
+    xp: int
+    coins: int
+
+
+class LedgerResult(NamedTuple):
+    applied: bool      # False → aynı idempotency anahtarı daha önce işlenmiş
+    balance: Balance
+
+
+class SimulationRecord(NamedTuple):
+    current_challenge: int
+    completed: bool
+    user_inputs: list
+    version: int       # 0 → henüz kaydedilmemiş
+
+
+class InsufficientBalance(Exception):
+    """İşlem bakiyeyi negatife düşürecekti"""
+
+
+class _VersionConflict(Exception):
+    pass
+
+
+class ProgressStore(ABC):
+    """Kullanıcı ilerlemesi ve aktif lablar için depolama arayüzü"""
+
+    @abstractmethod
+    def load(self, user_id: str) -> Optional[UserData]:
+        """Kullanıcı profilini getir (sohbet, simülasyon, modül ve yetenekler hariç)"""
+
+    @abstractmethod
+    def save(self, user_id: str, data: UserData) -> None:
+        ...
+
+    @abstractmethod
+    def user_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def set_active_lab(self, user_id: str, lab_name: str, info: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def remove_active_lab(self, user_id: str, lab_name: str) -> None:
+        ...
+
+    @abstractmethod
+    def get_active_labs(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def active_lab_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def get_completed_modules(self, user_id: str) -> List[str]:
+        """Tamamlanan modüller, tamamlanma sırasıyla"""
+
+    @abstractmethod
+    def add_completed_module(self, user_id: str, module: str) -> bool:
+        """Modülü tamamlandı işaretle; zaten işaretliyse False"""
+
+    @abstractmethod
+    def get_skills(self, user_id: str) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    def increment_skill(self, user_id: str, skill: str, amount: int = 1) -> None:
+        ...
+
+    @abstractmethod
+    def get_simulation_state(self, user_id: str, lab_name: str) -> Optional[SimulationRecord]:
+        ...
+
+    @abstractmethod
+    def get_simulation_states(self, user_id: str) -> Dict[str, SimulationRecord]:
+        ...
+
+    @abstractmethod
+    def save_simulation_state(self, user_id: str, lab_name: str, current_challenge: int, completed: bool,
+                              user_inputs: list, expected_version: Optional[int] = None) -> bool:
+        """Lab durumunu yaz.
+
+        ``expected_version`` verilirse compare-and-set yapılır: kayıt arada başka bir
+        istekçe değiştirildiyse hiçbir şey yazılmaz ve False döner. ``None`` koşulsuz yazar.
+        """
+
+    @abstractmethod
+    def get_chat_turns(self, user_id: str, limit: int) -> List[ChatTurnRow]:
+        """En yeni ``limit`` sohbet turu, eskiden yeniye"""
+
+    @abstractmethod
+    def append_chat_turns(self, user_id: str, turns: Iterable[ChatTurnRow], keep_last: Optional[int] = None) -> None:
+        """Turları sona ekle; ``keep_last`` verilirse daha eski turları sil"""
+
+    @abstractmethod
+    def get_balance(self, user_id: str) -> Balance:
+        ...
+
+    @abstractmethod
+    def apply_ledger(self, user_id: str, xp: int, coins: int, idempotency_key: str, reason: str) -> LedgerResult:
+        """Deftere bir kayıt ekle ve bakiyeyi atomik olarak güncelle.
+
+        Aynı kullanıcı için aynı ``idempotency_key`` ikinci kez gelirse bakiye
+        değişmez ve ``applied=False`` döner. Bakiye negatife düşecekse
+        ``InsufficientBalance`` fırlatılır.
+        """
+
+    def flush(self) -> None:
+        """Bekleyen yazmaları kalıcı hale getir"""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class MemoryProgressStore(ProgressStore):
+    """Süreç içi sözlük deposu; yeniden başlatmada veriler kaybolur, tek worker içindir"""
+
+    def __init__(self):
+        self._users: Dict[str, UserData] = {}
+        self._active_labs: Dict[str, Dict[str, Any]] = {}
+        self._completed: Dict[str, List[str]] = {}
+        self._skills: Dict[str, Dict[str, int]] = {}
+        self._simulations: Dict[Tuple[str, str], SimulationRecord] = {}
+        self._chat: Dict[str, List[ChatTurnRow]] = {}
+        self._lock = threading.Lock()
+        self._balances: Dict[str, Balance] = {}
+        self._ledger: List[Tuple[str, int, int, str, str, float]] = []
+        self._ledger_keys: Set[Tuple[str, str]] = set()
+        self._ledger_lock = threading.Lock()
+
+    def load(self, user_id: str) -> Optional[UserData]:
+        return self._users.get(user_id)
+
+    def save(self, user_id: str, data: UserData) -> None:
+        self._users[user_id] = data
+
+    def user_count(self) -> int:
+        return len(self._users)
+
+    def set_active_lab(self, user_id: str, lab_name: str, info: Dict[str, Any]) -> None:
+        self._active_labs.setdefault(user_id, {})[lab_name] = info
+
+    def remove_active_lab(self, user_id: str, lab_name: str) -> None:
+        self._active_labs.get(user_id, {}).pop(lab_name, None)
+
+    def get_active_labs(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        return dict(self._active_labs.get(user_id, {}))
+
+    def active_lab_count(self) -> int:
+        return sum(len(labs) for labs in self._active_labs.values())
+
+    def get_completed_modules(self, user_id: str) -> List[str]:
+        return list(self._completed.get(user_id, ()))
+
+    def add_completed_module(self, user_id: str, module: str) -> bool:
+        with self._lock:
+            modules = self._completed.setdefault(user_id, [])
+            if module in modules:
+                return False
+            modules.append(module)
+            return True
+
+    def get_skills(self, user_id: str) -> Dict[str, int]:
+        return dict(self._skills.get(user_id, {}))
+
+    def increment_skill(self, user_id: str, skill: str, amount: int = 1) -> None:
+        with self._lock:
+            skills = self._skills.setdefault(user_id, {})
+            skills[skill] = skills.get(skill, 0) + amount
+
+    def get_simulation_state(self, user_id: str, lab_name: str) -> Optional[SimulationRecord]:
+        return self._simulations.get((user_id, lab_name))
+
+    def get_simulation_states(self, user_id: str) -> Dict[str, SimulationRecord]:
+        return {lab: record for (uid, lab), record in self._simulations.items() if uid == user_id}
+
+    def save_simulation_state(self, user_id: str, lab_name: str, current_challenge: int, completed: bool,
+                              user_inputs: list, expected_version: Optional[int] = None) -> bool:
+        with self._lock:
+            current = self._simulations.get((user_id, lab_name))
+            version = current.version if current else 0
+            if expected_version is not None and expected_version != version:
+                return False
+            self._simulations[(user_id, lab_name)] = SimulationRecord(
+                current_challenge, completed, list(user_inputs), version + 1
+            )
+            return True
+
+    def get_chat_turns(self, user_id: str, limit: int) -> List[ChatTurnRow]:
+        return self._chat.get(user_id, [])[-limit:] if limit > 0 else []
+
+    def append_chat_turns(self, user_id: str, turns: Iterable[ChatTurnRow], keep_last: Optional[int] = None) -> None:
+        with self._lock:
+            history = self._chat.setdefault(user_id, [])
+            history.extend(turns)
+            if keep_last is not None and len(history) > keep_last:
+                del history[:-keep_last]
+
+    def get_balance(self, user_id: str) -> Balance:
+        return self._balances.get(user_id, Balance(0, 0))
+
+    def apply_ledger(self, user_id: str, xp: int, coins: int, idempotency_key: str, reason: str) -> LedgerResult:
+        with self._ledger_lock:
+            current = self._balances.get(user_id, Balance(0, 0))
+            if (user_id, idempotency_key) in self._ledger_keys:
+                return LedgerResult(False, current)
+            updated = Balance(current.xp + xp, current.coins + coins)
+            if updated.xp < 0 or updated.coins < 0:
+                raise InsufficientBalance(reason)
+            self._ledger.append((user_id, xp, coins, idempotency_key, reason, time.time()))
+            self._ledger_keys.add((user_id, idempotency_key))
+            self._balances[user_id] = updated
+            return LedgerResult(True, updated)
+
+
+class SQLProgressStore(ProgressStore):
+    """SQLAlchemy tabanlı kalıcı depo.
+
+    Kullanıcı profili birincil anahtarı ``user_id`` olan küçük bir JSON satırıdır.
+    Sohbet turları yalnızca ekleme yapılan bir tabloda, lab durumları (user_id, lab_name)
+    anahtarlı satırlarda (version sütunuyla compare-and-set), tamamlanan modüller ve
+    yetenekler ayrı satırlarda tutulur; her istek yalnızca ihtiyaç duyduğu satırları
+    okur ve yalnızca değişenleri yazar, böylece worker'lar birbirinin yazdığını ezmez.
+
+    ``write_behind`` açıkken profil ``save``'leri yalnızca bellekteki tampona yazılır;
+    arka plan thread'i biriken kayıtları ``flush_interval`` saniyede bir tek
+    transaction'da toplu olarak yazar. Bu mod, aynı kullanıcıya birden fazla worker'ın
+    yazdığı kurulumlarda kullanılmamalıdır.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        write_behind: bool = False,
+        flush_interval: float = 0.05,
+        batch_size: int = 256
+    ):
+        self.engine = create_engine(url, future=True)
+        self.dialect = self.engine.dialect.name
+
+        if self.dialect == "sqlite":
+            @event.listens_for(self.engine, "connect")
+            def _sqlite_pragmas(dbapi_conn, _record):
+                cursor = dbapi_conn.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute("PRAGMA busy_timeout=5000")
+                cursor.close()
+
+        self.metadata = MetaData()
+        self.users = Table(
+            "user_progress", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("data", Text, nullable=False),
+            Column("updated_at", Float, nullable=False)
+        )
+        self.active_labs = Table(
+            "active_labs", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("lab_name", String(64), primary_key=True),
+            Column("info", Text, nullable=False),
+            Index("ix_active_labs_lab_name", "lab_name")
+        )
+        self.completed_modules = Table(
+            "completed_modules", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("module", String(64), primary_key=True),
+            Column("completed_at", Float, nullable=False)
+        )
+        self.skills = Table(
+            "user_skills", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("skill", String(64), primary_key=True),
+            Column("level", Integer, nullable=False)
+        )
+        self.simulation_states = Table(
+            "simulation_states", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("lab_name", String(64), primary_key=True),
+            Column("current_challenge", Integer, nullable=False),
+            Column("completed", Integer, nullable=False),
+            Column("user_inputs", Text, nullable=False),
+            Column("version", Integer, nullable=False),
+            Column("updated_at", Float, nullable=False)
+        )
+        self.chat_turns = Table(
+            "chat_turns", self.metadata,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("user_id", String(128), nullable=False),
+            Column("role", String(16), nullable=False),
+            Column("msg", Text, nullable=False),
+            Column("created_at", Float, nullable=False),
+            Index("ix_chat_turns_user_id_id", "user_id", "id")
+        )
+        self.ledger = Table(
+            "reward_ledger", self.metadata,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("user_id", String(128), nullable=False, index=True),
+            Column("idempotency_key", String(128), nullable=False),
+            Column("delta_xp", Integer, nullable=False),
+            Column("delta_coins", Integer, nullable=False),
+            Column("reason", String(64), nullable=False),
+            Column("created_at", Float, nullable=False),
+            UniqueConstraint("user_id", "idempotency_key", name="uq_reward_ledger_key")
+        )
+        self.balances = Table(
+            "balances", self.metadata,
+            Column("user_id", String(128), primary_key=True),
+            Column("xp", Integer, nullable=False),
+            Column("coins", Integer, nullable=False),
+            Column("version", Integer, nullable=False)
+        )
+        self.metadata.create_all(self.engine)
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: Dict[str, Tuple[str, float]] = {}
+        self._inflight: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._flusher: Optional[threading.Thread] = None
+        if write_behind:
+            self._flusher = threading.Thread(target=self._flush_loop, name="progress-write-behind", daemon=True)
+            self._flusher.start()
+
+    def _insert(self, table: Table):
+        if self.dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        return insert(table)
+
+    def _upsert_users(self, conn, rows):
+        stmt = self._insert(self.users)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[self.users.c.user_id],
+            set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+        )
+        conn.execute(stmt, rows)
+
+    def load(self, user_id: str) -> Optional[UserData]:
+        with self._lock:
+            pending = self._pending.get(user_id) or self._inflight.get(user_id)
+        if pending is not None:
+            return json.loads(pending[0])
+
+        with self.engine.connect() as conn:
+            raw = conn.execute(
+                select(self.users.c.data).where(self.users.c.user_id == user_id)
+            ).scalar_one_or_none()
+        return json.loads(raw) if raw is not None else None
+
+    @staticmethod
+    def _dump(data: UserData) -> str:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def save(self, user_id: str, data: UserData) -> None:
+        raw = self._dump(data)
+        now = time.time()
+
+        if self.write_behind:
+            with self._lock:
+                self._pending[user_id] = (raw, now)
+                full = len(self._pending) >= self.batch_size
+            if full:
+                self._wakeup.set()
+            return
+
+        with self.engine.begin() as conn:
+            self._upsert_users(conn, [{"user_id": user_id, "data": raw, "updated_at": now}])
+
+    def user_count(self) -> int:
+        with self.engine.connect() as conn:
+            stored = conn.execute(select(func.count()).select_from(self.users)).scalar_one()
+            if not self._pending:
+                return stored
+            with self._lock:
+                pending_ids = list(self._pending)
+            existing = conn.execute(
+                select(func.count()).select_from(self.users).where(self.users.c.user_id.in_(pending_ids))
+            ).scalar_one()
+        return stored + len(pending_ids) - existing
+
+    def set_active_lab(self, user_id: str, lab_name: str, info: Dict[str, Any]) -> None:
+        stmt = self._insert(self.active_labs)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[self.active_labs.c.user_id, self.active_labs.c.lab_name],
+            set_={"info": stmt.excluded.info}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt, {"user_id": user_id, "lab_name": lab_name, "info": json.dumps(info)})
+
+    def remove_active_lab(self, user_id: str, lab_name: str) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(
+                self.active_labs.delete().where(
+                    (self.active_labs.c.user_id == user_id) & (self.active_labs.c.lab_name == lab_name)
+                )
+            )
+
+    def get_active_labs(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(self.active_labs.c.lab_name, self.active_labs.c.info)
+                .where(self.active_labs.c.user_id == user_id)
+            ).all()
+        return {row.lab_name: json.loads(row.info) for row in rows}
+
+    def active_lab_count(self) -> int:
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.active_labs)).scalar_one()
+
+    def get_completed_modules(self, user_id: str) -> List[str]:
+        table = self.completed_modules
+        with self.engine.connect() as conn:
+            return list(conn.execute(
+                select(table.c.module).where(table.c.user_id == user_id).order_by(table.c.completed_at)
+            ).scalars())
+
+    def add_completed_module(self, user_id: str, module: str) -> bool:
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                self._insert(self.completed_modules).on_conflict_do_nothing(),
+                {"user_id": user_id, "module": module, "completed_at": time.time()}
+            )
+        return result.rowcount == 1
+
+    def get_skills(self, user_id: str) -> Dict[str, int]:
+        table = self.skills
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(table.c.skill, table.c.level).where(table.c.user_id == user_id)).all()
+        return {row.skill: row.level for row in rows}
+
+    def increment_skill(self, user_id: str, skill: str, amount: int = 1) -> None:
+        # Artış veritabanında yapılır; eşzamanlı artışlar birbirini ezmez
+        stmt = self._insert(self.skills)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[self.skills.c.user_id, self.skills.c.skill],
+            set_={"level": self.skills.c.level + stmt.excluded.level}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt, {"user_id": user_id, "skill": skill, "level": amount})
+
+    @staticmethod
+    def _simulation_record(row) -> SimulationRecord:
+        return SimulationRecord(
+            row.current_challenge, bool(row.completed), json.loads(row.user_inputs), row.version
+        )
+
+    def get_simulation_state(self, user_id: str, lab_name: str) -> Optional[SimulationRecord]:
+        table = self.simulation_states
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(table).where((table.c.user_id == user_id) & (table.c.lab_name == lab_name))
+            ).first()
+        return self._simulation_record(row) if row else None
+
+    def get_simulation_states(self, user_id: str) -> Dict[str, SimulationRecord]:
+        table = self.simulation_states
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(table).where(table.c.user_id == user_id)).all()
+        return {row.lab_name: self._simulation_record(row) for row in rows}
+
+    def save_simulation_state(self, user_id: str, lab_name: str, current_challenge: int, completed: bool,
+                              user_inputs: list, expected_version: Optional[int] = None) -> bool:
+        table = self.simulation_states
+        values = {
+            "current_challenge": current_challenge,
+            "completed": int(completed),
+            "user_inputs": json.dumps(user_inputs, ensure_ascii=False),
+            "updated_at": time.time()
+        }
+        key = {"user_id": user_id, "lab_name": lab_name}
+
+        with self.engine.begin() as conn:
+            if expected_version is None:
+                stmt = self._insert(table)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.user_id, table.c.lab_name],
+                    set_={**{name: getattr(stmt.excluded, name) for name in values}, "version": table.c.version + 1}
+                )
+                conn.execute(stmt, {**key, **values, "version": 1})
+                return True
+            if expected_version == 0:
+                # İlk kayıt: aynı anda oluşturan başka istek varsa ekleme yapılmaz
+                result = conn.execute(
+                    self._insert(table).on_conflict_do_nothing(), {**key, **values, "version": 1}
+                )
+            else:
+                result = conn.execute(
+                    table.update()
+                    .where((table.c.user_id == user_id) & (table.c.lab_name == lab_name)
+                           & (table.c.version == expected_version))
+                    .values(**values, version=expected_version + 1)
+                )
+        return result.rowcount == 1
+
+    def get_chat_turns(self, user_id: str, limit: int) -> List[ChatTurnRow]:
+        table = self.chat_turns
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(table.c.role, table.c.msg, table.c.created_at)
+                .where(table.c.user_id == user_id)
+                .order_by(table.c.id.desc())
+                .limit(limit)
+            ).all()
+        return [(row.role, row.msg, row.created_at) for row in reversed(rows)]
+
+    def append_chat_turns(self, user_id: str, turns: Iterable[ChatTurnRow], keep_last: Optional[int] = None) -> None:
+        table = self.chat_turns
+        rows = [{"user_id": user_id, "role": role, "msg": msg, "created_at": ts} for role, msg, ts in turns]
+        if not rows:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+            if keep_last is not None:
+                # keep_last'ten eski turları sil (kullanıcı başına satır sayısı sabit kalır)
+                boundary = (
+                    select(table.c.id).where(table.c.user_id == user_id)
+                    .order_by(table.c.id.desc()).offset(keep_last).limit(1)
+                    .scalar_subquery()
+                )
+                conn.execute(table.delete().where((table.c.user_id == user_id) & (table.c.id <= boundary)))
+
+    def get_balance(self, user_id: str) -> Balance:
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(self.balances.c.xp, self.balances.c.coins).where(self.balances.c.user_id == user_id)
+            ).first()
+        return Balance(row.xp, row.coins) if row else Balance(0, 0)
+
+    def apply_ledger(self, user_id: str, xp: int, coins: int, idempotency_key: str, reason: str,
+                     max_retries: int = 8) -> LedgerResult:
+        for _ in range(max_retries):
+            try:
+                with self.engine.begin() as conn:
+                    return self._apply_ledger_once(conn, user_id, xp, coins, idempotency_key, reason)
+            except _VersionConflict:
+                continue
+            except IntegrityError:
+                # Aynı anahtarla eşzamanlı gelen diğer istek önce yazdı
+                return LedgerResult(False, self.get_balance(user_id))
+        raise RuntimeError(f"Bakiye güncellenemedi (çok fazla eşzamanlı yazma): {user_id}")
+
+    def _apply_ledger_once(self, conn, user_id, xp, coins, idempotency_key, reason) -> LedgerResult:
+        ledger, balances = self.ledger, self.balances
+
+        seen = conn.execute(
+            select(ledger.c.id).where((ledger.c.user_id == user_id) & (ledger.c.idempotency_key == idempotency_key))
+        ).first()
+
+        row = conn.execute(
+            select(balances.c.xp, balances.c.coins, balances.c.version).where(balances.c.user_id == user_id)
+        ).first()
+        if row is None:
+            conn.execute(
+                self._insert(balances).on_conflict_do_nothing(index_elements=[balances.c.user_id]),
+                {"user_id": user_id, "xp": 0, "coins": 0, "version": 0}
+            )
+            row = conn.execute(
+                select(balances.c.xp, balances.c.coins, balances.c.version).where(balances.c.user_id == user_id)
+            ).first()
+
+        if seen is not None:
+            return LedgerResult(False, Balance(row.xp, row.coins))
+
+        updated = Balance(row.xp + xp, row.coins + coins)
+        if updated.xp < 0 or updated.coins < 0:
+            raise InsufficientBalance(reason)
+
+        # Compare-and-set: başka bir worker arada yazdıysa version değişmiştir, baştan dene
+        result = conn.execute(
+            balances.update()
+            .where((balances.c.user_id == user_id) & (balances.c.version == row.version))
+            .values(xp=updated.xp, coins=updated.coins, version=row.version + 1)
+        )
+        if result.rowcount != 1:
+            raise _VersionConflict()
+
+        conn.execute(ledger.insert(), {
+            "user_id": user_id,
+            "idempotency_key": idempotency_key,
+            "delta_xp": xp,
+            "delta_coins": coins,
+            "reason": reason,
+            "created_at": time.time()
+        })
+        return LedgerResult(True, updated)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            # Yazım sürerken okumalar eski DB satırını görmesin
+            self._inflight = batch
+        if not batch:
+            return
+
+        rows = [{"user_id": uid, "data": raw, "updated_at": ts} for uid, (raw, ts) in batch.items()]
+        try:
+            with self.engine.begin() as conn:
+                self._upsert_users(conn, rows)
+        except Exception as e:
+            # Yazılamayan kayıtları, arada gelen daha yeni sürümleri ezmeden geri koy
+            with self._lock:
+                for uid, entry in batch.items():
+                    self._pending.setdefault(uid, entry)
+            print(f"⚠️ İlerleme kayıtları yazılamadı, tekrar denenecek: {e}")
+        finally:
+            with self._lock:
+                self._inflight = {}
+
+    def _flush_loop(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+        self.engine.dispose()
+
+
+def create_progress_store(url: str, **kwargs) -> ProgressStore:
+    """URL'ye göre uygun depoyu oluştur ("memory://" → süreç içi sözlük)"""
+    if url.startswith("memory://"):
+        return MemoryProgressStore()
+    return SQLProgressStore(url, **kwargs)
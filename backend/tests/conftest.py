@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Testler backend modüllerini düz import eder (uygulamanın çalıştığı dizin gibi)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main import edilirken Groq anahtarı ve ilerleme veritabanı okunur; testlerde gerçek
+# anahtar gerekmez (ağa çıkılmaz) ve veriler geçici bir SQLite dosyasına yazılır
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault(
+    "PROGRESS_STORE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'progress.db')}"
+)
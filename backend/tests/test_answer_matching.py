@@ -0,0 +1,63 @@
+import pytest
+
+from answer_matching import normalize_sql
+from main import ANSWER_MATCHERS as MATCHERS, check_simulation_answer
+
+
+def test_comment_terminator_is_kept_canonical():
+    assert normalize_sql("admin' --") == "admin' --"
+    assert normalize_sql("admin'#") == "admin' --"
+    assert normalize_sql("admin'") == "admin'"
+
+
+@pytest.mark.parametrize("answer", [
+    "admin' OR '1'='1' --",
+    "ADMIN' or 1=1--",
+    "' OR 'a'='a' #",
+    "admin' --",
+    "admin'-- ",
+    "admin' /* yorum */ --",
+])
+def test_sqli_login_bypass_accepted(answer):
+    assert MATCHERS[("sql_injection", 0)].matches(answer)
+
+
+@pytest.mark.parametrize("answer", [
+    "admin'",
+    "admin",
+    "' OR '1'='2' --",
+    "admin' OR '1'='1",
+    "",
+])
+def test_sqli_login_bypass_rejected(answer):
+    assert not MATCHERS[("sql_injection", 0)].matches(answer)
+
+
+@pytest.mark.parametrize("answer", [
+    "' UNION SELECT 1,username,password FROM users --",
+    "' union all select username , password from users#",
+    "' UNION SELECT password,username,3 FROM users; --",
+])
+def test_sqli_union_accepted(answer):
+    assert MATCHERS[("sql_injection", 1)].matches(answer)
+
+
+@pytest.mark.parametrize("answer", [
+    "' union select 1,usernamepassword from users --",
+    "' union select 1,username||password from users --",
+    "' union select 1,username,password from users",
+    "' union select 1,username,password from admins --",
+])
+def test_sqli_union_rejected(answer):
+    assert not MATCHERS[("sql_injection", 1)].matches(answer)
+
+
+def test_unknown_challenge_rejected():
+    assert not check_simulation_answer("sql_injection", 99, "admin' --")
+    assert not check_simulation_answer("nope", 0, "admin' --")
+
+
+def test_xss_variants():
+    matcher = MATCHERS[("xss", 0)]
+    assert matcher.matches('<SCRIPT>alert("hi");</script>')
+    assert not matcher.matches("<b>alert('XSS')</b>")
@@ -0,0 +1,55 @@
+from chat_cache import ResponseCache, normalize_message
+
+FIRST_EXCHANGE = [("user", "SQL injection nedir?"), ("assistant", "Çırak, SQL injection...")]
+
+
+def test_normalize_message_ignores_case_and_punctuation():
+    assert normalize_message("  İPUCU   ver!! ") == normalize_message("ipucu ver")
+
+
+def test_hit_only_with_identical_window():
+    cache = ResponseCache()
+    older = [("user", "merhaba"), ("assistant", "selam çırak")]
+    cache.put("Örnek verir misin?", older + FIRST_EXCHANGE, "örnek")
+
+    assert cache.get("örnek verir misin", older + FIRST_EXCHANGE) == "örnek"
+    # Son soru-cevap aynı olsa da daha eski turlar prompt'u değiştirir
+    assert cache.get("örnek verir misin", [("user", "selam"), ("assistant", "...")] + FIRST_EXCHANGE) is None
+    assert cache.get("örnek verir misin", FIRST_EXCHANGE) is None
+
+
+def test_miss_when_window_differs():
+    cache = ResponseCache()
+    cache.put("örnek verir misin", FIRST_EXCHANGE, "örnek")
+
+    assert cache.get("örnek verir misin", [("user", "XSS nedir?"), ("assistant", "XSS...")]) is None
+    assert cache.get("örnek verir misin", []) is None
+    # Geçmişteki metin prompt'a olduğu gibi girer; yalnızca noktalama farkı da ayrı anahtardır
+    assert cache.get("örnek verir misin", [("user", "SQL injection nedir"), FIRST_EXCHANGE[1]]) is None
+    assert cache.snapshot()["misses"] == 3
+
+
+def test_empty_window_matches_normalized_message():
+    cache = ResponseCache()
+    cache.put("sql injection nedir", [], "cevap")
+    assert cache.get("SQL injection nedir?", []) == "cevap"
+
+
+def test_semantic_layer_only_without_history():
+    cache = ResponseCache(semantic_threshold=0.6)
+    cache.put("sql injection nedir", [], "cevap")
+
+    assert cache.get("sql injection nedir acaba", []) == "cevap"
+    assert cache.get("sql injection nedir acaba", FIRST_EXCHANGE) is None
+
+
+def test_lru_eviction_and_ttl():
+    cache = ResponseCache(max_size=1)
+    cache.put("a", [], "1")
+    cache.put("b", [], "2")
+    assert cache.get("a", []) is None
+    assert cache.snapshot()["evictions"] == 1
+
+    expired = ResponseCache(ttl=-1)
+    expired.put("a", [], "1")
+    assert expired.get("a", []) is None
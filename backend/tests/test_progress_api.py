@@ -0,0 +1,221 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from progress_store import MemoryProgressStore
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "PROGRESS_STORE", MemoryProgressStore())
+    with TestClient(main.app) as c:
+        yield c
+
+
+def submit(client, lab_name, answer, user_id="u1"):
+    return client.post(f"/api/simulation/{lab_name}/submit", params={"user_id": user_id, "answer": answer}).json()
+
+
+def test_lab_completion_rewards_once(client):
+    client.post("/api/lab/start", json={"user_id": "u1", "lab_name": "hash_cracking"})
+
+    assert submit(client, "hash_cracking", "yanlış")["correct"] is False
+    assert submit(client, "hash_cracking", "password")["completed"] is False
+    done = submit(client, "hash_cracking", "password")
+    assert done["completed"] and not done["already_rewarded"]
+    assert done["rewards"] == main.LAB_SIMULATIONS["hash_cracking"]["reward"]
+    assert submit(client, "hash_cracking", "password")["message"] == "Bu lab zaten tamamlandı!"
+
+    progress = client.get("/api/user/u1/progress").json()["progress"]
+    reward = main.LAB_SIMULATIONS["hash_cracking"]["reward"]
+    assert progress["completed_tasks"] == ["hash_cracking"]
+    assert progress["total_xp"] == reward["xp"]
+    assert progress["skills"][main.LAB_SIMULATIONS["hash_cracking"]["skill"]] == 1
+
+    state = main.PROGRESS_STORE.get_simulation_state("u1", "hash_cracking")
+    assert [tuple(item)[1:] for item in state.user_inputs] == [
+        ("yanlış", False), ("password", True), ("password", True)
+    ]
+
+
+def test_restarted_lab_is_not_rewarded_twice(client):
+    for _ in range(2):
+        client.post("/api/lab/start", json={"user_id": "u1", "lab_name": "hash_cracking"})
+        submit(client, "hash_cracking", "password")
+        done = submit(client, "hash_cracking", "password")
+        assert done["completed"]
+
+    reward = main.LAB_SIMULATIONS["hash_cracking"]["reward"]
+    assert done["already_rewarded"] is True
+    assert done["rewards"] == {"xp": 0, "coins": 0} and done["level_up"] is False
+
+    progress = client.get("/api/user/u1/progress").json()["progress"]
+    assert progress["total_xp"] == reward["xp"]
+    assert progress["skills"][main.LAB_SIMULATIONS["hash_cracking"]["skill"]] == 1
+
+
+def test_submit_retries_on_concurrent_state_change(client, monkeypatch):
+    store = main.PROGRESS_STORE
+    original = store.save_simulation_state
+    calls = []
+
+    def racing(user_id, lab_name, *args, **kwargs):
+        calls.append(kwargs.get("expected_version"))
+        if len(calls) == 1:
+            # Başka bir gönderim aynı challenge'ı arada geçmiş olsun
+            original(user_id, lab_name, 1, False, [(0, "admin' OR '1'='1' --", True)])
+        return original(user_id, lab_name, *args, **kwargs)
+
+    monkeypatch.setattr(store, "save_simulation_state", racing)
+    result = submit(client, "sql_injection", "admin' OR '1'='1' --")
+
+    # Yeniden değerlendirmede cevap artık ikinci challenge'a karşı kontrol edilir
+    assert result["correct"] is False
+    assert calls == [0, 1]
+    assert store.get_simulation_state("u1", "sql_injection").current_challenge == 1
+
+
+def test_lab_restart_resets_only_that_lab(client):
+    submit(client, "sql_injection", "admin' OR '1'='1' --")
+    submit(client, "xss", "<script>alert('XSS')</script>")
+    client.post("/api/lab/start", json={"user_id": "u1", "lab_name": "xss"})
+
+    challenges = client.get("/api/user/u1/dashboard", params={"fields": "challenges"}).json()["challenges"]
+    assert challenges["sql_injection"]["challenge"]["id"] == 2
+    assert challenges["xss"]["challenge"]["id"] == 1
+
+
+def test_chat_turns_are_appended(client, monkeypatch):
+    async def fake_ask(message, window=None):
+        return f"cevap:{message}:{len(window)}"
+
+    monkeypatch.setattr(main, "ask_bilge_logvian", fake_ask)
+    client.post("/api/chat", json={"user_id": "u1", "message": "m1"})
+    client.post("/api/chat", json={"user_id": "u1", "message": "m2"})
+
+    turns = [(role, msg) for role, msg, _ in main.PROGRESS_STORE.get_chat_turns("u1", 10)]
+    assert turns == [("user", "m1"), ("assistant", "cevap:m1:0"), ("user", "m2"), ("assistant", "cevap:m2:2")]
+    # Profil kaydı sohbet geçmişini taşımaz
+    assert "chat_history" not in main.PROGRESS_STORE.load("u1")
+
+
+class LoopCheckingStore:
+    """Depo çağrılarını sarar ve event loop thread'inde yapılanları kaydeder"""
+
+    def __init__(self, store):
+        self._store = store
+        self.calls, self.on_loop = [], []
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            try:
+                asyncio.get_running_loop()
+                self.on_loop.append(name)
+            except RuntimeError:
+                pass
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def test_store_calls_do_not_block_event_loop(monkeypatch):
+    store = LoopCheckingStore(MemoryProgressStore())
+    monkeypatch.setattr(main, "PROGRESS_STORE", store)
+
+    async def fake_ask(message, window=None):
+        return "cevap"
+
+    async def fake_stream(message, window=None):
+        yield "cevap"
+
+    monkeypatch.setattr(main, "ask_bilge_logvian", fake_ask)
+    monkeypatch.setattr(main, "stream_bilge_logvian", fake_stream)
+
+    with TestClient(main.app) as c:
+        c.get("/")
+        c.post("/api/lab/start", json={"user_id": "u1", "lab_name": "xss"})
+        c.get("/api/lab/active/u1")
+        c.get("/api/simulation/xss/challenge", params={"user_id": "u1"})
+        submit(c, "xss", "<script>alert('XSS')</script>")
+        c.post("/api/lab/stop", json={"user_id": "u1", "lab_name": "xss"})
+        c.get("/api/tasks", params={"user_id": "u1"})
+        c.post("/api/lab/xss/start", params={"user_id": "u1"})
+        c.post("/api/hint", json={"user_id": "u1", "task_id": "xss"})
+        c.post("/api/chat", json={"user_id": "u1", "message": "m1"})
+        c.post("/api/chat/stream", json={"user_id": "u1", "message": "m2"})
+        c.get("/api/user/u1/progress")
+        c.get("/api/user/u1/dashboard")
+
+    assert {"load", "apply_ledger", "get_chat_turns", "append_chat_turns", "save_simulation_state"} <= set(store.calls)
+    assert store.on_loop == []
+
+
+def sse_frames(body):
+    frames = []
+    for raw in body.strip().split("\n\n"):
+        lines = raw.split("\n")
+        event = lines[0][len("event: "):] if lines[0].startswith("event: ") else None
+        frames.append((event, json.loads(lines[-1][len("data: "):])))
+    return frames
+
+
+def test_stream_error_is_not_saved(client, monkeypatch):
+    async def failing_stream(message, window=None):
+        yield "yarım "
+        raise main.LLMError("🔮 hata")
+
+    monkeypatch.setattr(main, "stream_bilge_logvian", failing_stream)
+    body = client.post("/api/chat/stream", json={"user_id": "u1", "message": "m1"}).text
+
+    assert sse_frames(body) == [(None, {"token": "yarım "}), ("error", {"error": "🔮 hata", "partial": True})]
+    assert main.PROGRESS_STORE.get_chat_turns("u1", 10) == []
+
+
+def test_stream_success_is_saved(client, monkeypatch):
+    async def ok_stream(message, window=None):
+        yield "cevap "
+        yield "tamam"
+
+    monkeypatch.setattr(main, "stream_bilge_logvian", ok_stream)
+    frames = sse_frames(client.post("/api/chat/stream", json={"user_id": "u1", "message": "m1"}).text)
+
+    assert frames[-1][0] == "done" and frames[-1][1]["response"] == "cevap tamam"
+    turns = [(role, msg) for role, msg, _ in main.PROGRESS_STORE.get_chat_turns("u1", 10)]
+    assert turns == [("user", "m1"), ("assistant", "cevap tamam")]
+
+
+def test_chat_error_is_not_saved(client, monkeypatch):
+    async def failing_ask(message, window=None):
+        raise main.LLMError("🔮 hata")
+
+    monkeypatch.setattr(main, "ask_bilge_logvian", failing_ask)
+    data = client.post("/api/chat", json={"user_id": "u1", "message": "m1"}).json()
+
+    assert data["error"] is True and data["response"] == "🔮 hata"
+    assert main.PROGRESS_STORE.get_chat_turns("u1", 10) == []
+
+
+def test_groq_failure_raises_and_is_not_cached(monkeypatch):
+    class FailingCompletions:
+        async def create(self, **kwargs):
+            raise RuntimeError("bağlantı koptu")
+
+    class FakeClient:
+        chat = type("Chat", (), {"completions": FailingCompletions()})()
+
+    monkeypatch.setattr(main, "client", FakeClient())
+
+    async def collect():
+        return [token async for token in main.stream_bilge_logvian("hata testi", [])]
+
+    with pytest.raises(main.LLMError, match="bağlantı koptu"):
+        asyncio.run(collect())
+    assert main.RESPONSE_CACHE.get("hata testi", []) is None
@@ -0,0 +1,151 @@
+import os
+import threading
+
+import pytest
+from sqlalchemy import func, select
+
+import progress_store
+from progress_store import InsufficientBalance, MemoryProgressStore, ProgressStore, SQLProgressStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        s = MemoryProgressStore()
+    else:
+        s = SQLProgressStore(f"sqlite:///{os.path.join(tmp_path, 'progress.db')}")
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def sql_store(tmp_path):
+    s = SQLProgressStore(f"sqlite:///{os.path.join(tmp_path, 'progress.db')}")
+    yield s
+    s.close()
+
+
+# --- Defter ---
+
+def test_ledger_same_key_applied_once(store):
+    first = store.apply_ledger("u1", 50, 20, "lab_complete:xss", "lab_complete")
+    second = store.apply_ledger("u1", 50, 20, "lab_complete:xss", "lab_complete")
+
+    assert first.applied and not second.applied
+    assert first.balance == second.balance == (50, 20)
+    assert store.get_balance("u1") == (50, 20)
+
+
+def test_ledger_keys_are_per_user(store):
+    store.apply_ledger("u1", 0, 100, "signup", "signup")
+    assert store.apply_ledger("u2", 0, 100, "signup", "signup").applied
+    assert store.get_balance("u2") == (0, 100)
+
+
+def test_ledger_rejects_negative_balance(store):
+    store.apply_ledger("u1", 0, 5, "signup", "signup")
+    with pytest.raises(InsufficientBalance):
+        store.apply_ledger("u1", 0, -10, "hint:1", "hint")
+    assert store.get_balance("u1") == (0, 5)
+    # Reddedilen anahtar kaydedilmez; bakiye yeterli olunca aynı anahtar uygulanır
+    store.apply_ledger("u1", 0, 10, "bonus", "bonus")
+    assert store.apply_ledger("u1", 0, -10, "hint:1", "hint").applied
+
+
+def test_ledger_retries_after_version_conflict(sql_store, monkeypatch):
+    original = SQLProgressStore._apply_ledger_once
+    attempts = []
+
+    def conflicting(self, conn, *args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            # İlk denemede başka bir worker bakiyeyi arada değiştirmiş gibi davran
+            raise progress_store._VersionConflict()
+        return original(self, conn, *args)
+
+    monkeypatch.setattr(SQLProgressStore, "_apply_ledger_once", conflicting)
+    result = sql_store.apply_ledger("u1", 10, 1, "k1", "test")
+
+    assert len(attempts) == 2
+    assert result.applied and result.balance == (10, 1)
+
+
+def test_ledger_concurrent_writers(sql_store):
+    def worker(i):
+        sql_store.apply_ledger("u1", 1, 0, f"k{i}", "test")
+        sql_store.apply_ledger("u1", 100, 0, "shared", "test")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sql_store.get_balance("u1") == (108, 0)
+    # Bakiye defterin toplamıyla tutarlı
+    ledger = sql_store.ledger
+    with sql_store.engine.connect() as conn:
+        totals = conn.execute(select(func.sum(ledger.c.delta_xp), func.count()).where(ledger.c.user_id == "u1")).one()
+    assert tuple(totals) == (108, 9)
+
+
+# --- Satır bazlı ilerleme ---
+
+def test_completed_modules_insert_once(store):
+    assert store.add_completed_module("u1", "xss")
+    assert store.add_completed_module("u1", "sql_injection")
+    assert not store.add_completed_module("u1", "xss")
+    assert store.get_completed_modules("u1") == ["xss", "sql_injection"]
+    assert store.get_completed_modules("u2") == []
+
+
+def test_skill_increments_accumulate(store):
+    store.increment_skill("u1", "XSS")
+    store.increment_skill("u1", "XSS", 2)
+    assert store.get_skills("u1") == {"XSS": 3}
+
+
+def test_simulation_state_compare_and_set(store):
+    assert store.get_simulation_state("u1", "xss") is None
+    assert store.save_simulation_state("u1", "xss", 0, False, [], expected_version=0)
+    # Aynı sürümden ikinci yazma (eşzamanlı gönderim) reddedilir
+    assert not store.save_simulation_state("u1", "xss", 1, False, [], expected_version=0)
+    assert store.save_simulation_state("u1", "xss", 1, False, [[0, "a", True]], expected_version=1)
+
+    record = store.get_simulation_state("u1", "xss")
+    assert (record.current_challenge, record.completed, record.version) == (1, False, 2)
+    assert [tuple(item) for item in record.user_inputs] == [(0, "a", True)]
+
+    # Koşulsuz yazma (lab yeniden başlatma) sürümü yine artırır
+    assert store.save_simulation_state("u1", "xss", 0, False, [])
+    assert store.get_simulation_state("u1", "xss").version == 3
+    assert set(store.get_simulation_states("u1")) == {"xss"}
+
+
+def test_chat_turns_append_and_trim(store):
+    store.append_chat_turns("u1", [("user", "m1", 1.0), ("assistant", "r1", 2.0)], keep_last=3)
+    store.append_chat_turns("u1", [("user", "m2", 3.0), ("assistant", "r2", 4.0)], keep_last=3)
+
+    assert store.get_chat_turns("u1", 10) == [("assistant", "r1", 2.0), ("user", "m2", 3.0), ("assistant", "r2", 4.0)]
+    assert store.get_chat_turns("u1", 1) == [("assistant", "r2", 4.0)]
+    assert store.get_chat_turns("u2", 10) == []
+
+
+def test_profile_save_does_not_touch_rows(store):
+    store.save("u1", {"user_id": "u1", "level": 1})
+    store.add_completed_module("u1", "xss")
+    store.append_chat_turns("u1", [("user", "m1", 1.0)])
+    store.save("u1", {"user_id": "u1", "level": 2})
+
+    assert store.load("u1") == {"user_id": "u1", "level": 2}
+    assert store.get_completed_modules("u1") == ["xss"]
+    assert store.get_chat_turns("u1", 10) == [("user", "m1", 1.0)]
+
+
+def test_incomplete_backend_fails_on_instantiation():
+    class PartialStore(ProgressStore):
+        def load(self, user_id):
+            return None
+
+    with pytest.raises(TypeError, match="abstract"):
+        PartialStore()
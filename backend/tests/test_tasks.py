@@ -0,0 +1,53 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from progress_store import MemoryProgressStore
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "PROGRESS_STORE", MemoryProgressStore())
+    with TestClient(main.app) as c:
+        yield c
+
+
+def test_masks_follow_lab_order():
+    catalog = main.TaskCatalog(main.LAB_SIMULATIONS, main.TASK_MODULES)
+    labs = list(main.LAB_SIMULATIONS)
+
+    assert catalog.completed_mask([labs[1], "bilinmeyen"]) == 0b10
+    assert catalog.locked_mask(0) == sum(
+        1 << i for i, lab in enumerate(main.LAB_SIMULATIONS.values()) if lab["unlock_xp"] > 0
+    )
+    assert catalog.locked_mask(10 ** 6) == 0
+
+    tasks = catalog.render(0b10, 0b01)
+    assert [t["id"] for t in tasks] == labs
+    assert [t["completed"] for t in tasks][:2] == [False, True]
+    assert [t["locked"] for t in tasks][:2] == [True, False]
+
+
+def test_version_changes_with_catalog_content():
+    labs = {name: dict(lab) for name, lab in main.LAB_SIMULATIONS.items()}
+    base = main.TaskCatalog(labs, main.TASK_MODULES).version
+    assert main.TaskCatalog(labs, main.TASK_MODULES).version == base
+
+    first = next(iter(labs))
+    labs[first]["reward"] = {"xp": 1, "coins": 1}
+    assert main.TaskCatalog(labs, main.TASK_MODULES).version != base
+
+
+def test_etag_revalidation(client):
+    first = client.get("/api/tasks", params={"user_id": "u1"})
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and len(first.json()["tasks"]) == len(main.LAB_SIMULATIONS)
+
+    cached = client.get("/api/tasks", params={"user_id": "u1"}, headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.headers["ETag"] == etag
+
+    # Modül tamamlanınca maske, dolayısıyla ETag değişir
+    main.PROGRESS_STORE.add_completed_module("u1", next(iter(main.LAB_SIMULATIONS)))
+    changed = client.get("/api/tasks", params={"user_id": "u1"}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert changed.json()["tasks"][0]["completed"] is True
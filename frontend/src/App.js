@@ -40,9 +40,7 @@ function App() {
   const messagesEndRef = useRef(null);
 
   useEffect(() => {
-    loadTasks();
-    loadUserProgress();
-    loadRunningLabs();
+    loadDashboard();
 
     // Partikül efekti için periyodik temizlik
     const interval = setInterval(() => {
@@ -93,12 +91,27 @@ function App() {
     }
   };
 
-  const loadRunningLabs = async () => {
+  // Görevler, ilerleme ve aktif lablar tek istekte
+  const loadDashboard = async () => {
     try {
-      const response = await axios.get("http://localhost:8000/api/lab/running");
-      setRunningLabs(response.data.running);
+      const response = await axios.get(`http://localhost:8000/api/user/${userId}/dashboard`, {
+        params: { fields: "tasks,progress,active_labs" }
+      });
+      const { tasks, progress, active_labs } = response.data;
+      setTasks(tasks);
+      setUserProgress(progress);
+      setRunningLabs(Object.fromEntries(
+        Object.values(active_labs).map(lab => [lab.container_id, {
+          container_name: lab.container_id,
+          lab_url: lab.url,
+          url: lab.url,
+          lab: lab.friendly_name
+        }])
+      ));
     } catch (error) {
-      console.error("Çalışan lablar yüklenemedi:", error);
+      console.error("Panel yüklenemedi:", error);
+      loadTasks();
+      loadUserProgress();
     }
   };
 
@@ -165,7 +178,11 @@ function App() {
         // Partikül efekti
         addParticleEffect('50%', '50%', 'levelup');
 
-        alert(`🎉 Tebrikler! ${response.data.rewards.xp} XP ve ${response.data.rewards.coins} jeton kazandın!`);
+        if (response.data.already_rewarded) {
+          alert(response.data.message);
+        } else {
+          alert(`🎉 Tebrikler! ${response.data.rewards.xp} XP ve ${response.data.rewards.coins} jeton kazandın!`);
+        }
       } else {
         alert("❌ Yanlış cevap. Tekrar dene!");
       }
@@ -208,20 +225,57 @@ function App() {
     setIsTyping(true);
 
     try {
-      const response = await axios.post("http://localhost:8000/api/chat", {
-        message: chatInput,
-        user_id: userId,
-        character: "Bilge Logvian"
+      const response = await fetch("http://localhost:8000/api/chat/stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          message: chatInput,
+          user_id: userId,
+          character: "Bilge Logvian"
+        })
       });
+      if (!response.ok || !response.body) {
+        throw new Error(`HTTP ${response.status}`);
+      }
 
-      const botMessage = {
-        id: Date.now() + 1,
+      // Bot mesajını boş ekle, token'lar geldikçe doldur
+      const botMessageId = Date.now() + 1;
+      setChatMessages(prev => [...prev, {
+        id: botMessageId,
         character: "wizard",
-        text: response.data.response,
+        text: "",
         avatar: logvianAvatar,
         timestamp: new Date()
-      };
-      setChatMessages(prev => [...prev, botMessage]);
+      }]);
+      setIsTyping(false);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (const rawEvent of events) {
+          const dataLine = rawEvent.split("\n").find(line => line.startsWith("data: "));
+          if (!dataLine || rawEvent.startsWith("event: done")) continue;
+          if (rawEvent.startsWith("event: error")) {
+            // Yarım cevabın yerine hata mesajını göster
+            const { error } = JSON.parse(dataLine.slice(6));
+            setChatMessages(prev => prev.map(m =>
+              m.id === botMessageId ? { ...m, character: "system", avatar: systemAvatar, text: error } : m
+            ));
+            continue;
+          }
+          const { token } = JSON.parse(dataLine.slice(6));
+          setChatMessages(prev => prev.map(m =>
+            m.id === botMessageId ? { ...m, text: m.text + token } : m
+          ));
+        }
+      }
 
     } catch (error) {
       console.error("Mesaj gönderilemedi:", error);
@@ -0,0 +1,186 @@
+"""
+Üretim öncesi kabul (admission) kontrolü.
+
+Aynı anda zamanlayıcıya en fazla ``max_inflight`` istek girer; gerisi sınırlı bir öncelik
+kuyruğunda bekler. Sıralama (öncelik katmanı, kullanıcı sanal zamanı, geliş sırası)
+anahtarıyla yapılır: kısa cevaplar önce gelir, aynı katmanda kullanıcılar sırayla (round-robin)
+hizmet alır, tek bir kullanıcının yığdığı istekler diğerlerini bekletmez.
+
+Reddetme durumları ``AdmissionRejected`` ile bildirilir (HTTP durum kodu + Retry-After):
+- 429: kuyruk dolu ya da kullanıcının bekleyen istek sınırı aşıldı
+- 503: tahmini bekleme süresi son tarihi (deadline) aşıyor ya da istek kuyrukta süresi doldu
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+PRIORITY_TIERS = {"short": 0, "normal": 1, "detailed": 2}
+
+
+def priority_tier(verbosity: str) -> int:
+    return PRIORITY_TIERS.get(verbosity, PRIORITY_TIERS["normal"])
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ("user_id", "tier", "enqueued_at", "admitted_at", "future", "released", "waiting")
+
+    def __init__(self, user_id: str, tier: int, future: Optional[asyncio.Future]):
+        self.user_id = user_id
+        self.tier = tier
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.future = future
+        self.released = False
+        self.waiting = future is not None
+
+
+class AdmissionController:
+    def __init__(self, max_inflight: int, max_queue: int = 64, max_queued_per_user: int = 4,
+                 deadline_seconds: float = 60.0, initial_service_seconds: float = 15.0):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.deadline_seconds = deadline_seconds
+
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._queued = 0
+        self._queued_by_user: Dict[str, int] = defaultdict(int)
+        self._queued_by_tier: Dict[int, int] = defaultdict(int)
+        # Kullanıcı başına sanal zaman; dağıtılan son isteğin sanal zamanından geriye düşmez
+        self._user_clock: Dict[str, int] = defaultdict(int)
+        self._virtual_time = 0
+        self.inflight = 0
+
+        # Tamamlanan isteklerin servis süresinin üstel hareketli ortalaması (bekleme tahmini için)
+        self.service_seconds = initial_service_seconds
+        self._waits: Deque[float] = deque(maxlen=500)
+        self.stats = {
+            "admitted": 0, "completed": 0,
+            "rejected_queue_full": 0, "rejected_user_limit": 0,
+            "shed_deadline": 0, "expired_in_queue": 0, "cancelled_in_queue": 0
+        }
+
+    # --- Tahmin ---
+    def estimated_wait(self, ahead: Optional[int] = None) -> float:
+        ahead = self._queued if ahead is None else ahead
+        if self.inflight < self.max_inflight and ahead == 0:
+            return 0.0
+        return (ahead // self.max_inflight + 1) * self.service_seconds
+
+    def _ahead_of(self, tier: int) -> int:
+        # Aynı ya da daha yüksek öncelikli katmanlarda bekleyenler önce hizmet alır
+        return sum(count for t, count in self._queued_by_tier.items() if t <= tier)
+
+    # --- Kabul ---
+    async def acquire(self, user_id: str, tier: int) -> Ticket:
+        if self.inflight < self.max_inflight and self._queued == 0:
+            return self._admit(Ticket(user_id, tier, None))
+
+        if self._queued >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected(429, "Sunucu yoğun; kuyruk dolu.", self._retry_after())
+        if self._queued_by_user.get(user_id, 0) >= self.max_queued_per_user:
+            self.stats["rejected_user_limit"] += 1
+            raise AdmissionRejected(429, "Bekleyen istek sınırına ulaştınız.", self._retry_after())
+
+        estimate = self.estimated_wait(self._ahead_of(tier))
+        if estimate > self.deadline_seconds:
+            self.stats["shed_deadline"] += 1
+            raise AdmissionRejected(503, "Tahmini bekleme süresi çok uzun.", self._retry_after(estimate))
+
+        ticket = Ticket(user_id, tier, asyncio.get_running_loop().create_future())
+        clock = max(self._user_clock[user_id], self._virtual_time) + 1
+        self._user_clock[user_id] = clock
+        heapq.heappush(self._heap, (tier, clock, next(self._seq), ticket))
+        self._queued += 1
+        self._queued_by_user[user_id] += 1
+        self._queued_by_tier[tier] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.deadline_seconds)
+        except asyncio.TimeoutError:
+            if not ticket.future.done():
+                self._leave_queue(ticket)
+                self.stats["expired_in_queue"] += 1
+                raise AdmissionRejected(503, "İstek kuyrukta zaman aşımına uğradı.", self._retry_after())
+        except asyncio.CancelledError:
+            if ticket.future.done():
+                # Yer verilmişti ama istemci gitti; yeri geri ver
+                self.release(ticket)
+            else:
+                self._leave_queue(ticket)
+                self.stats["cancelled_in_queue"] += 1
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """İsteğin yerini boşalt ve sıradaki isteği içeri al (birden fazla çağrı güvenli)"""
+        if ticket.released or ticket.admitted_at is None:
+            return
+        ticket.released = True
+        self.inflight -= 1
+        self.stats["completed"] += 1
+        elapsed = time.monotonic() - ticket.admitted_at
+        self.service_seconds = 0.8 * self.service_seconds + 0.2 * elapsed
+        self._dispatch()
+
+    def _admit(self, ticket: Ticket) -> Ticket:
+        ticket.admitted_at = time.monotonic()
+        self.inflight += 1
+        self.stats["admitted"] += 1
+        self._waits.append(ticket.admitted_at - ticket.enqueued_at)
+        return ticket
+
+    def _leave_queue(self, ticket: Ticket):
+        if not ticket.waiting:
+            return
+        ticket.waiting = False
+        self._queued -= 1
+        self._queued_by_user[ticket.user_id] -= 1
+        self._queued_by_tier[ticket.tier] -= 1
+        if not self._queued_by_user[ticket.user_id]:
+            del self._queued_by_user[ticket.user_id]
+            self._user_clock.pop(ticket.user_id, None)
+
+    def _dispatch(self):
+        while self.inflight < self.max_inflight and self._heap:
+            _, clock, _, ticket = heapq.heappop(self._heap)
+            if not ticket.waiting:
+                continue  # süresi dolmuş ya da iptal edilmiş
+            self._leave_queue(ticket)
+            self._virtual_time = max(self._virtual_time, clock)
+            self._admit(ticket)
+            ticket.future.set_result(True)
+
+    def _retry_after(self, estimate: Optional[float] = None) -> int:
+        return max(1, math.ceil(self.estimated_wait() if estimate is None else estimate))
+
+    def snapshot(self):
+        waits = sorted(self._waits)
+        return {
+            **self.stats,
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queue_depth": self._queued,
+            "queue_depth_by_tier": {
+                tier: self._queued_by_tier.get(level, 0) for tier, level in PRIORITY_TIERS.items()
+            },
+            "queued_users": len(self._queued_by_user),
+            "service_seconds_ewma": round(self.service_seconds, 2),
+            "wait_seconds_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "wait_seconds_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0
+        }
@@ -0,0 +1,114 @@
+"""
+Ağırlıkları hızlı açılış için önceden dönüştürme ve mmap ile yükleme.
+
+Dönüştürme (bir kez, çevrimdışı):
+
+    python convert_weights.py --model microsoft/phi-3-mini-4k-instruct --out converted --dtype float16
+
+Model bir kez ``from_pretrained`` ile açılır; modülün kendi state_dict'i (Phi3Attention'ın
+birleşik ``qkv_proj``'u ve Phi3MLP'nin ``gate_up_proj``'u dahil) hedef dtype'ta tek bir
+``model.pt`` dosyasına yazılır. Config, tokenizer ve varsa modelleme kodu yanına kopyalanır.
+
+Yükleme: model iskeleti ``meta`` cihazında (bellek ayırmadan) kurulur, ``model.pt``
+``torch.load(mmap=True)`` ile açılır ve tensörler ``load_state_dict(assign=True)`` ile
+kopyalanmadan yerine takılır. Ağırlıklar sayfa önbelleğinden okunduğu için aynı makinedeki
+birden fazla worker süreci aynı fiziksel belleği paylaşır.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+WEIGHTS_FILE = "model.pt"
+META_FILE = "converted.json"
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def is_converted(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, WEIGHTS_FILE)) and os.path.isfile(os.path.join(path, META_FILE))
+
+
+def convert(model_name: str, out_dir: str, dtype: str = "float32", trust_remote_code: bool = False):
+    started = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, torch_dtype=DTYPES[dtype], trust_remote_code=trust_remote_code
+    )
+    model.eval()
+
+    # Kalıcı olmayan buffer'lar (ör. rotary tabloları) state_dict'te yer almaz; ayrıca saklanır
+    persistent = set(model.state_dict())
+    buffers = {
+        name: buf.contiguous() for name, buf in model.named_buffers()
+        if buf is not None and name not in persistent
+    }
+    state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    torch.save({"state_dict": state_dict, "buffers": buffers}, os.path.join(out_dir, WEIGHTS_FILE))
+
+    model.config.save_pretrained(out_dir)
+    model.generation_config.save_pretrained(out_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(out_dir)
+    # trust_remote_code ile kullanılan modelleme kodu da yanında olmalı
+    if os.path.isdir(model_name):
+        for source in glob.glob(os.path.join(model_name, "*_phi3.py")):
+            shutil.copy(source, out_dir)
+
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "source": model_name,
+            "dtype": dtype,
+            "tensors": len(state_dict),
+            "converted_at": time.time()
+        }, f, indent=2)
+
+    print(f"✅ {model_name} → {out_dir} ({dtype}, {len(state_dict)} tensör, "
+          f"{time.perf_counter() - started:.1f}s)")
+
+
+def load_converted(path: str, device: str = "cpu", trust_remote_code: bool = False):
+    """Dönüştürülmüş modeli mmap ile, ağırlıkları kopyalamadan yükle"""
+    with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+
+    config = AutoConfig.from_pretrained(path, trust_remote_code=trust_remote_code)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=DTYPES[meta["dtype"]], trust_remote_code=trust_remote_code
+        )
+
+    checkpoint = torch.load(os.path.join(path, WEIGHTS_FILE), mmap=True, weights_only=True, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"], assign=True, strict=True)
+    for name, buf in checkpoint["buffers"].items():
+        module_name, _, buffer_name = name.rpartition(".")
+        model.get_submodule(module_name)._buffers[buffer_name] = buf
+    model.tie_weights()
+
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        raise RuntimeError(f"Dönüştürülmüş ağırlıklarda eksik tensörler var ({missing[:3]}...); yeniden dönüştürün.")
+
+    if device != "cpu":
+        model.to(device)
+    model.eval()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Phi-3 ağırlıklarını mmap ile yüklenebilir biçime dönüştür")
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "microsoft/phi-3-mini-4k-instruct"))
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="float32")
+    parser.add_argument("--trust-remote-code", action="store_true")
+    args = parser.parse_args()
+    convert(args.model, args.out, args.dtype, args.trust_remote_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+Şemaya bağlı (grammar-constrained) JSON üretimi.
+
+Model çıktısı sabit anahtar sırasıyla
+``{"theory": "...", "answer": "...", "homework": ["..."], "lab": ["..."], "notes": "..."}``
+biçimine zorlanır. Şema karakter düzeyinde küçük bir durum makinesi (FSM) olarak
+tanımlanır; uygulama açılırken her durum için "bu durumdan tamamen tüketilebilen
+token'lar" maskesi sözlük üzerinde bir kez hesaplanır. Üretimde her adımda yalnızca
+maskelenmiş logit'lerden örneklenir ve kapanış süslü parantezi gelince dizi biter.
+
+Her durum için nesneyi en kısa yoldan kapatan metin (ör. ``","homework":[],"lab":[],"notes":""}``)
+ve bu metnin en uzun önekine karşılık gelen token'lardan oluşan "kapanış" maskesi de hesaplanır. Token bütçesi
+bitmek üzereyken ya da ``answer`` cümle bütçesi dolduğunda bu maske kullanılır; böylece
+çıktı bütçe içinde her zaman geçerli bir JSON olarak kapanır.
+"""
+
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+FIELDS: Tuple[Tuple[str, str], ...] = (
+    ("theory", "str"),
+    ("answer", "str"),
+    ("homework", "arr"),
+    ("lab", "arr"),
+    ("notes", "str"),
+)
+
+WHITESPACE = " \n\t\r"
+# Arka arkaya en fazla bu kadar boşluk karakterine izin verilir; aksi halde model yapı
+# karakterleri arasında sonsuz boşluk üretip token bütçesini tüketebilir
+MAX_WHITESPACE_RUN = 8
+HEX = set("0123456789abcdefABCDEF")
+
+LIT, WS, STR, ARR = "lit", "ws", "str", "arr"
+
+# String alt durumları: açılış tırnağı bekleniyor, içerik, kaçış, \u + 4 hex basamak
+S_OPEN, S_IN, S_ESC, S_U1, S_U4 = 0, 1, 2, 3, 6
+# Dizi alt durumları; 10 + string alt durumu dizi elemanının içidir
+A_OPEN, A_FIRST, A_NEXT, A_ITEM, A_STRING = 0, 1, 2, 3, 10
+
+_DONE = object()
+_BYTE_TOKEN_RE = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+State = Tuple[int, int]
+
+
+def build_program(fields: Sequence[Tuple[str, str]] = FIELDS) -> List[Tuple[str, Optional[str]]]:
+    """Şemayı sıralı gramer öğelerine çevir (boşluklar yalnızca yapı karakterleri arasında)"""
+    program: List[Tuple[str, Optional[str]]] = [(WS, None), (LIT, "{")]
+    for index, (name, kind) in enumerate(fields):
+        program += [(WS, None), (LIT, f'"{name}"'), (WS, None), (LIT, ":"), (WS, None), (kind, None), (WS, None)]
+        program.append((LIT, "," if index < len(fields) - 1 else "}"))
+    return program
+
+
+def _string_step(sub: int, ch: str):
+    if sub == S_OPEN:
+        return S_IN if ch == '"' else None
+    if sub == S_IN:
+        if ch == '"':
+            return _DONE
+        if ch == "\\":
+            return S_ESC
+        return None if ch < " " else S_IN
+    if sub == S_ESC:
+        if ch == "u":
+            return S_U1
+        return S_IN if ch in '"\\/bfnrt' else None
+    if ch not in HEX:
+        return None
+    return S_IN if sub == S_U4 else sub + 1
+
+
+def token_texts(tokenizer, vocab_size: int) -> List[Optional[str]]:
+    """Her token id'si için çıktıya ekleyeceği metin; özel token'lar için None"""
+    special = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}) or {})
+    pieces = tokenizer.convert_ids_to_tokens(list(range(min(vocab_size, len(tokenizer)))))
+    sentencepiece = any(p is not None and p.startswith("▁") for p in pieces[:2000])
+
+    texts: List[Optional[str]] = [None] * vocab_size
+    for token_id, piece in enumerate(pieces):
+        if piece is None or token_id in special:
+            continue
+        if sentencepiece:
+            byte = _BYTE_TOKEN_RE.match(piece)
+            if byte:
+                value = int(byte.group(1), 16)
+                # Çok baytlı UTF-8 parçaları yalnızca string içinde geçerli bir karakter gibi ele alınır
+                text = chr(value) if value < 0x80 else "�"
+            else:
+                text = piece.replace("▁", " ")
+        else:
+            text = tokenizer.convert_tokens_to_string([piece])
+        texts[token_id] = text or None
+    return texts
+
+
+class JsonSchemaGrammar:
+    """Şema FSM'i ve durum başına önceden hesaplanmış token maskeleri (tüm isteklerde ortak)"""
+
+    def __init__(self, tokenizer, vocab_size: int, eos_token_ids: Iterable[int],
+                 device="cpu", fields: Sequence[Tuple[str, str]] = FIELDS):
+        started = time.perf_counter()
+        self.program = build_program(fields)
+        self.vocab_size = vocab_size
+        self.eos_token_ids: Set[int] = set(eos_token_ids)
+        self.texts = token_texts(tokenizer, vocab_size)
+        self.initial: State = (0, 0)
+        self.final: State = (len(self.program), 0)
+        self.masks: Dict[State, torch.Tensor] = {
+            state: mask.to(device) for state, mask in self._build_masks().items()
+        }
+        self.field_pcs = {
+            literal.strip('"'): pc + 4 for pc, (kind, literal) in enumerate(self.program)
+            if kind == LIT and literal.startswith('"')
+        }
+        self.answer_pc = self.field_pcs.get("answer")
+        self.completions: Dict[State, str] = {state: self.completion(state) for state in self.masks}
+        self.closing_masks: Dict[State, torch.Tensor] = {
+            state: mask.to(device) for state, mask in self._build_closing_masks().items()
+        }
+        blank = torch.tensor([t is not None and not t.strip() for t in self.texts], dtype=torch.bool)
+        # Boşluk sınırı aşıldığında kullanılan, yalnızca boşluktan oluşan token'ları dışlayan maskeler
+        self.masks_without_blank: Dict[State, torch.Tensor] = {
+            state: mask & ~blank.to(device) for state, mask in self.masks.items()
+        }
+        self.build_seconds = round(time.perf_counter() - started, 2)
+
+    # --- FSM ---
+    def step(self, state: State, ch: str) -> Optional[State]:
+        pc, sub = state
+        while pc < len(self.program):
+            kind, literal = self.program[pc]
+            if kind == WS:
+                if ch in WHITESPACE:
+                    return pc, 0
+                pc, sub = pc + 1, 0
+                continue
+            if kind == LIT:
+                if ch != literal[sub]:
+                    return None
+                return (pc + 1, 0) if sub + 1 == len(literal) else (pc, sub + 1)
+            if kind == STR:
+                nxt = _string_step(sub, ch)
+                if nxt is _DONE:
+                    return pc + 1, 0
+                return None if nxt is None else (pc, nxt)
+            return self._array_step(pc, sub, ch)
+        return None
+
+    @staticmethod
+    def _array_step(pc: int, sub: int, ch: str) -> Optional[State]:
+        if sub >= A_STRING:
+            nxt = _string_step(sub - A_STRING, ch)
+            if nxt is _DONE:
+                return pc, A_NEXT
+            return None if nxt is None else (pc, A_STRING + nxt)
+        if sub == A_OPEN:
+            return (pc, A_FIRST) if ch == "[" else None
+        if ch in WHITESPACE:
+            return pc, sub
+        if ch == '"' and sub in (A_FIRST, A_ITEM):
+            return pc, A_STRING + S_IN
+        if ch == "," and sub == A_NEXT:
+            return pc, A_ITEM
+        if ch == "]" and sub in (A_FIRST, A_NEXT):
+            return pc + 1, 0
+        return None
+
+    def completion(self, state: State) -> str:
+        """Durumdan nesneyi kapatan en kısa metin (boşluksuz; diziler ve string'ler boş kapanır)"""
+        pc, sub = state
+        out: List[str] = []
+        while pc < len(self.program):
+            kind, literal = self.program[pc]
+            if kind == LIT:
+                out.append(literal[sub:])
+            elif kind == STR:
+                out.append(_close_string(sub))
+            elif kind == ARR:
+                if sub >= A_STRING:
+                    out.append(_close_string(sub - A_STRING) + "]")
+                else:
+                    out.append({A_OPEN: "[]", A_FIRST: "]", A_NEXT: "]", A_ITEM: '""]'}[sub])
+            pc, sub = pc + 1, 0
+        return "".join(out)
+
+    def walk(self, state: State, text: str) -> Optional[State]:
+        for ch in text:
+            state = self.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    # --- Maskeler ---
+    def _states(self) -> List[State]:
+        states: List[State] = []
+        for pc, (kind, literal) in enumerate(self.program):
+            if kind == LIT:
+                states += [(pc, sub) for sub in range(len(literal))]
+            elif kind == WS:
+                states.append((pc, 0))
+            elif kind == STR:
+                states += [(pc, sub) for sub in range(S_OPEN, S_U4 + 1)]
+            else:
+                states += [(pc, sub) for sub in (A_OPEN, A_FIRST, A_NEXT, A_ITEM)]
+                states += [(pc, A_STRING + sub) for sub in range(S_IN, S_U4 + 1)]
+        return states
+
+    def _is_string_body(self, state: State) -> bool:
+        kind = self.program[state[0]][0] if state[0] < len(self.program) else None
+        return (kind == STR and state[1] == S_IN) or (kind == ARR and state[1] == A_STRING + S_IN)
+
+    def _build_masks(self) -> Dict[State, torch.Tensor]:
+        # Token'ları ilk karakterlerine göre grupla; bir durum için yalnızca ilk karakteri
+        # kabul edilen gruplar yürünür
+        by_first: Dict[str, List[int]] = {}
+        # İçinde tırnak, ters bölü ya da kontrol karakteri olmayan token'lar string gövdesinde
+        # durumu değiştirmez; bu durumlar için tek bir ortak maske yeterli
+        string_safe = torch.zeros(self.vocab_size, dtype=torch.bool)
+        unsafe: List[int] = []
+        for token_id, text in enumerate(self.texts):
+            if text is None:
+                continue
+            by_first.setdefault(text[0], []).append(token_id)
+            if '"' in text or "\\" in text or min(text) < " ":
+                unsafe.append(token_id)
+            else:
+                string_safe[token_id] = True
+
+        masks: Dict[State, torch.Tensor] = {}
+        for state in self._states():
+            if self._is_string_body(state):
+                mask = string_safe.clone()
+                candidates: Iterable[int] = unsafe
+            else:
+                mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+                candidates = [
+                    token_id
+                    for first, ids in by_first.items() if self.step(state, first) is not None
+                    for token_id in ids
+                ]
+            for token_id in candidates:
+                after = self.walk(state, self.texts[token_id])
+                # Kapanış parantezinden sonra metin kalan token'lar kabul edilmez (walk None döner)
+                if after is not None:
+                    mask[token_id] = True
+            masks[state] = mask
+
+        final = torch.zeros(self.vocab_size, dtype=torch.bool)
+        final[[i for i in self.eos_token_ids if i < self.vocab_size]] = True
+        masks[self.final] = final
+        return masks
+
+    def _build_closing_masks(self) -> Dict[State, torch.Tensor]:
+        """Kapanış metninin en uzun önekine karşılık gelen token(lar); en az adımda kapatır"""
+        by_text: Dict[str, List[int]] = {}
+        for token_id, text in enumerate(self.texts):
+            if text is not None:
+                by_text.setdefault(text, []).append(token_id)
+        longest = max(len(text) for text in by_text)
+
+        prefix_lengths: Dict[State, int] = {}
+        masks: Dict[State, torch.Tensor] = {}
+        for state, completion in self.completions.items():
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            for length in range(min(len(completion), longest), 0, -1):
+                ids = by_text.get(completion[:length])
+                if ids:
+                    mask[ids] = True
+                    prefix_lengths[state] = length
+                    break
+            # Son durumda kapanış metni boştur; EOS maskesi kullanılır
+            masks[state] = mask if mask.any() else self.masks[state]
+
+        # Kapanış maskesi izlenirse nesnenin kaç token'da kapanacağı (bütçe kontrolü için)
+        self.closing_steps: Dict[State, int] = {}
+        for state in self.completions:
+            steps, current = 0, state
+            while current in prefix_lengths and current != self.final:
+                current = self.walk(current, self.completions[current][:prefix_lengths[current]])
+                steps += 1
+            self.closing_steps[state] = steps
+        return masks
+
+    def new_constraint(self, max_tokens: Optional[int] = None,
+                       answer_sentences: Optional[int] = None) -> "JsonConstraint":
+        return JsonConstraint(self, max_tokens, answer_sentences)
+
+
+class JsonConstraint:
+    """Tek bir üretim dizisinin gramerdeki konumu (zamanlayıcı thread'inde ilerletilir).
+
+    ``max_tokens`` verilirse kalan token sayısı kapanış metninin uzunluğuna indiğinde
+    yalnızca kapanış token'larına izin verilir. ``answer_sentences`` verilirse ``answer``
+    bu kadar cümleye ulaşınca string kapatılmaya zorlanır.
+    """
+    __slots__ = (
+        "grammar", "state", "whitespace_run", "max_tokens", "tokens",
+        "answer_sentences", "sentences", "last_char", "closing"
+    )
+
+    def __init__(self, grammar: JsonSchemaGrammar, max_tokens: Optional[int] = None,
+                 answer_sentences: Optional[int] = None):
+        self.grammar = grammar
+        self.state: Optional[State] = grammar.initial
+        self.whitespace_run = 0
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.answer_sentences = answer_sentences
+        self.sentences = 0
+        self.last_char = ""
+        self.closing = False
+
+    @property
+    def closed(self) -> bool:
+        return self.state == self.grammar.final
+
+    @property
+    def answer_full(self) -> bool:
+        return (
+            self.answer_sentences is not None and self.state is not None
+            and self.state[0] == self.grammar.answer_pc and self.sentences >= self.answer_sentences
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.state is None or self.state == self.grammar.final
+
+    def allowed(self) -> Optional[torch.Tensor]:
+        if self.state is None:
+            return None
+        if self.closing or self.answer_full:
+            return self.grammar.closing_masks[self.state]
+        if self.whitespace_run >= MAX_WHITESPACE_RUN:
+            return self.grammar.masks_without_blank[self.state]
+        return self.grammar.masks[self.state]
+
+    def advance(self, token_id: int):
+        if self.state is None or token_id in self.grammar.eos_token_ids:
+            self.state = None
+            return
+        text = self.grammar.texts[token_id] if token_id < len(self.grammar.texts) else None
+        if not text:
+            self.state = None
+            return
+        for ch in text:
+            self.state = self.grammar.step(self.state, ch)
+            if self.state is None:
+                return
+            # answer içinde noktalama + boşluk bir cümle sonu sayılır
+            if self.state[0] == self.grammar.answer_pc and ch in WHITESPACE and self.last_char in ".!?":
+                self.sentences += 1
+            self.last_char = ch
+        self.whitespace_run = self.whitespace_run + len(text) if not text.strip() else 0
+
+        self.tokens += 1
+        if self.max_tokens is not None and not self.closing:
+            self.closing = self.max_tokens - self.tokens <= self.grammar.closing_steps.get(self.state, 0) + 1
+
+
+def _close_string(sub: int) -> str:
+    if sub == S_OPEN:
+        return '""'
+    if sub == S_ESC:
+        return 'n"'
+    if sub >= S_U1:
+        return "0" * (S_U4 - sub + 1) + '"'
+    return '"'
+
+
+class JsonCloseStop:
+    """Gramer maskesi kapalıyken: üst düzey JSON nesnesi kapanınca üretimi durdurur"""
+    __slots__ = ("texts", "eos_token_ids", "depth", "in_string", "escape", "done")
+
+    def __init__(self, texts: Sequence[Optional[str]], eos_token_ids: Iterable[int] = ()):
+        self.texts = texts
+        self.eos_token_ids = set(eos_token_ids)
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    @property
+    def closed(self) -> bool:
+        return self.done
+
+    def allowed(self) -> None:
+        return None
+
+    def advance(self, token_id: int):
+        if token_id in self.eos_token_ids or token_id >= len(self.texts):
+            return
+        for ch in self.texts[token_id] or "":
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+                    return
@@ -1,13 +1,25 @@
 import os
 import json
 import re
-from fastapi import FastAPI, HTTPException
+import functools
+from typing import Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from admission import AdmissionController, AdmissionRejected, priority_tier
+from streaming import IncrementalDecoder, JsonSectionParser
 
 # Transformers import
 try:
     import torch
     from transformers import AutoTokenizer, AutoModelForCausalLM
+    from scheduler import BatchScheduler
+    from json_constraint import JsonCloseStop, JsonSchemaGrammar, token_texts
+    from quantization import memory_report, quantize_model
+    from convert_weights import is_converted, load_converted
     TF_AVAILABLE = True
 except Exception:
     TF_AVAILABLE = False
@@ -17,16 +29,51 @@ app = FastAPI(title="LLM Server - Bilge Logvian")
 # Config from environment
 MODEL_NAME = os.getenv("MODEL_NAME", "microsoft/phi-3-mini-4k-instruct")
 MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "400"))
+# verbosity başına token bütçesi ve answer için cümle bütçesi (None = sınırsız)
+VERBOSITY_BUDGETS = {
+    "short": {"max_new_tokens": int(os.getenv("MAX_NEW_TOKENS_SHORT", "160")), "answer_sentences": 3},
+    "normal": {"max_new_tokens": MAX_NEW_TOKENS, "answer_sentences": 8},
+    "detailed": {"max_new_tokens": int(os.getenv("MAX_NEW_TOKENS_DETAILED", "600")), "answer_sentences": None},
+}
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.65"))
 TOP_P = float(os.getenv("TOP_P", "0.92"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "16"))  # (character, verbosity) başına önek KV cache sayısı
+JSON_CONSTRAINT = os.getenv("JSON_CONSTRAINT", "1") == "1"  # çıktıyı şemaya uyan JSON'a zorla
+LLM_QUANTIZE = os.getenv("LLM_QUANTIZE", "none")  # "none" | "int8" | "int4" (yalnızca CPU)
+# convert_weights.py çıktısı; varsa model buradan mmap ile yüklenir
+CONVERTED_MODEL_DIR = os.getenv("CONVERTED_MODEL_DIR", "")
+TRUST_REMOTE_CODE = os.getenv("TRUST_REMOTE_CODE", "0") == "1"
+# Spekülatif çözümleme: varsayılan mod ("off" | "ngram" | "draft"), adım başına taslak token
+# sayısı ve aynı tokenizer'ı kullanan küçük taslak model (boşsa "draft" modu kapalı)
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_MODE", "off")
+NUM_SPECULATIVE_TOKENS = int(os.getenv("NUM_SPECULATIVE_TOKENS", "4"))
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME", "")
+# Kabul kontrolü: aynı anda üretimdeki istek sayısı, bekleme kuyruğu ve son tarih
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", str(MAX_BATCH_SIZE)))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "4"))
+ADMISSION_DEADLINE_SECONDS = float(os.getenv("ADMISSION_DEADLINE_SECONDS", "60"))
+
+LOCAL = {"loaded": False, "tokenizer": None, "model": None, "device": "cpu", "scheduler": None, "grammar": None,
+         "token_texts": None, "quantization": "none"}
 
-LOCAL = {"loaded": False, "tokenizer": None, "model": None, "device": "cpu"}
+BUDGET_STATS = {"requests": 0, "generated_tokens": 0, "tokens_saved": 0, "stop_reasons": {}}
+USAGE_STATS = {"requests": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+
+ADMISSION = AdmissionController(
+    max_inflight=ADMISSION_MAX_INFLIGHT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_queued_per_user=ADMISSION_MAX_PER_USER,
+    deadline_seconds=ADMISSION_DEADLINE_SECONDS
+)
 
 class ChatRequest(BaseModel):
     message: str
     user_id: str = "anon"
     character: str = "Bilge Logvian"
     verbosity: str = "normal"  # "short" | "normal" | "detailed"
+    speculative: Optional[str] = None  # "off" | "ngram" | "draft"; boşsa SPECULATIVE_MODE
 
 @app.on_event("startup")
 def startup():
@@ -38,31 +85,106 @@ def startup():
         dtype = torch.float16 if torch.cuda.is_available() else torch.float32
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        print(f"LLM yükleniyor: {MODEL_NAME} (device={device}, dtype={dtype})")
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+        converted = bool(CONVERTED_MODEL_DIR) and is_converted(CONVERTED_MODEL_DIR)
+        source = CONVERTED_MODEL_DIR if converted else MODEL_NAME
+
+        print(f"LLM yükleniyor: {source} (device={device}, mmap={converted})")
+        tokenizer = AutoTokenizer.from_pretrained(source, use_fast=True)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
 
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
-            torch_dtype=dtype if device == "cuda" else torch.float32,
-            device_map="auto" if torch.cuda.is_available() else None
-        )
+        if converted:
+            # Dönüştürülmüş ağırlıklar zaten hedef dtype'ta; kopyalanmadan mmap edilir
+            model = load_converted(CONVERTED_MODEL_DIR, device, trust_remote_code=TRUST_REMOTE_CODE)
+        else:
+            if CONVERTED_MODEL_DIR:
+                print(f"⚠️ {CONVERTED_MODEL_DIR} içinde dönüştürülmüş model yok; {MODEL_NAME} kullanılıyor.")
+            model = AutoModelForCausalLM.from_pretrained(
+                MODEL_NAME,
+                torch_dtype=dtype if device == "cuda" else torch.float32,
+                device_map="auto" if torch.cuda.is_available() else None,
+                trust_remote_code=TRUST_REMOTE_CODE
+            )
 
+        quantization = "none"
         if device == "cpu":
             model.to("cpu")
+            model, quantization = quantize_model(model, LLM_QUANTIZE)
+        elif LLM_QUANTIZE != "none":
+            print("⚠️ LLM_QUANTIZE yalnızca CPU'da uygulanır; GPU'da yok sayıldı.")
+        model.eval()
+
+        draft_model = None
+        if DRAFT_MODEL_NAME:
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                DRAFT_MODEL_NAME,
+                torch_dtype=dtype if device == "cuda" else torch.float32,
+                trust_remote_code=TRUST_REMOTE_CODE
+            ).to(model.device).eval()
+            print(f"✅ Taslak model yüklendi: {DRAFT_MODEL_NAME}")
+
+        eos_ids = model.generation_config.eos_token_id
+        eos_ids = set(eos_ids if isinstance(eos_ids, list) else [eos_ids]) | {tokenizer.eos_token_id}
+        scheduler = BatchScheduler(
+            model,
+            eos_token_ids={i for i in eos_ids if i is not None},
+            pad_token_id=tokenizer.pad_token_id,
+            max_batch_size=MAX_BATCH_SIZE,
+            prefix_cache_size=PREFIX_CACHE_SIZE,
+            draft_model=draft_model,
+            num_speculative_tokens=NUM_SPECULATIVE_TOKENS
+        )
+        scheduler.start()
+
+        grammar = None
+        if JSON_CONSTRAINT:
+            grammar = JsonSchemaGrammar(
+                tokenizer,
+                vocab_size=model.config.vocab_size,
+                eos_token_ids=scheduler.eos_token_ids,
+                device=model.device
+            )
+            print(f"🧩 JSON gramer maskeleri hazır ({len(grammar.masks)} durum, {grammar.build_seconds}s)")
+        texts = grammar.texts if grammar is not None else token_texts(tokenizer, model.config.vocab_size)
 
         LOCAL.update({
             "loaded": True,
             "tokenizer": tokenizer,
             "model": model,
-            "device": device
+            "device": device,
+            "scheduler": scheduler,
+            "grammar": grammar,
+            "token_texts": texts,
+            "quantization": quantization
         })
-        print("✅ LLM yüklendi:", MODEL_NAME)
+        # Dönüştürülmüş modelin dtype'ı (ör. CPU'da fp16) istenen varsayılandan farklı olabilir
+        print(f"✅ LLM yüklendi: {source} (dtype={model.dtype}, quantization={quantization}, {memory_report(model)})")
     except Exception as e:
         print("⚠️ LLM yüklenirken hata:", e)
         LOCAL["loaded"] = False
 
+@app.on_event("shutdown")
+def shutdown():
+    if LOCAL["scheduler"] is not None:
+        LOCAL["scheduler"].stop()
+
+@app.get("/health")
+def health():
+    return {
+        "loaded": LOCAL["loaded"],
+        "model": MODEL_NAME,
+        "device": LOCAL["device"],
+        "quantization": LOCAL["quantization"],
+        "memory": memory_report(LOCAL["model"]) if LOCAL["model"] is not None else None,
+        "json_constraint": LOCAL["grammar"] is not None,
+        "admission": ADMISSION.snapshot(),
+        "budget": BUDGET_STATS,
+        "usage": USAGE_STATS,
+        "scheduler": LOCAL["scheduler"].snapshot() if LOCAL["scheduler"] else None
+    }
+
+QUESTION_MARKER = 'Kullanıcının sorusu: "'
+
 def build_prompt(character: str, message: str, verbosity: str = "normal") -> str:
     return f"""
 Sen "{character}" adında deneyimli bir siber güvenlik öğretmenisin (Bilge Logvian).
@@ -85,7 +207,90 @@ Kullanıcının sorusu: "{message}"
 Şimdi sadece JSON üret.
 """.strip()
 
+@functools.lru_cache(maxsize=64)
+def prefix_token_ids(prefix: str) -> Tuple[int, ...]:
+    return tuple(LOCAL["tokenizer"](prefix)["input_ids"])
+
+def encode_prompt(character: str, message: str, verbosity: str = "normal"):
+    """Prompt'u (sabit önek, soru) token'larına ayır.
+
+    Önek yalnızca character ve verbosity'ye bağlıdır; zamanlayıcı KV cache'ini bir kez
+    hesaplayıp saklar, her istekte sadece sorunun geçtiği son kısım prefill edilir.
+    """
+    tokenizer = LOCAL["tokenizer"]
+    prompt = build_prompt(character, message, verbosity)
+    split = prompt.index(QUESTION_MARKER) + len(QUESTION_MARKER)
+    # Prompt bir kez bütün olarak token'lanır ve id listesi önek uzunluğundan bölünür; soruyu
+    # ayrı token'lamak başına fazladan "▁" ekler ve model önbelleksiz yoldan farklı bir prompt görür
+    full_ids = tokenizer(prompt)["input_ids"]
+    prefix_ids = list(prefix_token_ids(prompt[:split]))
+    if full_ids[:len(prefix_ids)] != prefix_ids:
+        # Önek sınırında token'lar birleşti; bu istek önbelleksiz, tam prompt ile çalışır
+        return [], full_ids
+    return prefix_ids, full_ids[len(prefix_ids):]
+
+async def admit(req: ChatRequest):
+    """İsteği kabul kuyruğundan geçir; yer yoksa 429/503 + Retry-After"""
+    try:
+        return await ADMISSION.acquire(req.user_id, priority_tier(req.verbosity))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+
+def resolve_speculative(req: ChatRequest) -> Optional[str]:
+    try:
+        return LOCAL["scheduler"].speculative_mode(req.speculative or SPECULATIVE_MODE)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def generation_budget(verbosity: str):
+    return VERBOSITY_BUDGETS.get(verbosity, VERBOSITY_BUDGETS["normal"])
+
+def new_constraint(budget):
+    """Gramer açıksa bütçeye duyarlı JSON kısıtı; değilse yalnızca JSON kapanınca durduran kriter"""
+    grammar = LOCAL["grammar"]
+    if grammar is not None:
+        return grammar.new_constraint(budget["max_new_tokens"], budget["answer_sentences"])
+    return JsonCloseStop(LOCAL["token_texts"], LOCAL["scheduler"].eos_token_ids)
+
+def usage_report(prefix_ids, prompt_ids, completion_tokens: int):
+    """Token kullanımı; cached_prompt_tokens önek KV cache'inden gelen (prefill edilmeyen) kısım"""
+    usage = {
+        "prompt_tokens": len(prefix_ids) + len(prompt_ids),
+        "cached_prompt_tokens": len(prefix_ids),
+        "completion_tokens": completion_tokens,
+        "total_tokens": len(prefix_ids) + len(prompt_ids) + completion_tokens
+    }
+    USAGE_STATS["requests"] += 1
+    for key in ("prompt_tokens", "cached_prompt_tokens", "completion_tokens"):
+        USAGE_STATS[key] += usage[key]
+    return usage
+
+def budget_report(verbosity: str, budget, generated: int, constraint):
+    """İsteğin token bütçesi kullanımı; tasarruf eski sabit MAX_NEW_TOKENS sınırına göre"""
+    if constraint.closed:
+        reason = "json_closed"
+    elif generated >= budget["max_new_tokens"]:
+        reason = "length"
+    else:
+        reason = "eos"
+    saved = max(0, MAX_NEW_TOKENS - generated)
+
+    BUDGET_STATS["requests"] += 1
+    BUDGET_STATS["generated_tokens"] += generated
+    BUDGET_STATS["tokens_saved"] += saved
+    BUDGET_STATS["stop_reasons"][reason] = BUDGET_STATS["stop_reasons"].get(reason, 0) + 1
+    return {
+        "verbosity": verbosity,
+        "max_new_tokens": budget["max_new_tokens"],
+        "generated_tokens": generated,
+        "tokens_saved": saved,
+        "stop_reason": reason
+    }
+
 def try_parse_json(text: str):
+    # JSON kısıtı açıkken ilk json.loads başarılı olur; diğer adımlar kısıt kapalıyken
+    # ya da token bütçesi JSON kapanmadan bittiğinde devreye girer
     text_stripped = text.strip()
     try:
         return json.loads(text_stripped)
@@ -107,56 +312,26 @@ def try_parse_json(text: str):
                 return None
     return None
 
-@app.post("/chat")
-def chat(req: ChatRequest):
-    if not LOCAL["loaded"]:
-        raise HTTPException(status_code=503, detail="LLM yüklenmedi veya yükleme başarısız oldu.")
-
-    tokenizer = LOCAL["tokenizer"]
-    model = LOCAL["model"]
-
-    prompt = build_prompt(req.character, req.message, req.verbosity)
-
-    inputs = tokenizer(prompt, return_tensors="pt", truncation=True)
-    try:
-        inputs = {k: v.to(model.device) for k, v in inputs.items()}
-    except Exception:
-        inputs = {k: v.to("cpu") for k, v in inputs.items()}
-
-    try:
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=MAX_NEW_TOKENS,
-            temperature=TEMPERATURE,
-            top_p=TOP_P,
-            do_sample=True,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.pad_token_id
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Model üretim hatası: {e}")
-
-    raw = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    raw_after = raw.split(prompt, 1)[-1].strip() if prompt in raw else raw.strip()
+def ensure_list(v):
+    if v is None:
+        return []
+    if isinstance(v, list):
+        return v
+    if isinstance(v, str):
+        items = [ln.strip("-• \t") for ln in v.splitlines() if ln.strip()]
+        return items if len(items) > 1 else [v.strip()]
+    return [str(v)]
 
+def format_response(raw_after: str):
+    """Model çıktısını /chat ve /chat/stream'in ortak yanıt biçimine çevir"""
     parsed = try_parse_json(raw_after)
     if parsed:
-        def ensure_list(v):
-            if v is None:
-                return []
-            if isinstance(v, list):
-                return v
-            if isinstance(v, str):
-                items = [ln.strip("-• \t") for ln in v.splitlines() if ln.strip()]
-                return items if len(items) > 1 else [v.strip()]
-            return [str(v)]
-
         return {
-            "theory": str(parsed.get("theory", "")),
-            "answer": str(parsed.get("answer", "")),
+            "theory": str(parsed.get("theory", "")).strip(),
+            "answer": str(parsed.get("answer", "")).strip(),
             "homework": ensure_list(parsed.get("homework", [])),
             "lab": ensure_list(parsed.get("lab", [])),
-            "notes": str(parsed.get("notes", "")),
+            "notes": str(parsed.get("notes", "")).strip(),
             "raw_model_text": raw_after
         }
 
@@ -168,3 +343,106 @@ def chat(req: ChatRequest):
         "notes": "⚠️ Model çıktısı JSON parse edilemedi; ham metin 'answer' alanında.",
         "raw_model_text": raw_after
     }
+
+@app.post("/chat")
+async def chat(req: ChatRequest):
+    if not LOCAL["loaded"]:
+        raise HTTPException(status_code=503, detail="LLM yüklenmedi veya yükleme başarısız oldu.")
+
+    tokenizer = LOCAL["tokenizer"]
+
+    prefix_ids, prompt_ids = encode_prompt(req.character, req.message, req.verbosity)
+    speculative = resolve_speculative(req)
+    budget = generation_budget(req.verbosity)
+    constraint = new_constraint(budget)
+    ticket = await admit(req)
+
+    # Eşzamanlı istekler zamanlayıcıda ortak batch'lerde üretilir
+    try:
+        generated_ids = await LOCAL["scheduler"].submit(
+            prompt_ids,
+            max_new_tokens=budget["max_new_tokens"],
+            temperature=TEMPERATURE,
+            top_p=TOP_P,
+            prefix_ids=prefix_ids,
+            constraint=constraint,
+            speculative=speculative
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model üretim hatası: {e}")
+    finally:
+        ADMISSION.release(ticket)
+
+    # Yalnızca üretilen token'lar decode edilir; prompt metni hiç yeniden oluşturulmaz
+    raw = tokenizer.decode(generated_ids, skip_special_tokens=True)
+    raw_after = raw.strip()
+
+    return {
+        **format_response(raw_after),
+        "budget": budget_report(req.verbosity, budget, len(generated_ids), constraint),
+        "usage": usage_report(prefix_ids, prompt_ids, len(generated_ids))
+    }
+
+def ndjson(payload) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    """Yanıtı satır satır JSON (NDJSON) olarak akıt.
+
+    Her satır bir olaydır: ``token`` ham metin parçası, ``delta`` bir bölümün
+    (theory/answer/homework/lab/notes) yeni içeriği, ``section_end`` bölüm kapandı,
+    ``done`` /chat ile aynı biçimdeki son yanıt, ``error`` üretim hatası.
+    """
+    if not LOCAL["loaded"]:
+        raise HTTPException(status_code=503, detail="LLM yüklenmedi veya yükleme başarısız oldu.")
+
+    tokenizer = LOCAL["tokenizer"]
+    prefix_ids, prompt_ids = encode_prompt(req.character, req.message, req.verbosity)
+    speculative = resolve_speculative(req)
+    budget = generation_budget(req.verbosity)
+    constraint = new_constraint(budget)
+    ticket = await admit(req)
+
+    async def events():
+        decoder = IncrementalDecoder(tokenizer)
+        parser = JsonSectionParser()
+        pieces = []
+        generated = 0
+        try:
+            async for token in LOCAL["scheduler"].stream(
+                prompt_ids,
+                max_new_tokens=budget["max_new_tokens"],
+                temperature=TEMPERATURE,
+                top_p=TOP_P,
+                prefix_ids=prefix_ids,
+                constraint=constraint,
+                speculative=speculative
+            ):
+                generated += 1
+                text = decoder.push(token)
+                if not text:
+                    continue
+                pieces.append(text)
+                yield ndjson({"event": "token", "text": text})
+                for event in parser.feed(text):
+                    yield ndjson(event)
+                # İstemci bağlantıyı kapattıysa üretimi durdur (generator kapanınca istek iptal edilir)
+                if await request.is_disconnected():
+                    return
+        except Exception as e:
+            yield ndjson({"event": "error", "detail": f"Model üretim hatası: {e}"})
+            return
+        finally:
+            ADMISSION.release(ticket)
+
+        yield ndjson({
+            "event": "done",
+            **format_response("".join(pieces).strip()),
+            "budget": budget_report(req.verbosity, budget, generated, constraint),
+            "usage": usage_report(prefix_ids, prompt_ids, generated)
+        })
+
+    # Generator hiç başlamadan bağlantı koparsa yer arka plan görevinde boşaltılır
+    return StreamingResponse(events(), media_type="application/x-ndjson",
+                             background=BackgroundTask(ADMISSION.release, ticket))
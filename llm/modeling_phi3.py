@@ -15,10 +15,11 @@
 
 """ PyTorch Phi-3 model."""
 
+import heapq
 import inspect
 import math
 import warnings
-from typing import List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -108,38 +109,86 @@ def _get_unpad_data(attention_mask):
     )
 
 
-# Copied from transformers.models.gemma.modeling_gemma.GemmaRotaryEmbedding with gemma->phi3, Gemma->Phi3
+# Adapted from transformers.models.gemma.modeling_gemma.GemmaRotaryEmbedding with gemma->phi3, Gemma->Phi3
 class Phi3RotaryEmbedding(nn.Module):
+    """
+    Rotary embedding backed by precomputed cos/sin tables. The tables are built once (up to
+    `max_position_embeddings`, grown on demand) per dtype/device and every call is a gather by `position_ids`.
+    `Phi3Model` shares a single instance across all decoder layers.
+    """
+
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
         super().__init__()
 
         self.dim = dim
         self.max_position_embeddings = max_position_embeddings
         self.base = base
+        self.scaling_factor = 1.0
         self.register_buffer("inv_freq", None, persistent=False)
+        # (regime, dtype, device) -> (cos, sin), each of shape [table_len, dim]; plain attributes so they stay out of
+        # the state dict and are rebuilt lazily on whatever device the model ends up on
+        self._tables = {}
 
-    @torch.no_grad()
-    def forward(self, x, position_ids, seq_len=None):
-        # x: [bs, num_attention_heads, seq_len, head_size]
-        if self.inv_freq is None:
+    def _regime(self, seq_len):
+        return "default"
+
+    def _real_seq_len(self, position_ids, seq_len):
+        """`seq_len` is a host-side upper bound on the positions (past + current width, padding included)."""
+        if seq_len is None:
+            return int(position_ids.max()) + 1
+        return seq_len
+
+    def _table_len(self, regime):
+        return self.max_position_embeddings
+
+    def _inv_freq(self, regime, device):
+        if self.inv_freq is None or self.inv_freq.device != device:
             self.inv_freq = 1.0 / (
-                self.base ** (torch.arange(0, self.dim, 2, dtype=torch.int64, device=x.device).float() / self.dim)
+                self.base ** (torch.arange(0, self.dim, 2, dtype=torch.int64, device=device).float() / self.dim)
             )
-        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
-        position_ids_expanded = position_ids[:, None, :].float()
+        return self.inv_freq
+
+    def _build_table(self, length, inv_freq, device):
+        positions = torch.arange(length, dtype=torch.int64, device=device).float()
         # Force float32 since bfloat16 loses precision on long contexts
         # See https://github.com/huggingface/transformers/pull/29285
-        device_type = x.device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
+        device_type = device.type if device.type != "mps" else "cpu"
         with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
+            freqs = torch.outer(positions, inv_freq.float())
             emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos()
-            sin = emb.sin()
-        return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
+            return emb.cos() * self.scaling_factor, emb.sin() * self.scaling_factor
+
+    @torch.no_grad()
+    def table(self, seq_len, dtype, device):
+        """Returns the (cos, sin) tables for a sequence of `seq_len` positions, covering at least `seq_len` rows."""
+        regime = self._regime(seq_len)
+        key = (regime, dtype, device)
+        cached = self._tables.get(key)
+        if cached is None or cached[0].shape[0] < seq_len:
+            length = max(seq_len, self._table_len(regime))
+            cos, sin = self._build_table(length, self._inv_freq(regime, device), device)
+            cached = self._tables[key] = (cos.to(dtype=dtype), sin.to(dtype=dtype))
+        return cached
+
+    @torch.no_grad()
+    def forward(self, x, position_ids, seq_len=None, real_seq_len=None):
+        # x: [bs, num_attention_heads, seq_len, head_size]
+        # `real_seq_len` is the longest unpadded sequence (past + current) when the caller knows it; otherwise it is
+        # derived from the padded `seq_len`, syncing on position_ids only when that is not enough
+        if real_seq_len is None:
+            real_seq_len = self._real_seq_len(position_ids, seq_len)
+        cos, sin = self.table(real_seq_len, x.dtype, x.device)
+        return cos[position_ids], sin[position_ids]
 
 
 class Phi3LongRoPEScaledRotaryEmbedding(Phi3RotaryEmbedding):
+    """
+    LongRoPE: `short_factor` frequencies while the sequence fits in `original_max_position_embeddings`,
+    `long_factor` beyond it. Both regimes get their own table with the attention scaling factor folded in. The regime
+    follows the largest real position in the batch, as in the original implementation: left padding must not switch
+    a batch to the long factors.
+    """
+
     def __init__(self, dim, config, device=None):
         super().__init__(dim, config.max_position_embeddings, config.rope_theta, device)
 
@@ -147,37 +196,30 @@ class Phi3LongRoPEScaledRotaryEmbedding(Phi3RotaryEmbedding):
         self.long_factor = config.rope_scaling["long_factor"]
         self.original_max_position_embeddings = config.original_max_position_embeddings
 
-    @torch.no_grad()
-    def forward(self, x, position_ids, seq_len=None):
-        seq_len = torch.max(position_ids) + 1
-        if seq_len > self.original_max_position_embeddings:
-            ext_factors = torch.tensor(self.long_factor, dtype=torch.float32, device=x.device)
-        else:
-            ext_factors = torch.tensor(self.short_factor, dtype=torch.float32, device=x.device)
+        scale = self.max_position_embeddings / self.original_max_position_embeddings
+        if scale > 1.0:
+            self.scaling_factor = math.sqrt(1 + math.log(scale) / math.log(self.original_max_position_embeddings))
 
-        inv_freq_shape = torch.arange(0, self.dim, 2, dtype=torch.int64, device=x.device).float() / self.dim
-        self.inv_freq = 1.0 / (ext_factors * self.base**inv_freq_shape)
+    def _regime(self, seq_len):
+        return "long" if seq_len > self.original_max_position_embeddings else "short"
 
-        inv_freq_expanded = self.inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
-        position_ids_expanded = position_ids[:, None, :].float()
+    def _real_seq_len(self, position_ids, seq_len):
+        # A padded batch can be wider than the original context while all of its real positions still fit in it, so
+        # past the threshold the regime comes from the largest position id (one device sync)
+        if seq_len is None or seq_len > self.original_max_position_embeddings:
+            return int(position_ids.max()) + 1
+        return seq_len
 
-        # Force float32 since bfloat16 loses precision on long contexts
-        # See https://github.com/huggingface/transformers/pull/29285
-        device_type = x.device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
-        with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(1, 2)
-            emb = torch.cat((freqs, freqs), dim=-1)
-
-            scale = self.max_position_embeddings / self.original_max_position_embeddings
-            if scale <= 1.0:
-                scaling_factor = 1.0
-            else:
-                scaling_factor = math.sqrt(1 + math.log(scale) / math.log(self.original_max_position_embeddings))
+    def _table_len(self, regime):
+        if regime == "short":
+            return self.original_max_position_embeddings
+        return self.max_position_embeddings
 
-            cos = emb.cos() * scaling_factor
-            sin = emb.sin() * scaling_factor
-        return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
+    def _inv_freq(self, regime, device):
+        factors = self.long_factor if regime == "long" else self.short_factor
+        ext_factors = torch.tensor(factors, dtype=torch.float32, device=device)
+        inv_freq_shape = torch.arange(0, self.dim, 2, dtype=torch.int64, device=device).float() / self.dim
+        return 1.0 / (ext_factors * self.base**inv_freq_shape)
 
 
 # Copied from transformers.models.llama.modeling_llama.rotate_half
@@ -285,6 +327,16 @@ class Phi3Attention(nn.Module):
         self.qkv_proj = nn.Linear(self.hidden_size, op_size, bias=False)
         self._init_rope()
 
+    def _group_queries(self, query_states):
+        """
+        Grouped-query attention without `repeat_kv`: the query heads that share a key/value head are stacked as extra
+        rows, `(bsz, num_heads, q_len, head_dim) -> (bsz, num_key_value_heads, groups * q_len, head_dim)`, so scores
+        are computed against the unexpanded cache. Results with `num_key_value_heads` leading heads can be viewed back
+        as `(bsz, num_heads, q_len, ...)`.
+        """
+        bsz, _, q_len, _ = query_states.shape
+        return query_states.reshape(bsz, self.num_key_value_heads, self.num_key_value_groups * q_len, self.head_dim)
+
     def _init_rope(self):
         if self.rope_scaling is None:
             self.rotary_emb = Phi3RotaryEmbedding(
@@ -307,6 +359,7 @@ class Phi3Attention(nn.Module):
         past_key_value: Optional[Cache] = None,
         output_attentions: bool = False,
         use_cache: bool = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         logger.warning_once("You are not running the flash-attention implementation, expect numerical differences.")
 
@@ -331,7 +384,10 @@ class Phi3Attention(nn.Module):
                     "with a layer index."
                 )
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
-        cos, sin = self.rotary_emb(value_states, position_ids, seq_len=kv_seq_len)
+        if position_embeddings is not None:
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids, seq_len=kv_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
@@ -339,11 +395,10 @@ class Phi3Attention(nn.Module):
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
+        # k/v heads stay unexpanded when n_kv_heads < n_heads
+        query_states = self._group_queries(query_states)
         attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = attn_weights.view(bsz, self.num_heads, q_len, kv_seq_len)
 
         if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
             raise ValueError(
@@ -362,7 +417,11 @@ class Phi3Attention(nn.Module):
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(value_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
 
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = torch.matmul(
+            attn_weights.view(bsz, self.num_key_value_heads, self.num_key_value_groups * q_len, kv_seq_len),
+            value_states,
+        )
+        attn_output = attn_output.view(bsz, self.num_heads, q_len, self.head_dim)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -405,6 +464,7 @@ class Phi3FlashAttention2(Phi3Attention):
         past_key_value: Optional[Cache] = None,
         output_attentions: bool = False,
         use_cache: bool = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         # Phi3FlashAttention2 attention does not support output_attentions
@@ -450,9 +510,12 @@ class Phi3FlashAttention2(Phi3Attention):
                 )
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
 
-        # Because the input can be padded, the absolute sequence length depends on the max position id.
-        rotary_seq_len = max(kv_seq_len, position_ids[:, -1].max().item()) + 1
-        cos, sin = self.rotary_emb(value_states, position_ids, seq_len=rotary_seq_len)
+        if position_embeddings is not None:
+            cos, sin = position_embeddings
+        else:
+            # Because the input can be padded, the absolute sequence length depends on the max position id.
+            rotary_seq_len = max(kv_seq_len, position_ids[:, -1].max().item()) + 1
+            cos, sin = self.rotary_emb(value_states, position_ids, seq_len=rotary_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
@@ -491,9 +554,7 @@ class Phi3FlashAttention2(Phi3Attention):
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # flash-attn handles n_kv_heads < n_heads natively, so k/v are passed unexpanded
 
         attn_dropout = self.attention_dropout if self.training else 0.0
 
@@ -648,7 +709,7 @@ class Phi3FlashAttention2(Phi3Attention):
 
     # Copied from transformers.models.mistral.modeling_mistral.MistralFlashAttention2._upad_input
     def _upad_input(self, query_layer, key_layer, value_layer, attention_mask, query_length):
-        batch_size, kv_seq_len, num_heads, head_dim = key_layer.shape
+        batch_size, kv_seq_len, num_key_value_heads, head_dim = key_layer.shape
 
         # On the first iteration we need to properly re-create the padding mask
         # by slicing it on the proper place
@@ -658,12 +719,16 @@ class Phi3FlashAttention2(Phi3Attention):
 
         indices_k, cu_seqlens_k, max_seqlen_in_batch_k = _get_unpad_data(attention_mask)
 
-        key_layer = index_first_axis(key_layer.reshape(batch_size * kv_seq_len, num_heads, head_dim), indices_k)
-        value_layer = index_first_axis(value_layer.reshape(batch_size * kv_seq_len, num_heads, head_dim), indices_k)
+        key_layer = index_first_axis(
+            key_layer.reshape(batch_size * kv_seq_len, num_key_value_heads, head_dim), indices_k
+        )
+        value_layer = index_first_axis(
+            value_layer.reshape(batch_size * kv_seq_len, num_key_value_heads, head_dim), indices_k
+        )
 
         if query_length == kv_seq_len:
             query_layer = index_first_axis(
-                query_layer.reshape(batch_size * kv_seq_len, num_heads, head_dim), indices_k
+                query_layer.reshape(batch_size * kv_seq_len, self.num_heads, head_dim), indices_k
             )
             cu_seqlens_q = cu_seqlens_k
             max_seqlen_in_batch_q = max_seqlen_in_batch_k
@@ -708,6 +773,7 @@ class Phi3SdpaAttention(Phi3Attention):
         past_key_value: Optional[Cache] = None,
         output_attentions: bool = False,
         use_cache: bool = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if output_attentions:
             # TODO: Improve this warning with e.g. `model.config.attn_implementation = "manual"` once this is implemented.
@@ -722,6 +788,7 @@ class Phi3SdpaAttention(Phi3Attention):
                 past_key_value=past_key_value,
                 output_attentions=output_attentions,
                 use_cache=use_cache,
+                position_embeddings=position_embeddings,
             )
 
         bsz, q_len, _ = hidden_states.size()
@@ -739,7 +806,10 @@ class Phi3SdpaAttention(Phi3Attention):
         kv_seq_len = key_states.shape[-2]
         if past_key_value is not None:
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
-        cos, sin = self.rotary_emb(value_states, position_ids, seq_len=kv_seq_len)
+        if position_embeddings is not None:
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids, seq_len=kv_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
@@ -747,15 +817,22 @@ class Phi3SdpaAttention(Phi3Attention):
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
         if attention_mask is not None:
             if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
                 raise ValueError(
                     f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
                 )
 
+        if self.num_key_value_groups > 1:
+            # k/v heads stay unexpanded; the grouped query rows need the mask repeated per group (a single decode
+            # row broadcasts as is) and an explicit causal mask instead of `is_causal`
+            query_states = self._group_queries(query_states)
+            if attention_mask is None and q_len > 1:
+                attention_mask = torch.ones(q_len, kv_seq_len, dtype=torch.bool, device=query_states.device)
+                attention_mask = attention_mask.tril(kv_seq_len - q_len)[None, None]
+            if attention_mask is not None and q_len > 1:
+                attention_mask = attention_mask.repeat(1, 1, self.num_key_value_groups, 1)
+
         # SDPA with memory-efficient backend is currently (torch==2.1.2) bugged with non-contiguous inputs with custom attn_mask,
         # Reference: https://github.com/pytorch/pytorch/issues/112577.
         if query_states.device.type == "cuda" and attention_mask is not None:
@@ -773,6 +850,7 @@ class Phi3SdpaAttention(Phi3Attention):
             is_causal=self.is_causal and attention_mask is None and q_len > 1,
         )
 
+        attn_output = attn_output.view(bsz, self.num_heads, q_len, self.head_dim)
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.view(bsz, q_len, self.hidden_size)
 
@@ -810,6 +888,7 @@ class Phi3DecoderLayer(nn.Module):
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         if "padding_mask" in kwargs:
@@ -832,6 +911,9 @@ class Phi3DecoderLayer(nn.Module):
                 If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding
                 (see `past_key_values`).
             past_key_value (`Tuple(torch.FloatTensor)`, *optional*): cached past key and value projection states
+            position_embeddings (`Tuple(torch.FloatTensor)`, *optional*):
+                precomputed `(cos, sin)` rotary embeddings of shape `(batch, seq_len, head_dim)`; computed by the
+                attention module from `position_ids` when not given
         """
 
         residual = hidden_states
@@ -846,6 +928,7 @@ class Phi3DecoderLayer(nn.Module):
             past_key_value=past_key_value,
             output_attentions=output_attentions,
             use_cache=use_cache,
+            position_embeddings=position_embeddings,
         )
 
         hidden_states = residual + self.resid_attn_dropout(attn_outputs)
@@ -978,6 +1061,11 @@ PHI3_INPUTS_DOCSTRING = r"""
             more detail.
         return_dict (`bool`, *optional*):
             Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+        real_seq_len (`int`, *optional*):
+            Length (past plus current tokens, padding excluded) of the longest sequence in the batch, i.e. the largest
+            position id plus one. LongRoPE picks its short/long factors from it; callers that track lengths on the host
+            (e.g. a batching scheduler) pass it to avoid a device sync once a padded batch is wider than
+            `config.original_max_position_embeddings`.
 """
 
 
@@ -1003,6 +1091,10 @@ class Phi3Model(Phi3PreTrainedModel):
         self.layers = nn.ModuleList(
             [Phi3DecoderLayer(config, layer_idx) for layer_idx in range(config.num_hidden_layers)]
         )
+        # One rotary embedding (and one set of cos/sin tables) shared by every decoder layer
+        self.rotary_emb = self.layers[0].self_attn.rotary_emb
+        for layer in self.layers[1:]:
+            layer.self_attn.rotary_emb = self.rotary_emb
         self._attn_implementation = config._attn_implementation
         self.norm = Phi3RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
@@ -1028,6 +1120,7 @@ class Phi3Model(Phi3PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        real_seq_len: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1068,6 +1161,8 @@ class Phi3Model(Phi3PreTrainedModel):
                 past_key_values_length, seq_length + past_key_values_length, dtype=torch.long, device=device
             )
             position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
+            if real_seq_len is None:
+                real_seq_len = seq_length + past_key_values_length
         else:
             position_ids = position_ids.view(-1, seq_length).long()
 
@@ -1097,6 +1192,10 @@ class Phi3Model(Phi3PreTrainedModel):
             )
 
         hidden_states = inputs_embeds
+        # cos/sin are gathered once per forward and reused by all layers
+        position_embeddings = self.rotary_emb(
+            hidden_states, position_ids, seq_len=past_key_values_length + seq_length, real_seq_len=real_seq_len
+        )
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
@@ -1116,6 +1215,7 @@ class Phi3Model(Phi3PreTrainedModel):
                     past_key_values,
                     output_attentions,
                     use_cache,
+                    position_embeddings,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -1125,6 +1225,7 @@ class Phi3Model(Phi3PreTrainedModel):
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    position_embeddings=position_embeddings,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1154,6 +1255,322 @@ class Phi3Model(Phi3PreTrainedModel):
         )
 
 
+class Phi3StaticCache(Cache):
+    """
+    Preallocated KV cache: one fixed-capacity key and value tensor per layer of shape
+    `(batch_size, num_key_value_heads, max_cache_len, head_dim)`. New states are written in place and attention reads
+    a view of the filled prefix, so decoding does no `torch.cat` and no reallocation. The filled length is tracked on
+    the host, so querying it never syncs with the device.
+
+    Parameters:
+        config (`Phi3Config`):
+            The model configuration (layer count, kv heads and head size).
+        batch_size (`int`):
+            The batch size the cache is allocated for (reallocated once if the first update has another batch size).
+        max_cache_len (`int`):
+            Capacity in tokens, typically `prompt_len + max_new_tokens`.
+        device (`torch.device`):
+            The device to allocate the cache on.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            The dtype of the cached states.
+    """
+
+    def __init__(self, config: Phi3Config, batch_size: int, max_cache_len: int, device=None, dtype=None) -> None:
+        super().__init__()
+        self.batch_size = batch_size
+        self.max_cache_len = max_cache_len
+        head_dim = config.hidden_size // config.num_attention_heads
+        cache_shape = (batch_size, config.num_key_value_heads, max_cache_len, head_dim)
+        dtype = dtype if dtype is not None else torch.float32
+
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        for _ in range(config.num_hidden_layers):
+            self.key_cache.append(torch.zeros(cache_shape, dtype=dtype, device=device))
+            self.value_cache.append(torch.zeros(cache_shape, dtype=dtype, device=device))
+        self._lengths = [0] * config.num_hidden_layers
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        length = self._lengths[layer_idx]
+        return self.key_cache[layer_idx][:, :, :length], self.value_cache[layer_idx][:, :, :length]
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        start = self._lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        if start == 0 and self.key_cache[layer_idx].shape[0] != key_states.shape[0]:
+            # The batch can only change before anything is cached, e.g. beam search expanding the inputs
+            cache_shape = (key_states.shape[0],) + self.key_cache[layer_idx].shape[1:]
+            self.key_cache[layer_idx] = key_states.new_zeros(cache_shape)
+            self.value_cache[layer_idx] = value_states.new_zeros(cache_shape)
+        if end > self.max_cache_len:
+            raise ValueError(
+                f"Phi3StaticCache is full: {end} tokens do not fit in `max_cache_len={self.max_cache_len}`. "
+                "Allocate the cache with room for the prompt and all new tokens."
+            )
+        self.key_cache[layer_idx][:, :, start:end] = key_states
+        self.value_cache[layer_idx][:, :, start:end] = value_states
+        self._lengths[layer_idx] = end
+        return self[layer_idx]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def get_usable_length(self, new_seq_length: int, layer_idx: Optional[int] = 0) -> int:
+        # Nothing is ever evicted; overflowing the capacity raises in `update`
+        return self._lengths[layer_idx]
+
+    @property
+    def seen_tokens(self):
+        return self._lengths[0]
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """Reorders the cache in place for beam search, given the selected beam indices."""
+        for layer_idx in range(len(self)):
+            for cache in (self.key_cache[layer_idx], self.value_cache[layer_idx]):
+                cache.copy_(cache.index_select(0, beam_idx.to(cache.device)))
+
+    def reset(self):
+        """Marks the cache empty so the same buffers can be reused for the next generation."""
+        self._lengths = [0] * len(self)
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        return tuple(self)
+
+
+class Phi3BlockManager:
+    """
+    Paged KV cache: a pool of fixed-size blocks shared by many sequences. Every sequence owns a block table (the list
+    of block ids holding its tokens in order), blocks are handed out on demand as a sequence grows and go back to the
+    pool when it is freed. `fork` lets a sequence start from another one's cached prefix; shared blocks are
+    reference-counted and the partially filled last block is copied on the first write (copy-on-write).
+
+    Block storage has shape `(num_hidden_layers, num_blocks, block_size, num_key_value_heads, head_dim)` for keys and
+    for values. It is created on the first write and grows (doubling, up to `num_blocks`) only when blocks beyond the
+    current size are needed; low block ids are reused first so the pool stays compact.
+
+    Limitations: this is block *storage*, not block-wise attention. Attention reads the cache through
+    `Phi3PagedCache`, which gathers every sequence's blocks into a contiguous tensor on each forward (see there), and
+    `llm_server`'s `BatchScheduler` does not use this manager at all; it keeps its own dense per-batch KV tuples and
+    prefix cache.
+
+    Parameters:
+        config (`Phi3Config`):
+            The model configuration (layer count, kv heads and head size).
+        num_blocks (`int`):
+            Maximum number of blocks in the pool.
+        block_size (`int`, *optional*, defaults to 16):
+            Tokens per block.
+        device (`torch.device`, *optional*):
+            Device of the block storage; defaults to the device of the first written states.
+        dtype (`torch.dtype`, *optional*):
+            Dtype of the block storage; defaults to the dtype of the first written states.
+    """
+
+    def __init__(self, config: Phi3Config, num_blocks: int, block_size: int = 16, device=None, dtype=None) -> None:
+        self.num_layers = config.num_hidden_layers
+        self.num_key_value_heads = config.num_key_value_heads
+        self.head_dim = config.hidden_size // config.num_attention_heads
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = device
+        self.dtype = dtype
+
+        self.key_blocks: Optional[torch.Tensor] = None
+        self.value_blocks: Optional[torch.Tensor] = None
+        self._free_blocks = list(range(num_blocks))  # min-heap of free block ids
+        self._ref_counts = [0] * num_blocks
+        self._block_tables: Dict[int, List[int]] = {}
+        self._lengths: Dict[int, int] = {}
+        self._next_seq_id = 0
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    @property
+    def allocated_blocks(self) -> int:
+        """Number of blocks currently backed by storage."""
+        return 0 if self.key_blocks is None else self.key_blocks.shape[1]
+
+    def new_sequence(self) -> int:
+        seq_id = self._next_seq_id
+        self._next_seq_id += 1
+        self._block_tables[seq_id] = []
+        self._lengths[seq_id] = 0
+        return seq_id
+
+    def fork(self, seq_id: int) -> int:
+        """Starts a new sequence that shares all cached tokens (and blocks) of `seq_id`."""
+        child = self.new_sequence()
+        self._block_tables[child] = list(self._block_tables[seq_id])
+        self._lengths[child] = self._lengths[seq_id]
+        for block in self._block_tables[child]:
+            self._ref_counts[block] += 1
+        return child
+
+    def free(self, seq_id: int):
+        """Releases the sequence; blocks no longer referenced by any sequence go back to the pool."""
+        for block in self._block_tables.pop(seq_id):
+            self._ref_counts[block] -= 1
+            if self._ref_counts[block] == 0:
+                heapq.heappush(self._free_blocks, block)
+        del self._lengths[seq_id]
+
+    def seq_length(self, seq_id: int) -> int:
+        return self._lengths[seq_id]
+
+    def block_table(self, seq_ids: List[int]) -> torch.Tensor:
+        """`(len(seq_ids), max_blocks)` tensor of block ids; shorter tables are padded with block 0."""
+        tables = [self._block_tables[seq_id] for seq_id in seq_ids]
+        width = max(len(table) for table in tables)
+        rows = [table + [0] * (width - len(table)) for table in tables]
+        return torch.tensor(rows, dtype=torch.long, device=self.key_blocks.device)
+
+    def _ensure_storage(self, like: torch.Tensor, num_blocks: int):
+        if self.allocated_blocks >= num_blocks:
+            return
+        size = min(self.num_blocks, max(num_blocks, 2 * self.allocated_blocks))
+        shape = (self.num_layers, size, self.block_size, self.num_key_value_heads, self.head_dim)
+        dtype = self.dtype if self.dtype is not None else like.dtype
+        device = self.device if self.device is not None else like.device
+        key_blocks = torch.zeros(shape, dtype=dtype, device=device)
+        value_blocks = torch.zeros(shape, dtype=dtype, device=device)
+        if self.key_blocks is not None:
+            key_blocks[:, : self.allocated_blocks] = self.key_blocks
+            value_blocks[:, : self.allocated_blocks] = self.value_blocks
+        self.key_blocks, self.value_blocks = key_blocks, value_blocks
+
+    def _allocate_block(self, like: torch.Tensor) -> int:
+        if not self._free_blocks:
+            raise RuntimeError(
+                f"Phi3BlockManager is out of KV blocks ({self.num_blocks} x {self.block_size} tokens); "
+                "free finished sequences or allocate a larger pool."
+            )
+        block = heapq.heappop(self._free_blocks)
+        self._ensure_storage(like, block + 1)
+        self._ref_counts[block] = 1
+        return block
+
+    def reserve(self, seq_id: int, num_tokens: int, like: torch.Tensor) -> List[int]:
+        """Makes room for `num_tokens` new tokens and returns their flat slot ids (`block * block_size + offset`)."""
+        table = self._block_tables[seq_id]
+        start = self._lengths[seq_id]
+        end = start + num_tokens
+
+        last = start // self.block_size
+        if start % self.block_size and self._ref_counts[table[last]] > 1:
+            # The partially filled last block is shared: copy it before writing into it
+            block = self._allocate_block(like)
+            self.key_blocks[:, block] = self.key_blocks[:, table[last]]
+            self.value_blocks[:, block] = self.value_blocks[:, table[last]]
+            self._ref_counts[table[last]] -= 1
+            table[last] = block
+        while len(table) * self.block_size < end:
+            table.append(self._allocate_block(like))
+
+        self._lengths[seq_id] = end
+        return [table[pos // self.block_size] * self.block_size + pos % self.block_size for pos in range(start, end)]
+
+    def write(self, layer_idx: int, slots: torch.Tensor, key_states: torch.Tensor, value_states: torch.Tensor):
+        """Scatters `(batch, kv_heads, q_len, head_dim)` states into the slots returned by `reserve`."""
+        key_flat = self.key_blocks[layer_idx].view(-1, self.num_key_value_heads, self.head_dim)
+        value_flat = self.value_blocks[layer_idx].view(-1, self.num_key_value_heads, self.head_dim)
+        key_flat[slots] = key_states.transpose(1, 2).reshape(-1, self.num_key_value_heads, self.head_dim)
+        value_flat[slots] = value_states.transpose(1, 2).reshape(-1, self.num_key_value_heads, self.head_dim)
+
+    def gather(self, layer_idx: int, block_table: torch.Tensor, length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Reads the first `length` tokens of each row of `block_table` as `(batch, kv_heads, length, head_dim)`."""
+        bsz, width = block_table.shape
+        shape = (bsz, width * self.block_size, self.num_key_value_heads, self.head_dim)
+        key_states = self.key_blocks[layer_idx][block_table].view(shape)[:, :length].transpose(1, 2)
+        value_states = self.value_blocks[layer_idx][block_table].view(shape)[:, :length].transpose(1, 2)
+        return key_states, value_states
+
+    def cache(self, seq_ids: List[int]) -> "Phi3PagedCache":
+        return Phi3PagedCache(self, seq_ids)
+
+
+class Phi3PagedCache(Cache):
+    """
+    `Cache` view over a batch of `Phi3BlockManager` sequences, usable as `past_key_values` in `forward` and
+    `generate`. New states are written into the sequences' blocks and attention reads keys/values through their block
+    tables. Like the other caches every row has the same length; pad prompts as usual for batched inputs.
+
+    Limitations: the attention implementations in this file are the dense ones, so `update` gathers the full cached
+    keys/values of the batch into a contiguous `(batch, num_key_value_heads, length, head_dim)` tensor for every layer
+    on every step. Paging saves memory between steps (shared prefixes, no per-sequence preallocation), but each
+    decode step still copies O(length) states per sequence and layer; it is not a PagedAttention kernel that reads
+    blocks in place, and it is slower per token than `Phi3StaticCache` or `DynamicCache`.
+    """
+
+    def __init__(self, manager: Phi3BlockManager, seq_ids: List[int]) -> None:
+        super().__init__()
+        lengths = {manager.seq_length(seq_id) for seq_id in seq_ids}
+        if len(lengths) != 1:
+            raise ValueError(f"All sequences of a Phi3PagedCache must have the same length, got {sorted(lengths)}.")
+        self.manager = manager
+        self.seq_ids = list(seq_ids)
+        self._lengths = [lengths.pop()] * manager.num_layers
+        self._slots: Optional[torch.Tensor] = None
+        self._block_table: Optional[torch.Tensor] = None
+
+    def __len__(self):
+        return self.manager.num_layers
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_tokens = key_states.shape[-2]
+        if layer_idx == 0:
+            # Blocks are reserved once per forward; the remaining layers write into the same slots
+            slots = []
+            for seq_id in self.seq_ids:
+                slots.extend(self.manager.reserve(seq_id, num_tokens, key_states))
+            self._slots = torch.tensor(slots, dtype=torch.long, device=self.manager.key_blocks.device)
+            self._block_table = self.manager.block_table(self.seq_ids)
+        self._lengths[layer_idx] += num_tokens
+        self.manager.write(layer_idx, self._slots, key_states, value_states)
+        return self.manager.gather(layer_idx, self._block_table, self._lengths[layer_idx])
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    @property
+    def seen_tokens(self):
+        return self._lengths[0]
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor]]:
+        if self._lengths[0] == 0:
+            return ()
+        block_table = self.manager.block_table(self.seq_ids)
+        return tuple(
+            self.manager.gather(layer_idx, block_table, self._lengths[layer_idx]) for layer_idx in range(len(self))
+        )
+
+
 class Phi3ForCausalLM(Phi3PreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
 
@@ -1163,10 +1580,33 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
         self.model = Phi3Model(config)
         self.vocab_size = config.vocab_size
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+        self._static_cache = None
 
         # Initialize weights and apply final processing
         self.post_init()
 
+    def _setup_cache(self, cache_cls, max_batch_size, max_cache_len: Optional[int] = None):
+        """
+        Called by `generate(cache_implementation="static")`. `generation_config.max_length` (prompt length plus
+        `max_new_tokens`) sizes a single `Phi3StaticCache` shared by all layers; the per-layer `cache_cls` from
+        transformers is not used.
+        """
+        max_cache_len = max_cache_len if max_cache_len is not None else self.config.max_position_embeddings
+        self._static_cache = Phi3StaticCache(self.config, max_batch_size, max_cache_len, self.device, self.dtype)
+
+    def _reset_cache(self):
+        self._static_cache = None
+
+    def generate(self, *args, **kwargs):
+        # transformers only calls `_reset_cache` after a successful static generation; if a step raises, the
+        # filled buffers would be picked up by `prepare_inputs_for_generation` on the next call. Drop them on
+        # both ends so every call starts without a cache it did not set up itself.
+        self._reset_cache()
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            self._reset_cache()
+
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM.get_input_embeddings
     def get_input_embeddings(self):
         return self.model.embed_tokens
@@ -1206,6 +1646,7 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        real_seq_len: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1250,6 +1691,7 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            real_seq_len=real_seq_len,
         )
 
         hidden_states = outputs[0]
@@ -1285,6 +1727,10 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
     def prepare_inputs_for_generation(
         self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs
     ):
+        if past_key_values is None and self._static_cache is not None:
+            # First step of a static-cache generation: the prompt is written into the preallocated buffers
+            past_key_values = self._static_cache
+
         if past_key_values is not None:
             if isinstance(past_key_values, Cache):
                 cache_length = past_key_values.get_seq_length()
@@ -1341,6 +1787,9 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
     @staticmethod
     # Copied from transformers.models.llama.modeling_llama.LlamaForCausalLM._reorder_cache
     def _reorder_cache(past_key_values, beam_idx):
+        if isinstance(past_key_values, Phi3StaticCache):
+            past_key_values.reorder_cache(beam_idx)
+            return past_key_values
         reordered_past = ()
         for layer_past in past_key_values:
             reordered_past += (
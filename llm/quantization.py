@@ -0,0 +1,108 @@
+"""
+CPU çıkarımı için ağırlık nicemleme (quantization) yardımcıları.
+
+``int8``: Phi-3 dekoder katmanlarındaki Linear'lar (qkv_proj, o_proj, gate_up_proj,
+down_proj) torch'un dinamik int8 nicemlemesiyle değiştirilir; ağırlıklar 4 kat küçülür ve
+matmul'lar int8 CPU çekirdekleriyle (fbgemm/qnnpack) yapılır.
+Diğer ağırlıklar yüklendikleri dtype'ta kalır; fp16 dönüştürülmüş bir modelde nicemlenmiş
+Linear'lar float32 girdi alıp çıktıyı fp16'ya geri çevirir.
+``int4``: torchao kuruluysa yalnızca ağırlıkların int4'e indirildiği mod; torchao yoksa
+ya da uygulanamazsa int8'e düşülür.
+"""
+
+import os
+import resource
+from typing import Dict, Iterable, Tuple
+
+import torch
+from torch import nn
+
+QUANTIZED_LINEARS: Tuple[str, ...] = ("qkv_proj", "o_proj", "gate_up_proj", "down_proj")
+QUANTIZE_MODES = ("none", "int8", "int4")
+
+
+def _target_names(model: nn.Module, targets: Iterable[str]) -> Dict[str, nn.Module]:
+    targets = set(targets)
+    return {
+        name: module for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.rsplit(".", 1)[-1] in targets
+    }
+
+
+class _Float32Input(nn.Module):
+    """fp16/bf16 modelde nicemlenmiş Linear'ı float32 girdiyle çalıştırıp çıktıyı modelin dtype'ına döndürür"""
+
+    def __init__(self, linear: nn.Module):
+        super().__init__()
+        self.linear = linear
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.linear(x.float()).to(x.dtype)
+
+
+def quantize_int8(model: nn.Module, targets: Iterable[str] = QUANTIZED_LINEARS) -> nn.Module:
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    for name, module in _target_names(model, targets).items():
+        # Yalnızca bu Linear float32'ye çevrilip hemen nicemlenir; geri kalan (mmap edilmiş)
+        # ağırlıklar kopyalanmaz ve tepe bellek tek katman kadar artar
+        input_dtype = module.weight.dtype
+        module.float()
+        module.qconfig = qconfig
+        quantized = torch.ao.nn.quantized.dynamic.Linear.from_float(module)
+        if input_dtype != torch.float32:
+            quantized = _Float32Input(quantized)
+        parent, _, child = name.rpartition(".")
+        setattr(model.get_submodule(parent), child, quantized)
+    return model
+
+
+def quantize_int4(model: nn.Module, targets: Iterable[str] = QUANTIZED_LINEARS, group_size: int = 128) -> nn.Module:
+    from torchao.quantization import int4_weight_only, quantize_
+
+    names = set(_target_names(model, targets))
+    quantize_(model, int4_weight_only(group_size=group_size), filter_fn=lambda module, fqn: fqn in names)
+    return model
+
+
+def quantize_model(model: nn.Module, mode: str) -> Tuple[nn.Module, str]:
+    """Modeli istenen moda göre nicemle; (model, gerçekten uygulanan mod) döndür"""
+    mode = (mode or "none").lower()
+    if mode not in QUANTIZE_MODES:
+        print(f"⚠️ Bilinmeyen LLM_QUANTIZE değeri '{mode}'; nicemleme yapılmadı.")
+        return model, "none"
+    if mode == "none":
+        return model, mode
+
+    # Model bütünüyle float32'ye çevrilmez (mmap edilmiş ağırlıklar kopyalanırdı);
+    # yalnızca hedef Linear'lar nicemlenirken dönüştürülür
+    if mode == "int4":
+        try:
+            return quantize_int4(model), "int4"
+        except Exception as e:
+            print(f"⚠️ int4 nicemleme uygulanamadı ({e}); int8'e geçiliyor.")
+    return quantize_int8(model), "int8"
+
+
+def _tensor_bytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            return value.int_repr().numel() * value.element_size()
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+def memory_report(model: nn.Module) -> Dict[str, float]:
+    """Model ağırlıklarının kapladığı bellek ve sürecin RSS değeri (MB)"""
+    weights = sum(_tensor_bytes(v) for v in model.state_dict().values())
+    report = {"weights_mb": round(weights / 2 ** 20, 1)}
+
+    try:
+        with open("/proc/self/statm") as f:
+            report["rss_mb"] = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except (OSError, ValueError):
+        pass
+    # Linux'ta KB cinsinden en yüksek RSS
+    report["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
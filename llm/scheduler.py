@@ -0,0 +1,499 @@
+"""
+Sürekli (continuous) batching ile çalışan süreç içi üretim zamanlayıcısı.
+
+Bekleyen istekler tek bir arka plan thread'inde dinamik batch'lere toplanır:
+yeni gelen istekler sola dolgulanarak (left-padding) prefill edilir ve KV cache'leri
+mevcut batch'e eklenir; biten diziler token sınırında batch'ten çıkarılır. Böylece
+her decode adımı tüm aktif konuşmalar için tek bir model forward'ı olur.
+"""
+
+import asyncio
+import copy
+import inspect
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+from speculative import (
+    SPECULATIVE_MODES, DraftModel, crop_cache, draft_tokens, sample_token, target_probs, verify_token
+)
+
+try:
+    from transformers.cache_utils import Cache
+except Exception:  # eski transformers sürümleri
+    Cache = None
+
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def context_length(req: "GenerationRequest") -> int:
+    """İsteğin dolgusuz uzunluğu: önek + prompt + üretilen token'lar (sonuncusu dahil)"""
+    return len(req.prefix_ids or ()) + len(req.prompt_ids) + len(req.generated)
+
+
+class GenerationRequest:
+    __slots__ = (
+        "prompt_ids", "max_new_tokens", "temperature", "top_p",
+        "generated", "future", "loop", "created_at", "finished", "on_token", "prefix_ids",
+        "constraint", "speculative", "draft_past", "draft_cached"
+    )
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, temperature: float, top_p: float,
+                 future: asyncio.Future, loop: asyncio.AbstractEventLoop,
+                 on_token: Optional[Callable[[int], None]] = None,
+                 prefix_ids: Optional[Tuple[int, ...]] = None, constraint=None,
+                 speculative: Optional[str] = None):
+        # prefix_ids verildiyse prompt_ids yalnızca önekten sonraki kısımdır
+        self.prefix_ids = prefix_ids
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated: List[int] = []
+        self.future = future
+        self.loop = loop
+        self.created_at = time.time()
+        self.finished = False
+        # Zamanlayıcı thread'inde her yeni token için çağrılır (EOS hariç)
+        self.on_token = on_token
+        # İsteğe bağlı gramer kısıtı: allowed() → izin verilen token maskesi, advance(token), done
+        self.constraint = constraint
+        # "ngram" | "draft" | None; taslak modelin bu istek için KV cache'i ve kapsadığı token sayısı
+        self.speculative = speculative
+        self.draft_past = None
+        self.draft_cached = 0
+
+    def resolve(self, result=None, error: Optional[BaseException] = None):
+        def _set():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        self.loop.call_soon_threadsafe(_set)
+
+
+def sample_next_tokens(logits: torch.Tensor, temperatures: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """Satır başına farklı temperature/top_p ile örnekle; temperature<=0 ise greedy"""
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+
+    temps = temperatures.clamp(min=1e-5).unsqueeze(-1)
+    probs = torch.softmax(logits / temps, dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    sorted_probs[(cumulative - sorted_probs) > top_ps.unsqueeze(-1)] = 0.0
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+
+    return torch.where(temperatures <= 0, greedy, sampled)
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def merge_caches(a: Optional[LegacyCache], a_mask: Optional[torch.Tensor],
+                 b: LegacyCache, b_mask: torch.Tensor) -> Tuple[LegacyCache, torch.Tensor]:
+    """İki batch'in KV cache'lerini sola dolgulayarak batch boyutunda birleştir"""
+    if a is None:
+        return b, b_mask
+    length = max(a_mask.shape[1], b_mask.shape[1])
+    merged = tuple(
+        (
+            torch.cat([_left_pad(ka, length, 2), _left_pad(kb, length, 2)], dim=0),
+            torch.cat([_left_pad(va, length, 2), _left_pad(vb, length, 2)], dim=0),
+        )
+        for (ka, va), (kb, vb) in zip(a, b)
+    )
+    mask = torch.cat([_left_pad(a_mask, length, 1), _left_pad(b_mask, length, 1)], dim=0)
+    return merged, mask
+
+
+class BatchScheduler:
+    def __init__(self, model, eos_token_ids: Set[int], pad_token_id: int, max_batch_size: int = 8,
+                 prefix_cache_size: int = 16, draft_model=None, num_speculative_tokens: int = 4):
+        self.model = model
+        self.eos_token_ids = eos_token_ids
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.device = getattr(model, "device", torch.device("cpu"))
+        # Depodaki Phi-3 modeli batch'in gerçek (dolgusuz) uzunluğunu alır; LongRoPE kısa/uzun
+        # faktör seçimini sola dolgulu genişliğe göre değil buna göre yapar
+        self._pass_real_seq_len = "real_seq_len" in inspect.signature(model.forward).parameters
+
+        # Sabit prompt öneklerinin KV cache'leri (önek token'ları → cache), LRU sırasıyla
+        self.prefix_cache_size = prefix_cache_size
+        self._prefixes: "OrderedDict[Tuple[int, ...], LegacyCache]" = OrderedDict()
+
+        # Spekülatif çözümleme: adım başına en fazla bu kadar taslak token doğrulanır
+        self.draft_model = DraftModel(draft_model) if draft_model is not None else None
+        self.num_speculative_tokens = num_speculative_tokens
+
+        self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._active: List[GenerationRequest] = []
+        self._past: Optional[LegacyCache] = None
+        self._mask: Optional[torch.Tensor] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.stats = {
+            "steps": 0, "generated_tokens": 0, "busy_seconds": 0.0, "max_batch_seen": 0,
+            "prefill_tokens": 0, "prefix_hits": 0, "prefix_misses": 0, "prefix_tokens_reused": 0,
+            "speculative": {
+                mode: {"steps": 0, "drafted": 0, "accepted": 0, "emitted": 0}
+                for mode in SPECULATIVE_MODES if mode != "off"
+            }
+        }
+
+    # --- Dış arayüz ---
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="llm-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    async def submit(self, prompt_ids: List[int], max_new_tokens: int, temperature: float, top_p: float,
+                     prefix_ids: Optional[Sequence[int]] = None, constraint=None,
+                     speculative: Optional[str] = None) -> List[int]:
+        """İsteği kuyruğa ekle; üretim bitince yalnızca üretilen token'ları döndür (EOS hariç).
+
+        ``prefix_ids`` birçok istekte ortak olan sabit prompt başlangıcıdır; KV cache'i bir kez
+        hesaplanıp saklanır ve sonraki isteklerde yalnızca ``prompt_ids`` prefill edilir.
+        ``constraint`` verilirse her adımda yalnızca izin verdiği token'lardan örneklenir ve
+        kısıt tamamlandığında (ör. JSON kapandığında) üretim durur. ``speculative`` ("ngram" ya da
+        "draft") verilirse her adımda taslak token'lar tek forward'da doğrulanır.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        prefix = tuple(prefix_ids) if prefix_ids else None
+        self._queue.put(GenerationRequest(prompt_ids, max_new_tokens, temperature, top_p, future, loop,
+                                          prefix_ids=prefix, constraint=constraint,
+                                          speculative=self.speculative_mode(speculative)))
+        return await future
+
+    async def stream(self, prompt_ids: List[int], max_new_tokens: int, temperature: float,
+                     top_p: float, prefix_ids: Optional[Sequence[int]] = None,
+                     constraint=None, speculative: Optional[str] = None) -> AsyncIterator[int]:
+        """İsteği kuyruğa ekle ve üretilen token'ları geldikçe döndür"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        tokens: "asyncio.Queue[Optional[int]]" = asyncio.Queue()
+        # Token callback'leri sonuçtan önce sıraya girdiği için None her zaman en sona düşer
+        future.add_done_callback(lambda _: tokens.put_nowait(None))
+
+        self._queue.put(GenerationRequest(
+            prompt_ids, max_new_tokens, temperature, top_p, future, loop,
+            on_token=lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token),
+            prefix_ids=tuple(prefix_ids) if prefix_ids else None,
+            constraint=constraint,
+            speculative=self.speculative_mode(speculative)
+        ))
+        try:
+            while True:
+                token = await tokens.get()
+                if token is None:
+                    break
+                yield token
+            future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def speculative_mode(self, mode: Optional[str]) -> Optional[str]:
+        """İstenen spekülatif modu doğrula; kapalıysa None"""
+        if mode not in SPECULATIVE_MODES + (None, ""):
+            raise ValueError(f"Bilinmeyen speculative modu: {mode} (geçerli: {', '.join(SPECULATIVE_MODES)})")
+        if mode in (None, "", "off") or self.num_speculative_tokens <= 0:
+            return None
+        if mode == "draft" and self.draft_model is None:
+            raise ValueError("Taslak model yüklenmedi; speculative='draft' kullanılamaz.")
+        return mode
+
+    def snapshot(self):
+        busy = self.stats["busy_seconds"]
+        speculative = {
+            mode: {
+                **s,
+                "acceptance_rate": round(s["accepted"] / s["drafted"], 3) if s["drafted"] else None,
+                "tokens_per_step": round(s["emitted"] / s["steps"], 2) if s["steps"] else None
+            }
+            for mode, s in self.stats["speculative"].items()
+        }
+        return {
+            **self.stats,
+            "speculative": speculative,
+            "active_sequences": len(self._active),
+            "queued": self._queue.qsize(),
+            "cached_prefixes": len(self._prefixes),
+            "tokens_per_second": round(self.stats["generated_tokens"] / busy, 2) if busy else 0.0
+        }
+
+    # --- Zamanlayıcı thread'i ---
+    def _run(self):
+        while not self._stopped.is_set():
+            incoming = self._collect()
+            if not incoming and not self._active:
+                continue
+
+            started = time.perf_counter()
+            try:
+                with torch.inference_mode():
+                    if incoming:
+                        self._prefill(incoming)
+                    elif self._active:
+                        self._decode_step()
+                self._retire()
+            except Exception as e:
+                for req in self._active + incoming:
+                    req.resolve(error=e)
+                self._active, self._past, self._mask = [], None, None
+            self.stats["busy_seconds"] += time.perf_counter() - started
+
+    def _collect(self) -> List[GenerationRequest]:
+        """Boş slot kadar yeni isteği al; batch boşsa ilk isteği bekle"""
+        incoming: List[GenerationRequest] = []
+        free = self.max_batch_size - len(self._active)
+        while len(incoming) < free:
+            try:
+                if not self._active and not incoming:
+                    req = self._queue.get(timeout=0.1)
+                else:
+                    req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req.future.cancelled():
+                continue
+            incoming.append(req)
+        return incoming
+
+    def _forward(self, input_ids, attention_mask, past, real_seq_len: int, all_logits: bool = False):
+        """``real_seq_len``: batch'teki en uzun dizinin dolgusuz uzunluğu (en büyük pozisyon + 1)"""
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+        kwargs = {"real_seq_len": real_seq_len} if self._pass_real_seq_len else {}
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+            **kwargs
+        )
+        next_past = out.past_key_values
+        if Cache is not None and isinstance(next_past, Cache):
+            next_past = next_past.to_legacy_cache()
+        return (out.logits if all_logits else out.logits[:, -1, :]), next_past
+
+    def _prefix_cache(self, prefix_ids: Tuple[int, ...]) -> LegacyCache:
+        """Önekin KV cache'ini döndür; yoksa bir kez hesaplayıp sakla"""
+        past = self._prefixes.get(prefix_ids)
+        if past is not None:
+            self._prefixes.move_to_end(prefix_ids)
+            self.stats["prefix_hits"] += 1
+            return past
+
+        ids = torch.tensor([prefix_ids], device=self.device)
+        _, past = self._forward(ids, torch.ones_like(ids), None, len(prefix_ids))
+        self.stats["prefix_misses"] += 1
+        self.stats["prefill_tokens"] += len(prefix_ids)
+        self._prefixes[prefix_ids] = past
+        if len(self._prefixes) > self.prefix_cache_size:
+            self._prefixes.popitem(last=False)
+        return past
+
+    def _prefill(self, incoming: List[GenerationRequest]):
+        # Aynı öneki paylaşan istekler tek forward'da prefill edilir
+        groups: Dict[Optional[Tuple[int, ...]], List[GenerationRequest]] = {}
+        for req in incoming:
+            groups.setdefault(req.prefix_ids, []).append(req)
+        for prefix_ids, reqs in groups.items():
+            self._prefill_group(reqs, prefix_ids)
+
+        # Batch'teki eski diziler bu turda ilerlemedi; bir sonraki adımda hep birlikte ilerlerler
+        self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(self._active))
+
+    def _prefill_group(self, reqs: List[GenerationRequest], prefix_ids: Optional[Tuple[int, ...]]):
+        length = max(len(r.prompt_ids) for r in reqs)
+        ids = torch.full((len(reqs), length), self.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(reqs), length), dtype=torch.long)
+        for row, req in enumerate(reqs):
+            ids[row, length - len(req.prompt_ids):] = torch.tensor(req.prompt_ids)
+            mask[row, length - len(req.prompt_ids):] = 1
+        ids, mask = ids.to(self.device), mask.to(self.device)
+
+        past = None
+        if prefix_ids:
+            # Önek cache'i satır sayısı kadar çoğaltılır; dolgu önek ile soru arasına düşer,
+            # maske sayesinde dikkate alınmaz ve pozisyonlar maskeden hesaplandığı için kaymaz
+            prefix_past = self._prefix_cache(prefix_ids)
+            past = tuple(
+                (k.expand(len(reqs), -1, -1, -1), v.expand(len(reqs), -1, -1, -1))
+                for k, v in prefix_past
+            )
+            mask = torch.cat([mask.new_ones((len(reqs), len(prefix_ids))), mask], dim=1)
+            self.stats["prefix_tokens_reused"] += len(prefix_ids) * len(reqs)
+
+        logits, past = self._forward(ids, mask, past, max(context_length(r) for r in reqs))
+        self.stats["prefill_tokens"] += sum(len(r.prompt_ids) for r in reqs)
+        self._past, self._mask = merge_caches(self._past, self._mask, past, mask)
+        self._active.extend(reqs)
+        self._append_tokens(reqs, logits)
+
+    def _decode_step(self):
+        if any(req.speculative for req in self._active):
+            self._speculative_step()
+            return
+        last = torch.tensor([[req.generated[-1]] for req in self._active], device=self.device)
+        mask = torch.cat([self._mask, self._mask.new_ones((self._mask.shape[0], 1))], dim=-1)
+        logits, self._past = self._forward(last, mask, self._past, max(context_length(r) for r in self._active))
+        self._mask = mask
+        self._append_tokens(self._active, logits)
+        self.stats["steps"] += 1
+
+    def _apply_constraints(self, requests: Sequence[GenerationRequest], logits: torch.Tensor) -> torch.Tensor:
+        masks = [r.constraint.allowed() if r.constraint is not None else None for r in requests]
+        if all(m is None for m in masks):
+            return logits
+        full = torch.ones(logits.shape[-1], dtype=torch.bool, device=logits.device)
+        allowed = torch.stack([full if m is None else m[:logits.shape[-1]] for m in masks])
+        return logits.float().masked_fill(~allowed, float("-inf"))
+
+    def _append_tokens(self, requests: Sequence[GenerationRequest], logits: torch.Tensor):
+        logits = self._apply_constraints(requests, logits)
+        temps = torch.tensor([r.temperature for r in requests], device=logits.device)
+        top_ps = torch.tensor([r.top_p for r in requests], device=logits.device)
+        tokens = sample_next_tokens(logits, temps, top_ps).tolist()
+        for req, token in zip(requests, tokens):
+            self._push_token(req, token)
+
+    def _push_token(self, req: GenerationRequest, token: int) -> bool:
+        """Token'ı isteğe ekle; dizi bittiyse True"""
+        req.generated.append(token)
+        self.stats["generated_tokens"] += 1
+        if req.constraint is not None:
+            req.constraint.advance(token)
+        if token in self.eos_token_ids or len(req.generated) >= req.max_new_tokens:
+            req.finished = True
+        elif req.constraint is not None and req.constraint.done:
+            req.finished = True
+        if req.on_token is not None and token not in self.eos_token_ids:
+            req.on_token(token)
+        return req.finished
+
+    def _speculative_step(self):
+        """Taslak token'ları tüm batch için tek forward'da doğrula.
+
+        Her satır [son token, d1..dk] ile beslenir; reddedilen taslakların KV sütunları maskede
+        sıfırlanır (pozisyonlar maskeden hesaplandığı için sonraki token'lar kaymaz) ve hiçbir
+        satırın kullanmadığı sütunlar cache'ten atılır.
+        """
+        drafts: List[List[int]] = []
+        masks: List[List[Optional[torch.Tensor]]] = []
+        for req in self._active:
+            budget = min(self.num_speculative_tokens, req.max_new_tokens - len(req.generated) - 1)
+            draft = draft_tokens(req, budget, self.draft_model) if req.speculative and budget > 0 else []
+            # Kısıtlı dizilerde taslak, gramerin izin vermediği ilk token'da kesilir
+            row_masks: List[Optional[torch.Tensor]] = []
+            constraint = copy.copy(req.constraint) if req.constraint is not None else None
+            for position, token in enumerate(draft):
+                allowed = constraint.allowed() if constraint is not None else None
+                if allowed is not None and not bool(allowed[token]):
+                    draft = draft[:position]
+                    break
+                row_masks.append(allowed)
+                if constraint is not None:
+                    constraint.advance(token)
+            row_masks.append(constraint.allowed() if constraint is not None else None)
+            drafts.append(draft)
+            masks.append(row_masks)
+
+        batch, width = len(self._active), 1 + max(len(d) for d in drafts)
+        ids = torch.full((batch, width), self.pad_token_id, dtype=torch.long)
+        step_mask = torch.zeros((batch, width), dtype=torch.long)
+        for row, (req, draft) in enumerate(zip(self._active, drafts)):
+            ids[row, :1 + len(draft)] = torch.tensor([req.generated[-1]] + draft)
+            step_mask[row, :1 + len(draft)] = 1
+        ids, step_mask = ids.to(self.device), step_mask.to(self.device)
+
+        mask = torch.cat([self._mask, step_mask], dim=-1)
+        real_seq_len = max(context_length(req) + len(draft) for req, draft in zip(self._active, drafts))
+        logits, self._past = self._forward(ids, mask, self._past, real_seq_len, all_logits=True)
+
+        for row, (req, draft) in enumerate(zip(self._active, drafts)):
+            accepted = emitted = 0
+            for position in range(len(draft) + 1):
+                row_logits = logits[row, position]
+                if masks[row][position] is not None:
+                    row_logits = row_logits.float().masked_fill(~masks[row][position][:row_logits.shape[-1]],
+                                                                float("-inf"))
+                probs = target_probs(row_logits, req.temperature, req.top_p)
+                if position < len(draft):
+                    ok, token = verify_token(probs, draft[position])
+                    accepted += ok
+                else:
+                    ok, token = False, sample_token(probs)
+                emitted += 1
+                if self._push_token(req, token) or not ok:
+                    break
+
+            # Reddedilen taslakların KV'si geçersiz: sadece son token + kabul edilen taslaklar kalır
+            mask[row, mask.shape[1] - width + 1 + accepted:] = 0
+            if req.draft_past is not None:
+                req.draft_cached = min(req.draft_cached, context_length(req) - 1)
+                req.draft_past = crop_cache(req.draft_past, req.draft_cached)
+            if req.speculative:
+                stats = self.stats["speculative"][req.speculative]
+                stats["steps"] += 1
+                stats["drafted"] += len(draft)
+                stats["accepted"] += accepted
+                stats["emitted"] += emitted
+
+        keep = mask.bool().any(0)
+        if not bool(keep.all()):
+            index = keep.nonzero().squeeze(-1)
+            mask = mask.index_select(1, index)
+            self._past = tuple((k.index_select(2, index), v.index_select(2, index)) for k, v in self._past)
+        self._mask = mask
+        self.stats["steps"] += 1
+
+    def _retire(self):
+        """Biten ya da iptal edilen dizileri batch'ten çıkar ve sonuçlarını ilet"""
+        keep = []
+        for row, req in enumerate(self._active):
+            if req.finished:
+                generated = req.generated[:-1] if req.generated[-1] in self.eos_token_ids else req.generated
+                req.resolve(generated)
+            elif req.future.cancelled():
+                continue
+            else:
+                keep.append(row)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._active, self._past, self._mask = [], None, None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self._active = [self._active[i] for i in keep]
+        self._mask = self._mask.index_select(0, index)
+        # Kalan dizilerin hiçbirinin kullanmadığı soldaki dolgu sütunlarını at
+        lead = int((self._mask.sum(0) == 0).long().cumprod(0).sum())
+        self._mask = self._mask[:, lead:]
+        self._past = tuple(
+            (k.index_select(0, index)[:, :, lead:], v.index_select(0, index)[:, :, lead:])
+            for k, v in self._past
+        )
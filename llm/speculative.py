@@ -0,0 +1,109 @@
+"""
+Spekülatif çözümleme (speculative decoding) yardımcıları.
+
+Her adımda ucuz bir taslakçı k token önerir, büyük model bu k token'ı tek bir forward'da
+doğrular. Taslaklar deterministik olduğu için (tek noktaya olasılık) kabul kuralı
+``p(d)`` olasılıkla kabul, ret durumunda ``d`` çıkarılmış ``p``'den örnekleme şeklindedir;
+böylece çıktı dağılımı normal örneklemeyle aynı kalır (greedy'de birebir aynı çıktı).
+
+Taslakçılar:
+- ``ngram`` (prompt lookup): bağlamdaki son n-gram'ın daha önceki bir geçişini bulur ve
+  ardından gelen token'ları önerir; JSON anahtarları ve şablon metinlerde çok isabetlidir.
+- ``draft``: aynı tokenizer'ı kullanan küçük bir taslak model, greedy olarak k token üretir.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+SPECULATIVE_MODES = ("off", "ngram", "draft")
+
+
+def ngram_draft(tokens: Sequence[int], k: int, max_ngram: int = 3) -> List[int]:
+    """Son ``n`` token'ın (n = max_ngram..1) en yakın önceki geçişinden sonraki k token"""
+    length = len(tokens)
+    for n in range(min(max_ngram, length - 1), 0, -1):
+        pattern = list(tokens[-n:])
+        for start in range(length - n - 1, -1, -1):
+            if tokens[start] == pattern[0] and list(tokens[start:start + n]) == pattern:
+                follow = list(tokens[start + n:start + n + k])
+                if follow:
+                    return follow
+    return []
+
+
+def target_probs(logits: torch.Tensor, temperature: float, top_p: float) -> torch.Tensor:
+    """Tek bir satırın örnekleme dağılımı; temperature<=0 ise argmax'ta tek nokta"""
+    logits = logits.float()
+    if temperature <= 0:
+        probs = torch.zeros_like(logits)
+        probs[logits.argmax()] = 1.0
+        return probs
+    probs = torch.softmax(logits / max(temperature, 1e-5), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(descending=True)
+    cumulative = sorted_probs.cumsum(-1)
+    sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+    filtered = torch.zeros_like(probs).scatter(0, sorted_idx, sorted_probs)
+    return filtered / filtered.sum()
+
+
+def verify_token(probs: torch.Tensor, draft: int) -> Tuple[bool, int]:
+    """Taslak token'ı kabul et ya da düzeltilmiş token'ı örnekle → (kabul edildi mi, token)"""
+    p = float(probs[draft])
+    if p > 0 and (p >= 1.0 or torch.rand(()).item() < p):
+        return True, draft
+    residual = probs.clone()
+    residual[draft] = 0.0
+    if residual.sum() <= 0:
+        return True, draft
+    return False, int(torch.multinomial(residual, 1))
+
+
+def sample_token(probs: torch.Tensor) -> int:
+    if float(probs.max()) >= 1.0:
+        return int(probs.argmax())
+    return int(torch.multinomial(probs, 1))
+
+
+def crop_cache(past, length: int):
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past)
+
+
+class DraftModel:
+    """Küçük taslak model; her isteğin KV cache'i istekte saklanır ve kabul edilen uzunluğa kırpılır"""
+
+    def __init__(self, model):
+        self.model = model
+        self.device = getattr(model, "device", torch.device("cpu"))
+
+    @torch.inference_mode()
+    def draft(self, context: Sequence[int], k: int, past=None, cached: int = 0):
+        """Bağlamın devamı için greedy k token; (token'lar, yeni cache, cache'teki token sayısı)"""
+        if past is None:
+            cached = 0
+        elif cached >= len(context):
+            # Son token'ın logit'leri gerektiği için bir token geri alıp yeniden besle
+            past, cached = crop_cache(past, len(context) - 1), len(context) - 1
+        ids = torch.tensor([list(context[cached:])], device=self.device)
+        tokens: List[int] = []
+        for _ in range(k):
+            out = self.model(input_ids=ids, past_key_values=past, use_cache=True)
+            past = out.past_key_values
+            if hasattr(past, "to_legacy_cache"):
+                past = past.to_legacy_cache()
+            token = int(out.logits[0, -1].argmax())
+            tokens.append(token)
+            ids = torch.tensor([[token]], device=self.device)
+        # Cache bağlamı ve son taslak hariç tüm taslakları içerir
+        return tokens, past, len(context) + k - 1
+
+
+def draft_tokens(req, k: int, draft_model: Optional[DraftModel]) -> List[int]:
+    """İsteğin moduna göre en fazla k taslak token üret"""
+    context = list(req.prefix_ids or ()) + req.prompt_ids + req.generated
+    if req.speculative == "draft" and draft_model is not None:
+        tokens, req.draft_past, req.draft_cached = draft_model.draft(
+            context, k, req.draft_past, req.draft_cached
+        )
+        return tokens
+    return ngram_draft(context, k)
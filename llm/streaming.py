@@ -0,0 +1,207 @@
+"""
+Akış (streaming) yardımcıları: token'ları artımlı olarak metne çeviren decoder,
+metni durdurma dizilerinde (ör. bir sonraki konuşmacının işareti) kesen filtre ve
+modelin ürettiği JSON'u karakter karakter okuyup theory/answer/homework/lab/notes
+bölümlerinin içeriğini geldikçe veren ayrıştırıcı.
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+
+class IncrementalDecoder:
+    """Her adımda yalnızca son birkaç token'ı decode ederek yeni metni çıkarır.
+
+    SentencePiece baştaki boşluğu bağlama göre ürettiği ve çok baytlı karakterler
+    birden fazla token'a bölünebildiği için küçük bir önek penceresiyle decode edilir;
+    yarım kalmış UTF-8 dizisi (\\ufffd) tamamlanana kadar metin bekletilir.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token: int) -> str:
+        self.tokens.append(token)
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        full_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(full_text) <= len(prefix_text) or full_text.endswith("�"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return full_text[len(prefix_text):]
+
+
+def _first_stop(text: str, stops: Sequence[str]) -> Optional[int]:
+    positions = [i for i in (text.find(stop) for stop in stops) if i >= 0]
+    return min(positions) if positions else None
+
+
+def trim_at_stop(text: str, stops: Sequence[str]) -> str:
+    """Metni ilk durdurma dizisinden önce kes"""
+    cut = _first_stop(text, stops)
+    return text if cut is None else text[:cut]
+
+
+class StopSequenceFilter:
+    """Akış halindeki metni ilk durdurma dizisinde keser.
+
+    Bir durdurma dizisinin başlangıcı olabilecek kuyruk, sonraki parça gelene kadar
+    bekletilir; böylece parçalara bölünmüş dizi de dışarı sızmaz. ``stopped`` True
+    olduktan sonra gelen metin atılır.
+    """
+
+    def __init__(self, stops: Sequence[str]):
+        self.stops = tuple(stops)
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        text = self.pending + text
+        cut = _first_stop(text, self.stops)
+        if cut is not None:
+            self.stopped = True
+            self.pending = ""
+            return text[:cut]
+
+        hold = 0
+        for stop in self.stops:
+            for size in range(min(len(stop) - 1, len(text)), hold, -1):
+                if text.endswith(stop[:size]):
+                    hold = size
+                    break
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+    def flush(self) -> str:
+        """Akış bittiğinde bekletilen kuyruğu ver"""
+        text, self.pending = self.pending, ""
+        return text
+
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonSectionParser:
+    """Üst düzey JSON nesnesindeki string ve string-dizisi alanlarını akış halinde çözer.
+
+    ``feed`` her çağrıda olay listesi döndürür:
+    ``{"event": "delta", "section": "answer", "index": None, "text": "..."}`` — string içeriği
+    (dizi elemanları için ``index`` eleman sırasıdır) ve
+    ``{"event": "section_end", "section": "answer"}`` — alanın değeri kapandı.
+    Beklenmeyen yapılar (iç içe nesneler, sayılar) sessizce atlanır.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape: Optional[str] = None   # None | "" | "u" + hex basamakları
+        self.key_buffer: Optional[List[str]] = None
+        self.section: Optional[str] = None
+        self.pending_key: Optional[str] = None
+        self.item_index: Optional[int] = None
+        self.closed = False
+
+    def feed(self, text: str) -> List[Dict]:
+        events: List[Dict] = []
+        buffer: List[str] = []
+
+        def flush():
+            if buffer:
+                events.append({"event": "delta", "section": self.section, "index": self.item_index,
+                               "text": "".join(buffer)})
+                buffer.clear()
+
+        for ch in text:
+            if self.closed:
+                break
+
+            if self.in_string:
+                decoded = self._string_char(ch)
+                if decoded is None:
+                    continue
+                if decoded is _END:
+                    self.in_string = False
+                    if self.key_buffer is not None:
+                        self.pending_key = "".join(self.key_buffer)
+                        self.key_buffer = None
+                    else:
+                        flush()
+                        if self.depth == 1:
+                            events.append({"event": "section_end", "section": self.section})
+                            self.section = None
+                    continue
+                if self.key_buffer is not None:
+                    self.key_buffer.append(decoded)
+                elif self.section is not None and self.depth in (1, 2):
+                    buffer.append(decoded)
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                if self.depth == 1 and self.section is None:
+                    # Anahtar mı değer mi? ':' görülmüşse değer
+                    if self.pending_key is None:
+                        self.key_buffer = []
+                    else:
+                        self.section = self.pending_key
+                        self.pending_key = None
+                        self.item_index = None
+                elif self.depth == 2 and self.section is not None:
+                    self.item_index = 0 if self.item_index is None else self.item_index + 1
+            elif ch in "{[":
+                self.depth += 1
+                if ch == "[" and self.depth == 2 and self.pending_key is not None:
+                    self.section = self.pending_key
+                    self.pending_key = None
+                    self.item_index = None
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 1 and ch == "]" and self.section is not None:
+                    events.append({"event": "section_end", "section": self.section})
+                    self.section = None
+                elif self.depth == 0:
+                    self.closed = True
+            elif ch == ":" and self.depth == 1:
+                continue
+            elif ch == "," and self.depth == 1:
+                self.pending_key = None
+
+        flush()
+        return events
+
+    def _string_char(self, ch: str):
+        """String içindeki bir karakteri çöz; kaçış dizisi tamamlanmadıysa None"""
+        if self.escape is None:
+            if ch == "\\":
+                self.escape = ""
+                return None
+            if ch == '"':
+                return _END
+            return ch
+
+        if self.escape == "":
+            if ch == "u":
+                self.escape = "u"
+                return None
+            self.escape = None
+            return _ESCAPES.get(ch, ch)
+
+        self.escape += ch
+        if len(self.escape) < 5:
+            return None
+        code, self.escape = self.escape[1:], None
+        try:
+            return chr(int(code, 16))
+        except ValueError:
+            return ""
+
+
+_END = object()
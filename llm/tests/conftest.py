@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# llm/ modülleri düz import edilir (sunucunun çalıştığı dizin gibi)
+sys.path.insert(0, LLM_DIR)
+
+
+def build_tiny_phi3(path, **overrides):
+    """Depodaki Phi-3 yapılandırması ve modelleme koduyla ``path`` altında küçük, rastgele ağırlıklı model kur"""
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    for name in ("configuration_phi3.py", "modeling_phi3.py"):
+        shutil.copy(os.path.join(LLM_DIR, name), path)
+
+    with open(os.path.join(LLM_DIR, "config.json")) as f:
+        config = json.load(f)
+    config.pop("_name_or_path", None)
+    config.update(
+        hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, torch_dtype="float32"
+    )
+    config.update(overrides)
+    with open(os.path.join(path, "config.json"), "w") as f:
+        json.dump(config, f)
+
+    torch.manual_seed(0)
+    config = AutoConfig.from_pretrained(str(path), trust_remote_code=True)
+    model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, attn_implementation="eager")
+    return model.eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_phi3(tmp_path_factory):
+    """Küçük Phi-3 modeli; GQA yolunun da çalışması için key/value kafa sayısı sorgu kafalarından azdır"""
+    return build_tiny_phi3(tmp_path_factory.mktemp("tiny_phi3"))
+
+
+@pytest.fixture(scope="session")
+def longrope_phi3(tmp_path_factory):
+    """LongRoPE ölçeklemeli küçük model; özgün bağlam 32 token olduğu için eşik testlerde kolayca aşılır"""
+    half_head_dim = 64 // 4 // 2
+    return build_tiny_phi3(
+        tmp_path_factory.mktemp("longrope_phi3"),
+        original_max_position_embeddings=32, max_position_embeddings=128, sliding_window=None,
+        rope_scaling={
+            "type": "longrope",
+            "short_factor": [1.0 + 0.1 * i for i in range(half_head_dim)],
+            "long_factor": [2.0 + 0.5 * i for i in range(half_head_dim)],
+        }
+    )
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, priority_tier
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def drain(controller, jobs):
+    """Tek yer dolu iken ``jobs``'u kuyruğa sok, sonra yeri boşalt; kabul sırasını döndür"""
+    order = []
+    blocker = await controller.acquire("blocker", priority_tier("normal"))
+
+    async def job(user_id, verbosity):
+        try:
+            ticket = await controller.acquire(user_id, priority_tier(verbosity))
+        except AdmissionRejected as e:
+            order.append(("rejected", user_id, e.status_code))
+            return
+        order.append((user_id, verbosity))
+        await asyncio.sleep(0)
+        controller.release(ticket)
+
+    tasks = []
+    for user_id, verbosity in jobs:
+        tasks.append(asyncio.create_task(job(user_id, verbosity)))
+        await asyncio.sleep(0)
+    controller.release(blocker)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_tiers_are_served_in_priority_order():
+    controller = AdmissionController(max_inflight=1, deadline_seconds=100, initial_service_seconds=0.1)
+    order = run(drain(controller, [("a", "detailed"), ("b", "normal"), ("c", "short"), ("d", "normal")]))
+
+    assert order == [("c", "short"), ("b", "normal"), ("d", "normal"), ("a", "detailed")]
+    assert controller.inflight == 0
+    assert controller.snapshot()["queue_depth"] == 0
+
+
+def test_users_round_robin_within_tier():
+    controller = AdmissionController(max_inflight=1, deadline_seconds=100, initial_service_seconds=0.1)
+    jobs = [("a", "normal")] * 3 + [("b", "normal"), ("c", "normal")]
+    order = run(drain(controller, jobs))
+
+    # a'nın yığdığı istekler b ve c'yi sona itmez
+    assert [user for user, _ in order] == ["a", "b", "c", "a", "a"]
+
+
+def test_queue_and_user_limits_return_429():
+    controller = AdmissionController(max_inflight=1, max_queue=3, max_queued_per_user=2,
+                                     deadline_seconds=100, initial_service_seconds=0.1)
+    jobs = [("a", "normal")] * 3 + [("b", "normal"), ("c", "normal")]
+    order = run(drain(controller, jobs))
+
+    assert ("rejected", "a", 429) in order
+    assert ("rejected", "c", 429) in order
+    assert controller.stats["rejected_user_limit"] == 1
+    assert controller.stats["rejected_queue_full"] == 1
+
+
+def test_deadline_shedding_returns_503():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, deadline_seconds=1, initial_service_seconds=5)
+        ticket = await controller.acquire("a", 1)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await controller.acquire("b", 1)
+        controller.release(ticket)
+        return excinfo.value, controller
+
+    rejected, controller = run(scenario())
+    assert rejected.status_code == 503 and rejected.retry_after >= 1
+    assert controller.stats["shed_deadline"] == 1
+
+
+def test_expired_request_leaves_queue():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, deadline_seconds=0.05, initial_service_seconds=0.01)
+        ticket = await controller.acquire("a", 1)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await controller.acquire("b", 1)
+        # Süresi dolan istek yer almaz; boşalan yere sıradaki istek hemen girer
+        controller.release(ticket)
+        assert (await controller.acquire("c", 1)).admitted_at is not None
+        return excinfo.value, controller
+
+    rejected, controller = run(scenario())
+    assert rejected.status_code == 503
+    assert controller.stats["expired_in_queue"] == 1
+    assert controller.snapshot()["queue_depth"] == 0
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+from transformers import AutoTokenizer
+
+import llm_server
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module", autouse=True)
+def tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(LLM_DIR)
+    llm_server.LOCAL["tokenizer"] = tokenizer
+    llm_server.prefix_token_ids.cache_clear()
+    yield tokenizer
+    llm_server.LOCAL.pop("tokenizer", None)
+
+
+@pytest.mark.parametrize("message", ["SQL injection nedir?", "XSS", " boşluklu soru", '"alıntı" ile başlayan'])
+@pytest.mark.parametrize("verbosity", ["short", "normal", "detailed"])
+def test_split_ids_equal_full_prompt(tokenizer, message, verbosity):
+    prompt = llm_server.build_prompt("bilge", message, verbosity)
+    prefix_ids, prompt_ids = llm_server.encode_prompt("bilge", message, verbosity)
+    assert list(prefix_ids) + list(prompt_ids) == tokenizer(prompt)["input_ids"]
+
+
+def test_prefix_shared_across_questions():
+    first, _ = llm_server.encode_prompt("bilge", "SQL injection nedir?")
+    second, _ = llm_server.encode_prompt("bilge", "Phishing nedir?")
+    assert first and first == second
@@ -0,0 +1,82 @@
+import json
+import os
+import random
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from json_constraint import FIELDS, JsonCloseStop, JsonSchemaGrammar
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EOS = {32000, 32007}
+VALID = '{"theory": "Kod büyüsü \\"tırnak\\" ve \\u00e7", "answer":"Evet.", "homework": ["a", "b"], "lab": [], "notes": ""}'
+
+
+@pytest.fixture(scope="module")
+def grammar():
+    tokenizer = AutoTokenizer.from_pretrained(LLM_DIR)
+    return JsonSchemaGrammar(tokenizer, 32064, EOS)
+
+
+def test_fsm_accepts_schema_and_rejects_other_shapes(grammar):
+    assert grammar.walk(grammar.initial, VALID) == grammar.final
+
+    assert grammar.walk(grammar.initial, '{"answer": ""') is None        # anahtar sırası sabit
+    assert grammar.walk(grammar.initial, '{"theory": 1') is None         # string bekleniyor
+    assert grammar.walk(grammar.initial, VALID + " ") is None           # kapanıştan sonra metin yok
+    assert grammar.walk(grammar.initial, VALID.replace('["a", "b"]', '["a",]')) is None
+
+
+@pytest.mark.parametrize("cut", range(0, len(VALID), 7))
+def test_completion_closes_any_prefix(grammar, cut):
+    state = grammar.walk(grammar.initial, VALID[:cut])
+    closed = VALID[:cut] + grammar.completion(state)
+
+    assert grammar.walk(grammar.initial, closed) == grammar.final
+    assert list(json.loads(closed)) == [name for name, _ in FIELDS]
+
+
+def random_walk(grammar, constraint, rng, limit=400):
+    """Maskenin izin verdiği token'lardan rastgele seç; üretilen token'ları döndür"""
+    structural = torch.tensor([t is not None and any(ch in t for ch in '"[]{},:') for t in grammar.texts])
+    ids = []
+    while not constraint.done and len(ids) < limit:
+        allowed = constraint.allowed()
+        # Yapı karakterlerini sık seçerek yürüyüşün bir yerde kapanmasını sağla
+        if rng.random() < 0.6 and (allowed & structural).any():
+            allowed = allowed & structural
+        choices = allowed.nonzero().flatten().tolist()
+        token = choices[rng.randrange(len(choices))]
+        constraint.advance(token)
+        ids.append(token)
+    return ids
+
+
+def test_masked_tokens_always_produce_valid_json(grammar):
+    rng = random.Random(0)
+    for _ in range(10):
+        constraint = grammar.new_constraint()
+        ids = random_walk(grammar, constraint, rng)
+        assert constraint.closed
+        assert list(json.loads("".join(grammar.texts[i] for i in ids))) == [name for name, _ in FIELDS]
+
+
+@pytest.mark.parametrize("budget", [30, 60])
+def test_token_budget_still_closes_json(grammar, budget):
+    rng = random.Random(budget)
+    for _ in range(5):
+        constraint = grammar.new_constraint(max_tokens=budget)
+        ids = random_walk(grammar, constraint, rng)
+        assert constraint.closed and len(ids) <= budget
+        json.loads("".join(grammar.texts[i] for i in ids))
+
+
+def test_close_stop_tracks_top_level_object(grammar):
+    ids = {text: i for i, text in enumerate(grammar.texts) if text in ('{', '"', '}', 'a', ':')}
+    stop = JsonCloseStop(grammar.texts, EOS)
+    for text in ['{', '"', '}', '"', ':', '{', '}']:
+        stop.advance(ids[text])
+        assert not stop.done
+    stop.advance(ids['}'])
+    assert stop.done
@@ -0,0 +1,108 @@
+import sys
+
+import pytest
+import torch
+
+
+@pytest.fixture(scope="module")
+def phi3(tiny_phi3):
+    """Uzak koddan yüklenen modeling_phi3 modülü (cache sınıfları için)"""
+    return sys.modules[type(tiny_phi3).__module__]
+
+
+def greedy(model, input_ids, max_new_tokens=10, **kwargs):
+    return model.generate(
+        input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=max_new_tokens, do_sample=False,
+        pad_token_id=32000, **kwargs
+    )
+
+
+# --- Paged cache ---
+
+def test_paged_forks_match_generate(tiny_phi3, phi3):
+    torch.manual_seed(1)
+    manager = phi3.Phi3BlockManager(tiny_phi3.config, num_blocks=64, block_size=4)
+    prefix = torch.randint(5, 1000, (1, 10))
+    root = manager.new_sequence()
+    with torch.no_grad():
+        tiny_phi3(prefix, past_key_values=manager.cache([root]), use_cache=True)
+    prefix_blocks = 64 - manager.num_free_blocks
+
+    for suffix_len in (3, 6):
+        child = manager.fork(root)
+        full = torch.cat([prefix, torch.randint(5, 1000, (1, suffix_len))], dim=1)
+        assert torch.equal(greedy(tiny_phi3, full), greedy(tiny_phi3, full, past_key_values=manager.cache([child])))
+        manager.free(child)
+        # Kopyalanan son blok ve yeni bloklar geri döner; önek blokları kökte kalır
+        assert 64 - manager.num_free_blocks == prefix_blocks
+        assert manager.seq_length(root) == 10
+
+    manager.free(root)
+    assert manager.num_free_blocks == 64
+
+
+def test_paged_batch_of_forks(tiny_phi3, phi3):
+    torch.manual_seed(2)
+    manager = phi3.Phi3BlockManager(tiny_phi3.config, num_blocks=64, block_size=4)
+    prefix = torch.randint(5, 1000, (1, 9))
+    root = manager.new_sequence()
+    with torch.no_grad():
+        tiny_phi3(prefix, past_key_values=manager.cache([root]), use_cache=True)
+
+    first, second = manager.fork(root), manager.fork(root)
+    full = torch.cat([prefix.expand(2, -1), torch.randint(5, 1000, (2, 5))], dim=1)
+    expected = greedy(tiny_phi3, full, max_new_tokens=8)
+    assert torch.equal(expected, greedy(tiny_phi3, full, max_new_tokens=8, past_key_values=manager.cache([first, second])))
+
+
+def test_paged_pool_exhaustion(tiny_phi3, phi3):
+    manager = phi3.Phi3BlockManager(tiny_phi3.config, num_blocks=2, block_size=4)
+    with pytest.raises(RuntimeError, match="out of KV blocks"), torch.no_grad():
+        tiny_phi3(torch.randint(5, 1000, (1, 10)), past_key_values=manager.cache([manager.new_sequence()]), use_cache=True)
+
+
+def test_paged_cache_rejects_unequal_lengths(tiny_phi3, phi3):
+    manager = phi3.Phi3BlockManager(tiny_phi3.config, num_blocks=8, block_size=4)
+    short, long = manager.new_sequence(), manager.new_sequence()
+    with torch.no_grad():
+        tiny_phi3(torch.randint(5, 1000, (1, 3)), past_key_values=manager.cache([long]), use_cache=True)
+    with pytest.raises(ValueError):
+        manager.cache([short, long])
+
+
+# --- Static cache ---
+
+class FailAfter:
+    """Birkaç adımdan sonra hata fırlatan StoppingCriteria (yarıda kalan üretim)"""
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.steps -= 1
+        if self.steps == 0:
+            raise RuntimeError("üretim yarıda kesildi")
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool)
+
+
+def test_static_cache_matches_dynamic(tiny_phi3):
+    torch.manual_seed(3)
+    ids = torch.randint(5, 1000, (2, 12))
+    assert torch.equal(greedy(tiny_phi3, ids), greedy(tiny_phi3, ids, cache_implementation="static"))
+    assert tiny_phi3._static_cache is None
+
+
+def test_failed_static_generate_leaves_no_stale_cache(tiny_phi3):
+    from transformers import StoppingCriteriaList
+
+    torch.manual_seed(4)
+    ids = torch.randint(5, 1000, (1, 8))
+    expected = greedy(tiny_phi3, ids)
+
+    with pytest.raises(RuntimeError, match="yarıda"):
+        greedy(tiny_phi3, ids, cache_implementation="static", stopping_criteria=StoppingCriteriaList([FailAfter(3)]))
+    assert tiny_phi3._static_cache is None
+
+    # Sonraki çağrılar (dinamik ve statik) yarım kalan tamponları görmez
+    assert torch.equal(greedy(tiny_phi3, ids), expected)
+    assert torch.equal(greedy(tiny_phi3, ids, cache_implementation="static"), expected)
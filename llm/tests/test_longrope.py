@@ -0,0 +1,110 @@
+import asyncio
+import math
+
+import pytest
+import torch
+
+from scheduler import BatchScheduler
+
+
+def reference_rotary(rotary):
+    """Önceden hesaplanmış tablolardan önceki LongRoPE yolu: faktörler her çağrıda, bölge en büyük pozisyondan seçilir"""
+
+    def forward(x, position_ids, seq_len=None, real_seq_len=None):
+        seq_len = torch.max(position_ids) + 1
+        factors = rotary.long_factor if seq_len > rotary.original_max_position_embeddings else rotary.short_factor
+        ext_factors = torch.tensor(factors, dtype=torch.float32, device=x.device)
+        inv_freq_shape = torch.arange(0, rotary.dim, 2, dtype=torch.int64, device=x.device).float() / rotary.dim
+        inv_freq = 1.0 / (ext_factors * rotary.base ** inv_freq_shape)
+
+        inv_freq_expanded = inv_freq[None, :, None].float().expand(position_ids.shape[0], -1, 1)
+        freqs = (inv_freq_expanded @ position_ids[:, None, :].float()).transpose(1, 2)
+        emb = torch.cat((freqs, freqs), dim=-1)
+
+        scale = rotary.max_position_embeddings / rotary.original_max_position_embeddings
+        scaling_factor = math.sqrt(1 + math.log(scale) / math.log(rotary.original_max_position_embeddings))
+        return (emb.cos() * scaling_factor).to(x.dtype), (emb.sin() * scaling_factor).to(x.dtype)
+
+    return forward
+
+
+@pytest.fixture
+def reference(longrope_phi3, monkeypatch):
+    """Rotary embedding'i önceki yola çeviren bağlam; ``with reference():`` içinde model eski yoldan çalışır"""
+    rotary = longrope_phi3.model.rotary_emb
+
+    class Context:
+        def __enter__(self):
+            monkeypatch.setattr(rotary, "forward", reference_rotary(rotary))
+
+        def __exit__(self, *exc):
+            monkeypatch.undo()
+
+    return Context
+
+
+def padded_batch(lengths, width):
+    torch.manual_seed(sum(lengths))
+    ids = torch.full((len(lengths), width), 32000)
+    mask = torch.zeros((len(lengths), width), dtype=torch.long)
+    for row, length in enumerate(lengths):
+        ids[row, width - length:] = torch.randint(5, 1000, (length,))
+        mask[row, width - length:] = 1
+    position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+    return ids, mask, position_ids
+
+
+@pytest.mark.parametrize("lengths, width", [
+    ([30, 12], 40),   # dolgulu genişlik eşiği aşar, gerçek pozisyonlar aşmaz → kısa faktörler
+    ([20, 8], 20),
+    ([36, 10], 44),   # bir satır eşiği gerçekten aşar → tüm batch uzun faktörlerle (önceki davranış)
+])
+def test_padded_batch_matches_reference(longrope_phi3, reference, lengths, width):
+    ids, mask, position_ids = padded_batch(lengths, width)
+    with torch.no_grad():
+        with reference():
+            expected = longrope_phi3(ids, attention_mask=mask, position_ids=position_ids).logits
+        synced = longrope_phi3(ids, attention_mask=mask, position_ids=position_ids).logits
+        hinted = longrope_phi3(ids, attention_mask=mask, position_ids=position_ids, real_seq_len=max(lengths)).logits
+
+    real = mask.bool()
+    assert torch.allclose(synced[real], expected[real], atol=1e-5)
+    assert torch.allclose(hinted[real], expected[real], atol=1e-5)
+
+
+def test_generation_across_threshold_matches_reference(longrope_phi3, reference):
+    ids, mask, _ = padded_batch([28, 9], 36)
+    kwargs = dict(attention_mask=mask, max_new_tokens=12, do_sample=False, pad_token_id=32000)
+    with torch.no_grad():
+        with reference():
+            expected = longrope_phi3.generate(ids, **kwargs)
+        actual = longrope_phi3.generate(ids, **kwargs)
+    assert torch.equal(actual, expected)
+
+
+def test_scheduler_passes_real_length(tiny_phi3, monkeypatch):
+    """Zamanlayıcının ana makinede tuttuğu uzunluk, maskeden hesaplanan en büyük pozisyon + 1 ile aynı olmalı"""
+    seen = []
+    forward = tiny_phi3.forward
+
+    def recording(*args, real_seq_len=None, attention_mask=None, **kwargs):
+        seen.append((real_seq_len, int(attention_mask.sum(-1).max())))
+        return forward(*args, attention_mask=attention_mask, real_seq_len=real_seq_len, **kwargs)
+
+    monkeypatch.setattr(tiny_phi3, "forward", recording)
+    scheduler = BatchScheduler(tiny_phi3, {32000}, 32000, max_batch_size=2)
+    scheduler.start()
+
+    async def run():
+        prefix = [1, 450, 4996]
+        return await asyncio.gather(
+            scheduler.submit([29892, 3186, 338], 6, 0.0, 1.0, prefix_ids=prefix),
+            scheduler.submit([10, 11, 12, 13, 14, 15, 16], 9, 0.0, 1.0, speculative="ngram"),
+            scheduler.submit([1, 10], 7, 0.0, 1.0, speculative="ngram"),
+        )
+
+    try:
+        asyncio.run(run())
+    finally:
+        scheduler.stop()
+    assert seen and all(passed == actual for passed, actual in seen)
@@ -0,0 +1,60 @@
+import copy
+import glob
+import os
+import shutil
+
+import pytest
+import torch
+
+from convert_weights import convert, load_converted
+from quantization import QUANTIZED_LINEARS, quantize_model
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def converted_fp16(tiny_phi3, tmp_path_factory):
+    """Küçük modelin fp16'ya dönüştürülüp mmap ile yüklenmiş hâli"""
+    source = tmp_path_factory.mktemp("tiny_source")
+    tiny_phi3.save_pretrained(source)
+    for name in glob.glob(os.path.join(LLM_DIR, "tokenizer*")) + glob.glob(os.path.join(LLM_DIR, "*_phi3.py")):
+        shutil.copy(name, source)
+    out = tmp_path_factory.mktemp("tiny_converted")
+    convert(str(source), str(out), "float16", trust_remote_code=True)
+    return str(out)
+
+
+def target_modules(model):
+    return [name for name, _ in model.named_modules() if name.rsplit(".", 1)[-1] in QUANTIZED_LINEARS]
+
+
+def test_int8_replaces_only_target_linears(tiny_phi3):
+    model, mode = quantize_model(copy.deepcopy(tiny_phi3), "int8")
+    assert mode == "int8"
+    assert all(isinstance(model.get_submodule(name), torch.ao.nn.quantized.dynamic.Linear)
+               for name in target_modules(model))
+    assert isinstance(model.lm_head, torch.nn.Linear)
+
+    ids = torch.randint(5, 1000, (1, 8))
+    with torch.no_grad():
+        expected, actual = tiny_phi3(ids).logits, model(ids).logits
+    assert torch.allclose(expected, actual, atol=0.1)
+
+
+def test_fp16_converted_model_is_not_copied(converted_fp16):
+    model = load_converted(converted_fp16, trust_remote_code=True)
+    assert model.dtype == torch.float16
+    untouched = {name: p.data_ptr() for name, p in model.named_parameters()
+                 if name.rsplit(".", 2)[-2] not in QUANTIZED_LINEARS}
+
+    model, mode = quantize_model(model, "int8")
+    assert mode == "int8"
+    # Hedef dışı ağırlıklar fp16 kalır ve mmap edilen tensörler yerinde kullanılır
+    assert model.dtype == torch.float16
+    assert {name: p.data_ptr() for name, p in model.named_parameters()} == untouched
+
+    ids = torch.randint(5, 1000, (1, 8))
+    with torch.no_grad():
+        out = model.generate(ids, attention_mask=torch.ones_like(ids), max_new_tokens=5, do_sample=False,
+                             pad_token_id=32000)
+    assert out.shape == (1, 13)
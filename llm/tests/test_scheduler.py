@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+import torch
+
+from scheduler import BatchScheduler
+
+EOS = {32000, 32001, 32007}
+PAD = 32000
+# (prompt, max_new_tokens); batch boyutu istek sayısından küçük olduğu için istekler
+# farklı adımlarda batch'e girer ve farklı adımlarda çıkar
+REQUESTS = [
+    ([1, 450, 4996, 17354], 12),
+    ([1, 22172, 29892, 3186, 338, 263, 1243, 29889], 8),
+    ([1, 10], 15),
+    ([1, 310, 278, 5613, 29871, 30140, 29877], 5),
+    ([1, 22172, 29892, 3186, 338, 2253], 10),
+]
+
+
+def reference(model, prompt, max_new_tokens):
+    """Tek başına greedy ``generate`` çıktısı (EOS hariç)"""
+    ids = torch.tensor([prompt])
+    out = model.generate(
+        ids, attention_mask=torch.ones_like(ids), max_new_tokens=max_new_tokens,
+        do_sample=False, eos_token_id=sorted(EOS), pad_token_id=PAD
+    )
+    generated = out[0, len(prompt):].tolist()
+    for i, token in enumerate(generated):
+        if token in EOS:
+            return generated[:i]
+    return generated
+
+
+@pytest.fixture
+def scheduler(tiny_phi3):
+    s = BatchScheduler(tiny_phi3, EOS, PAD, max_batch_size=2)
+    s.start()
+    yield s
+    s.stop()
+
+
+async def submit_all(scheduler, requests, **kwargs):
+    return await asyncio.gather(*[
+        scheduler.submit(prompt, max_new_tokens, 0.0, 1.0, **kwargs) for prompt, max_new_tokens in requests
+    ])
+
+
+@pytest.mark.parametrize("speculative", [None, "ngram"])
+def test_batched_greedy_matches_generate(tiny_phi3, scheduler, speculative):
+    results = asyncio.run(submit_all(scheduler, REQUESTS, speculative=speculative))
+
+    assert results == [reference(tiny_phi3, prompt, n) for prompt, n in REQUESTS]
+    assert scheduler.snapshot()["max_batch_seen"] == 2
+
+
+def test_prefix_cache_matches_generate(tiny_phi3, scheduler):
+    prefix = REQUESTS[1][0][:5]
+    shared = [(prompt, n) for prompt, n in REQUESTS if prompt[:5] == prefix]
+
+    async def run():
+        return await asyncio.gather(*[
+            scheduler.submit(prompt[len(prefix):], n, 0.0, 1.0, prefix_ids=prefix) for prompt, n in shared
+        ])
+
+    first = asyncio.run(run())
+    second = asyncio.run(run())
+
+    expected = [reference(tiny_phi3, prompt, n) for prompt, n in shared]
+    assert first == second == expected
+    assert scheduler.stats["prefix_misses"] == 1
+    assert scheduler.stats["prefix_hits"] >= 1
+
+
+def test_stream_yields_submit_tokens(tiny_phi3, scheduler):
+    prompt, n = REQUESTS[0]
+
+    async def run():
+        return [token async for token in scheduler.stream(prompt, n, 0.0, 1.0)]
+
+    assert asyncio.run(run()) == reference(tiny_phi3, prompt, n)
+
+
+def test_speculative_mode_validation(scheduler):
+    assert scheduler.speculative_mode("off") is None
+    assert scheduler.speculative_mode("ngram") == "ngram"
+    with pytest.raises(ValueError, match="Taslak model"):
+        scheduler.speculative_mode("draft")
+    with pytest.raises(ValueError, match="geçerli: off, ngram, draft"):
+        scheduler.speculative_mode("medusa")
+    assert set(scheduler.snapshot()["speculative"]) == {"ngram", "draft"}
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+from transformers import AutoTokenizer
+
+from streaming import IncrementalDecoder, JsonSectionParser, StopSequenceFilter, trim_at_stop
+
+LLM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXT = (
+    '{"theory": "Kod \\"büyüsü\\"\\nsatır \\u00e7ok", "answer": "Evet.", '
+    '"homework": ["ödev 1", "ödev 2"], "lab": [], "notes": "not"}'
+)
+
+
+def collect(parser, chunks):
+    sections, order = {}, []
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            if event["event"] == "delta":
+                key = (event["section"], event["index"])
+                sections[key] = sections.get(key, "") + event["text"]
+            else:
+                order.append(event["section"])
+    return sections, order
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, len(TEXT)])
+def test_sections_independent_of_chunking(chunk_size):
+    parser = JsonSectionParser()
+    sections, order = collect(parser, [TEXT[i:i + chunk_size] for i in range(0, len(TEXT), chunk_size)])
+
+    assert sections == {
+        ("theory", None): 'Kod "büyüsü"\nsatır çok',
+        ("answer", None): "Evet.",
+        ("homework", 0): "ödev 1",
+        ("homework", 1): "ödev 2",
+        ("notes", None): "not",
+    }
+    assert order == ["theory", "answer", "homework", "lab", "notes"]
+    assert parser.closed
+
+
+def test_text_after_close_is_ignored():
+    parser = JsonSectionParser()
+    collect(parser, [TEXT])
+    assert parser.feed('{"theory": "x"}') == []
+
+
+def test_incremental_decoder_matches_full_decode():
+    tokenizer = AutoTokenizer.from_pretrained(LLM_DIR)
+    text = "Çırak, SQL injection 'admin' -- ile başlar. 🔮 Kod büyüsü!"
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    decoder = IncrementalDecoder(tokenizer)
+    pieces = [decoder.push(token) for token in ids]
+
+    assert "".join(pieces) == tokenizer.decode(ids, skip_special_tokens=True)
+    assert all("�" not in piece for piece in pieces)
+
+
+SPEAKERS = ("\nKullanıcı:", "\nWizard:")
+REPLY = "SQL injection, sorguya veri sızdırmaktır.\nÖrnek: ' OR 1=1"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 100])
+def test_stop_filter_cuts_at_next_speaker(chunk_size):
+    text = REPLY + "\nKullanıcı: teşekkürler\nWizard: rica ederim"
+    speaker = StopSequenceFilter(SPEAKERS)
+    out = "".join(speaker.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size))
+
+    assert speaker.stopped
+    assert out + speaker.flush() == REPLY == trim_at_stop(text, SPEAKERS)
+    assert speaker.feed("\nyine") == ""
+
+
+def test_stop_filter_releases_partial_marker_at_end():
+    speaker = StopSequenceFilter(SPEAKERS)
+    out = speaker.feed(REPLY + "\nKull")
+
+    assert out == REPLY and not speaker.stopped
+    assert speaker.flush() == "\nKull"
+    assert trim_at_stop(REPLY, SPEAKERS) == REPLY